@@ -1 +1 @@
-from treestore import Treestore, __version__
+from treestore import Treestore, get_store, __version__
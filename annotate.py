@@ -1,16 +1,29 @@
-import urllib2
 import re
-import rdflib
+from lazy import lazy_import
+from templates import QueryTemplate
+
+urllib2 = lazy_import('urllib2')
+rdflib = lazy_import('rdflib')
 
 
 class Annotatable:
+    # named queries (see templates.py); annotations are pasted into the 
+    # query, so it isn't kept prepared
+    query_templates = {
+        'annotate': QueryTemplate('''
+INSERT { GRAPH <%(graph)s> {
+    %(annotations!)s
+} }
+WHERE {
+    GRAPH <%(graph)s> { ?tree obo:CDAO_0000148 [] . }
+}''', prepare=False),
+        }
+    
     def annotate(self, tree_uri, annotations=None, annotation_file=None, doi=None):
         '''Annotate tree with annotations from RDF file.'''
         
         if tree_uri: tree_uri = self.uri_from_id(tree_uri)
         
-        cursor = self.get_cursor()
-        
         if annotations:
             pass
         elif annotation_file:
@@ -23,18 +36,9 @@ class Annotatable:
             raise Exception('No annotation source (string, file, or DOI)  was specified.')
             
         
-        insert_stmt = self.build_query('''
-WITH %s
-INSERT {
-    %s
-}
-WHERE {
-    ?tree obo:CDAO_0000148 [] .
-}
-        ''' % (rdflib.URIRef(tree_uri).n3(), annotations))
-
-        if self.verbose: print insert_stmt
-        cursor.execute(insert_stmt)
+        self.run_query('annotate', graph=tree_uri, annotations=annotations)
+        
+        self.set_version(tree_uri)
 
 
 def doi_lookup(doi):
@@ -0,0 +1,380 @@
+'''Non-blocking access to a treestore from asynchronous code. Every method of
+AsyncTreestore returns a future right away and runs the query on a bounded
+pool of worker threads, each with its own pooled connection. The futures are
+concurrent.futures-style, so an event loop can be called back when they're
+done, rather than waiting for them:
+
+    store = AsyncTreestore(Treestore())
+    future = store.get_subtree(contains=taxa)
+    future.add_done_callback(lambda f: respond(f.result()))
+
+Callbacks run on a worker thread, so they should hand the result back to
+the event loop's own thread (e.g. with Tornado's IOLoop.add_callback).
+'''
+
+import threading
+import Queue
+
+try:
+    from concurrent.futures import Future, CancelledError, TimeoutError
+except ImportError:
+    Future = None
+
+
+class BusyError(Exception):
+    '''Raised by the future of an operation submitted while `max_pending`
+    operations were already queued or running.'''
+
+
+if Future is None:
+    class CancelledError(Exception):
+        pass
+
+    class TimeoutError(Exception):
+        pass
+
+    class Future(object):
+        '''A minimal version of concurrent.futures.Future, for when the
+        futures backport isn't installed.'''
+
+        def __init__(self):
+            self._condition = threading.Condition()
+            self._state = 'pending'
+            self._result = self._exception = None
+            self._callbacks = []
+
+        def cancel(self):
+            with self._condition:
+                if self._state in ('running', 'finished'): return False
+                if self._state == 'cancelled': return True
+                self._state = 'cancelled'
+                self._condition.notify_all()
+            self._run_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == 'cancelled'
+
+        def running(self):
+            return self._state == 'running'
+
+        def done(self):
+            return self._state in ('cancelled', 'finished')
+
+        def set_running_or_notify_cancel(self):
+            with self._condition:
+                if self._state == 'cancelled': return False
+                self._state = 'running'
+                return True
+
+        def _finish(self, result, exception):
+            with self._condition:
+                if self.done(): return
+                self._result, self._exception = result, exception
+                self._state = 'finished'
+                self._condition.notify_all()
+            self._run_callbacks()
+
+        def set_result(self, result):
+            self._finish(result, None)
+
+        def set_exception(self, exception):
+            self._finish(None, exception)
+
+        def _wait(self, timeout):
+            with self._condition:
+                if not self.done(): self._condition.wait(timeout)
+                if self._state == 'cancelled': raise CancelledError()
+                if not self.done(): raise TimeoutError()
+
+        def result(self, timeout=None):
+            self._wait(timeout)
+            if self._exception is not None: raise self._exception
+            return self._result
+
+        def exception(self, timeout=None):
+            self._wait(timeout)
+            return self._exception
+
+        def add_done_callback(self, fn):
+            with self._condition:
+                if not self.done():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        def _run_callbacks(self):
+            callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                try:
+                    fn(self)
+                except Exception:
+                    pass
+
+
+class AsyncTreestore(object):
+    '''Runs treestore operations on `concurrency` worker threads (default: the
+    size of the store's connection pool). At most `max_pending` operations can
+    be queued or running at once; submitting more never blocks the caller,
+    but returns a future that has failed with a BusyError. Cancelling a future stops the operation if it hasn't started yet,
+    or skips its remaining steps if it has.
+
+    Taxa in `get_subtree` and `find_mrca` are resolved in chunks of
+    `resolve_chunk_size`, which are looked up concurrently.'''
+
+    def __init__(self, treestore=None, concurrency=None, max_pending=None,
+                 resolve_chunk_size=100):
+        if treestore is None:
+            from treestore import Treestore
+            treestore = Treestore()
+        self.treestore = treestore
+        self.concurrency = concurrency or treestore.pool.size
+        self.max_pending = max_pending or 4 * self.concurrency
+        self.resolve_chunk_size = resolve_chunk_size
+
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._tasks = Queue.Queue()
+        self._shutdown = False
+        self._workers = []
+        for _ in range(self.concurrency):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None: break
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel(): continue
+            # the connection is returned to the pool after each task, so a
+            # worker waiting for one can't hold up the others
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                self.treestore.release_connection()
+                future.set_exception(e)
+            else:
+                self.treestore.release_connection()
+                future.set_result(result)
+
+    def _run(self, fn, *args, **kwargs):
+        '''Queue a call on the worker threads without waiting for a free
+        slot; used for the steps of an operation that already has one.'''
+
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        '''Run `fn(*args, **kwargs)` on a worker thread and return a future
+        for its result. If `max_pending` operations are queued or running 
+        already, the future fails with a BusyError instead.'''
+
+        if self._shutdown: raise RuntimeError('AsyncTreestore has been shut down.')
+        if not self._slots.acquire(False): return self._busy()
+        future = self._run(fn, *args, **kwargs)
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _start(self):
+        '''Reserve a slot for an operation made of several steps, and return
+        the future for its final result. If there's no free slot, the 
+        future has failed already, and no steps should be started.'''
+
+        if self._shutdown: raise RuntimeError('AsyncTreestore has been shut down.')
+        if not self._slots.acquire(False): return self._busy()
+        outer = Future()
+        outer.add_done_callback(lambda f: self._slots.release())
+        return outer
+
+    def _busy(self):
+        future = Future()
+        future.set_exception(BusyError('%s operations are pending already.' % self.max_pending))
+        return future
+
+    def _then(self, future, outer, fn):
+        '''When `future` finishes, call `fn` with its result; `fn` starts the
+        next step. Errors are passed on to `outer`, and cancelling `outer`
+        cancels `future`.'''
+
+        outer.add_done_callback(lambda f: f.cancelled() and future.cancel())
+
+        def done(future):
+            if outer.done(): return
+            if future.cancelled():
+                outer.cancel()
+                return
+            try:
+                fn(future.result())
+            except BaseException as e:
+                outer.set_exception(e)
+
+        future.add_done_callback(done)
+
+    def _combine(self, futures, merge):
+        '''Return a future for `merge` applied to the results of several
+        futures, once they've all finished.'''
+
+        combined = Future()
+        combined.add_done_callback(
+            lambda f: f.cancelled() and [future.cancel() for future in futures])
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(future):
+            if combined.done(): return
+            if future.cancelled():
+                combined.cancel()
+                return
+            if future.exception() is not None:
+                combined.set_exception(future.exception())
+                return
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            try:
+                combined.set_result(merge([f.result() for f in futures]))
+            except BaseException as e:
+                combined.set_exception(e)
+
+        for future in futures:
+            future.add_done_callback(done)
+        return combined
+
+    def _resolve_taxa(self, graph, taxa, taxonomy=None):
+        # look up chunks of taxa concurrently, then merge the results
+        size = self.resolve_chunk_size
+        chunks = [taxa[i:i+size] for i in range(0, len(taxa), size)] or [[]]
+
+        def merge(results):
+            resolved, unresolved = {}, []
+            for chunk_resolved, chunk_unresolved in results:
+                resolved.update(chunk_resolved)
+                unresolved += chunk_unresolved
+            return resolved, unresolved
+
+        return self._combine([self._run(self.treestore.resolve_taxa, graph, chunk, taxonomy)
+                              for chunk in chunks], merge)
+
+    def resolve_taxa(self, graph, taxa, taxonomy=None):
+        '''Asynchronous Treestore.resolve_taxa; chunks of taxa are resolved
+        concurrently.'''
+
+        outer = self._start()
+        if outer.done(): return outer
+        self._then(self._resolve_taxa(self.treestore.uri_from_id(graph), list(taxa), taxonomy),
+                   outer, outer.set_result)
+        return outer
+
+    def _with_resolved(self, outer, taxa, tree_uri, filter, taxonomy, fn):
+        # find the best tree if none was given, resolve the taxa in it, then
+        # call fn(tree_uri, resolved)
+        def resolve(tree_uri):
+            self._then(self._resolve_taxa(tree_uri, taxa, taxonomy), outer,
+                       lambda resolved: fn(tree_uri, resolved))
+
+        if tree_uri:
+            resolve(self.treestore.uri_from_id(tree_uri))
+        else:
+            self._then(self._run(self.treestore.best_tree, taxa, filter=filter,
+                                 taxonomy=taxonomy),
+                       outer, resolve)
+
+    def find_mrca(self, taxa, tree_uri, taxonomy=None, unresolved=None):
+        '''Asynchronous Treestore.find_mrca.'''
+
+        taxa = list(taxa)
+        outer = self._start()
+        if outer.done(): return outer
+
+        def find(tree_uri, resolved):
+            self._then(self._run(self.treestore.find_mrca, taxa, tree_uri, taxonomy,
+                                 unresolved=unresolved, resolved=resolved),
+                       outer, outer.set_result)
+
+        self._with_resolved(outer, taxa, tree_uri, None, taxonomy, find)
+        return outer
+
+    def get_subtree(self, contains=[], contains_ids=[], tree_uri=None,
+                    format='newick', prune=True, filter=None, taxonomy=None,
+                    handle=None, unresolved=None):
+        '''Asynchronous Treestore.get_subtree.'''
+
+        if not contains or contains_ids: raise Exception('A list of taxa or ids is required.')
+        taxa = list(contains)
+        outer = self._start()
+        if outer.done(): return outer
+
+        def subtree(tree_uri, resolved):
+            self._then(self._run(self.treestore.get_subtree, contains=taxa,
+                                 tree_uri=tree_uri, format=format, prune=prune,
+                                 taxonomy=taxonomy, handle=handle,
+                                 unresolved=unresolved, resolved=resolved),
+                       outer, outer.set_result)
+
+        self._with_resolved(outer, taxa, tree_uri, filter, taxonomy, subtree)
+        return outer
+
+    def list_trees_containing_taxa(self, *args, **kwargs):
+        '''Asynchronous Treestore.list_trees_containing_taxa; the result is
+        a list.'''
+
+        return self.submit(lambda: list(self.treestore.list_trees_containing_taxa(*args, **kwargs)))
+
+    def get_names(self, *args, **kwargs):
+        return self.submit(self.treestore.get_names, *args, **kwargs)
+
+    def count_names(self, *args, **kwargs):
+        return self.submit(self.treestore.count_names, *args, **kwargs)
+
+    def get_tree_info(self, *args, **kwargs):
+        return self.submit(self.treestore.get_tree_info, *args, **kwargs)
+
+    def serialize_trees(self, *args, **kwargs):
+        return self.submit(self.treestore.serialize_trees, *args, **kwargs)
+
+    def add_trees(self, *args, **kwargs):
+        return self.submit(self.treestore.add_trees, *args, **kwargs)
+
+    def graft_trees(self, *args, **kwargs):
+        return self.submit(self.treestore.graft_trees, *args, **kwargs)
+
+    def prune_clade(self, *args, **kwargs):
+        return self.submit(self.treestore.prune_clade, *args, **kwargs)
+
+    def relabel_taxa(self, *args, **kwargs):
+        return self.submit(self.treestore.relabel_taxa, *args, **kwargs)
+
+    def set_branch_length(self, *args, **kwargs):
+        return self.submit(self.treestore.set_branch_length, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        '''Stop accepting operations, and stop the worker threads once the
+        operations already submitted have finished.'''
+
+        if self._shutdown: return
+        self._shutdown = True
+
+        def stop():
+            # every pending operation holds a slot until it's done
+            for _ in range(self.max_pending):
+                self._slots.acquire()
+            for _ in self._workers:
+                self._tasks.put(None)
+
+        if wait:
+            stop()
+            for worker in self._workers:
+                worker.join()
+        else:
+            stopper = threading.Thread(target=stop)
+            stopper.daemon = True
+            stopper.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
@@ -0,0 +1,115 @@
+import collections
+import threading
+
+
+class TreeCache:
+    '''An LRU cache of reconstructed trees (as CompactTrees). Entries are 
+    keyed by graph URI and tagged with the graph's version stamp; an entry is
+    only returned for the version it was stored with. The cache is bounded both by number of
+    entries and by the estimated size of the trees it holds.
+
+    Queries that need only part of a tree don't fill the cache on their own
+    first miss; a tree is worth reconstructing whole once it's been missed
+    `fill_after` times (see `note_miss`).'''
+
+    fill_after = 2
+
+    def __init__(self, max_entries=64, max_bytes=256*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # graph -> lookups that missed since it was last stored
+        self._missed = {}
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, graph, version):
+        '''Return the cached tree for this version of a graph, or None.'''
+
+        with self._lock:
+            entry = self._entries.pop(graph, None)
+            if entry is None or entry[0] != version:
+                if entry: self._bytes -= entry[2]
+                self.misses += 1
+                return None
+
+            # reinsert to mark this as the most recently used entry
+            self._entries[graph] = entry
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, graph, version):
+        '''Return the cached tree for this version of a graph, or None,
+        without counting a hit or miss.'''
+
+        with self._lock:
+            entry = self._entries.get(graph)
+            return entry[1] if entry and entry[0] == version else None
+
+    def note_miss(self, graph):
+        '''Count a miss by a caller that only needs part of a graph's tree,
+        and so doesn't reconstruct and store it. Returns True instead, 
+        without counting, once the graph has been missed `fill_after` times,
+        when the caller should `get` and `put` the whole tree.'''
+
+        with self._lock:
+            missed = self._missed.get(graph, 0) + 1
+            if missed >= self.fill_after:
+                self._missed.pop(graph, None)
+                return True
+            if len(self._missed) >= 4 * self.max_entries: self._missed.clear()
+            self._missed[graph] = missed
+            self.misses += 1
+            return False
+
+    def put(self, graph, version, tree, size):
+        '''Store a tree reconstructed from a given version of a graph.
+        `size` is its estimated size in bytes.'''
+
+        if not self.enabled or size > self.max_bytes: return
+
+        with self._lock:
+            old = self._entries.pop(graph, None)
+            if old: self._bytes -= old[2]
+
+            self._entries[graph] = (version, tree, size)
+            self._bytes += size
+
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, graph=None):
+        '''Drop the cached tree for a graph, or all cached trees.'''
+
+        with self._lock:
+            if graph is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._bytes = 0
+            elif graph in self._entries:
+                self._bytes -= self._entries.pop(graph)[2]
+                self.invalidations += 1
+
+    def stats(self):
+        '''Return a dictionary of cache statistics.'''
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    }
+
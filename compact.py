@@ -0,0 +1,422 @@
+import math
+import re
+from array import array
+from lazy import lazy_import
+
+bp = lazy_import('Bio.Phylo')
+
+
+nan = float('nan')
+
+# labels that don't match this pattern are quoted in Newick output
+unquoted_label = re.compile(r"[^\s\(\)\[\]\'\:\;\,]+")
+
+# number of output pieces collected before each write to the output handle
+write_chunk = 4096
+
+
+class CompactTree(object):
+    '''A tree stored as flat arrays instead of linked clade objects. Nodes are
+    numbered in preorder; each node has a parent index (-1 for roots), a
+    branch length (NaN if missing) and a label, and the children of node i
+    are children[offsets[i]:offsets[i+1]]. Since nodes are in preorder, the
+    subtree of node i is the range of nodes from i to ends[i].
+
+    Labels are interned, so a label shared by many nodes is stored once.'''
+
+    __slots__ = ('ids', 'parents', 'lengths', 'labels', 'offsets', 'children',
+                 'ends', 'rooted', '_index')
+
+    def __init__(self, ids, parents, lengths, labels, rooted=True):
+        '''Create a tree from lists of store node ids, parent indices, branch
+        lengths and labels, all in preorder.'''
+
+        n = len(parents)
+        self.ids = ids
+        self.parents = parents if isinstance(parents, array) else array('i', parents)
+        self.lengths = lengths if isinstance(lengths, array) else array('d', lengths)
+        self.labels = labels
+        self.rooted = rooted
+        self._index = None
+
+        # count children per node, then fill them in from the parent array
+        offsets = array('i', [0]) * (n + 1)
+        for parent in self.parents:
+            if parent >= 0: offsets[parent + 1] += 1
+        for i in xrange(n):
+            offsets[i + 1] += offsets[i]
+        children = array('i', [0]) * offsets[n]
+        fill = array('i', offsets)
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                children[fill[parent]] = i
+                fill[parent] += 1
+        self.offsets = offsets
+        self.children = children
+
+        # in preorder, a node's subtree ends where its last child's subtree ends
+        ends = array('i', xrange(n))
+        for i in xrange(n - 1, -1, -1):
+            parent = self.parents[i]
+            if parent >= 0 and ends[i] > ends[parent]: ends[parent] = ends[i]
+        self.ends = ends
+
+    @classmethod
+    def from_rows(cls, batches, mrca=None, replace=None):
+        '''Build a tree from batches of (node id, branch length, parent id,
+        label) rows, which can arrive in any order. The root is `mrca` if
+        given, otherwise the node without a parent; labels found in `replace`
+        are replaced with the corresponding value.'''
+
+        info = {}
+        child_ids = {}
+        roots = []
+        interned = {}
+
+        for rows in batches:
+            for node_id, edge_length, parent, label in rows:
+                if node_id in info: continue
+
+                # replace synonymous names from the phylogeny with names from the query
+                if replace and label in replace: label = replace[label]
+                if label is not None: label = interned.setdefault(label, label)
+
+                info[node_id] = (float(edge_length) if edge_length else nan, label)
+
+                # this is a root node if it has no parent or if it's the MRCA
+                if (node_id == mrca) if mrca else (parent is None):
+                    roots.append(node_id)
+                else:
+                    child_ids.setdefault(parent, []).append(node_id)
+
+        # any parent that never had a row of its own is kept as a root, so no
+        # nodes are lost
+        for parent in child_ids:
+            if not parent in info:
+                info[parent] = (nan, None)
+                roots.append(parent)
+
+        ids = []
+        parents = array('i')
+        lengths = array('d')
+        labels = []
+        stack = [(node_id, -1) for node_id in reversed(roots)]
+        while stack:
+            node_id, parent = stack.pop()
+            index = len(ids)
+            edge_length, label = info[node_id]
+            ids.append(node_id)
+            parents.append(parent)
+            lengths.append(edge_length)
+            labels.append(label)
+            stack += [(child, index) for child in reversed(child_ids.get(node_id, ()))]
+
+        return cls(ids, parents, lengths, labels)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def child_indices(self, i):
+        return self.children[self.offsets[i]:self.offsets[i + 1]]
+
+    def length(self, i):
+        '''Branch length of node i, or None if it has none.'''
+
+        x = self.lengths[i]
+        return None if x != x else x
+
+    def index_of(self, node_id):
+        '''Return the index of the node with a given store node id.'''
+
+        if self._index is None:
+            self._index = {node_id: i for i, node_id in enumerate(self.ids)}
+        return self._index[node_id]
+
+    def roots(self):
+        return [i for i, parent in enumerate(self.parents) if parent < 0]
+
+    def mrca(self, indices):
+        '''Return the index of the most recent common ancestor of some nodes,
+        or None if they're in different trees of a forest.'''
+
+        lo, hi = min(indices), max(indices)
+        node = lo
+        while self.ends[node] < hi:
+            node = self.parents[node]
+            if node < 0: return None
+        return node
+
+    def subtree(self, i):
+        '''Return the subtree rooted at node i as a new CompactTree.'''
+
+        end = self.ends[i] + 1
+        parents = array('i', [parent - i for parent in self.parents[i:end]])
+        parents[0] = -1
+        return CompactTree(self.ids[i:end], parents, self.lengths[i:end],
+                           self.labels[i:end], self.rooted)
+
+    def induced(self, i, indices):
+        '''Return the subtree rooted at node i with only the nodes on the
+        paths from `indices` (which must be descendants of i) up to it, as a
+        new CompactTree. Pruning it gives the same tree as pruning the whole
+        subtree to those nodes, without visiting the rest of the subtree.'''
+
+        parents = self.parents
+        kept = set([i])
+        for node in indices:
+            while not node in kept:
+                kept.add(node)
+                node = parents[node]
+
+        nodes = sorted(kept)
+        position = {node: n for n, node in enumerate(nodes)}
+        new_parents = array('i', [-1]) + array('i', [position[parents[node]] for node in nodes[1:]])
+        return CompactTree([self.ids[node] for node in nodes], new_parents,
+                           array('d', [self.lengths[node] for node in nodes]),
+                           [self.labels[node] for node in nodes], self.rooted)
+
+    def relabel(self, replace):
+        '''Replace labels found in `replace`, in place. Returns the tree.'''
+
+        if replace:
+            self.labels = [replace.get(label, label) for label in self.labels]
+        return self
+
+    def changed(self, labels=None, lengths=None):
+        '''Return a copy of the tree with some nodes' labels or branch
+        lengths replaced, given as dictionaries keyed by node index.'''
+
+        new_labels = list(self.labels)
+        for i, label in (labels or {}).iteritems(): new_labels[i] = label
+        new_lengths = array('d', self.lengths)
+        for i, length in (lengths or {}).iteritems(): 
+            new_lengths[i] = nan if length is None else length
+        return CompactTree(self.ids, self.parents, new_lengths, new_labels, self.rooted)
+
+    def splice(self, start, stop, ids=(), parents=(), lengths=(), labels=()):
+        '''Return a copy of the tree with the nodes from `start` up to (but
+        not including) `stop`, which must be whole subtrees or an empty
+        range, replaced by new nodes. The new nodes are given in preorder,
+        with parent indices in the new tree.'''
+
+        shift = len(ids) - (stop - start)
+        new_parents = self.parents[:start] + array('i', parents)
+        new_parents.extend(parent + shift if parent >= stop else parent
+                           for parent in self.parents[stop:])
+        new_lengths = (self.lengths[:start] + 
+                       array('d', [nan if length is None else length for length in lengths]) +
+                       self.lengths[stop:])
+        return CompactTree(list(self.ids[:start]) + list(ids) + list(self.ids[stop:]),
+                           new_parents, new_lengths,
+                           self.labels[:start] + list(labels) + self.labels[stop:],
+                           self.rooted)
+
+    def collapse(self, i):
+        '''Return a copy of the tree without node i, which must have a single
+        child; the child takes its place, with the sum of their branch
+        lengths.'''
+
+        parent = self.parents[i]
+        new_parents = self.parents[:i]
+        new_parents.extend(parent if p == i else p - 1 if p > i else p
+                           for p in self.parents[i + 1:])
+        new_lengths = array('d', self.lengths)
+        new_lengths[i + 1] = add_lengths(new_lengths[i], new_lengths[i + 1])
+        del new_lengths[i]
+        return CompactTree(list(self.ids[:i]) + list(self.ids[i + 1:]), new_parents, new_lengths,
+                           self.labels[:i] + self.labels[i + 1:], self.rooted)
+
+    def prune(self, contains):
+        '''Return the subtree induced by the nodes labeled with names in
+        `contains`, computed in one postorder pass. Unlabeled nodes left with
+        a single child are collapsed into it, adding their branch lengths
+        together; roots are always kept.'''
+
+        n = len(self)
+        lengths = array('d', self.lengths)
+        kept_children = [None] * n
+        collapsed = array('i', [-1]) * n
+
+        for i in xrange(n - 1, -1, -1):
+            kept = [collapsed[child] for child in self.child_indices(i)
+                    if collapsed[child] >= 0]
+            kept_children[i] = kept
+
+            if self.parents[i] < 0: continue
+            if self.labels[i] in contains or len(kept) > 1:
+                collapsed[i] = i
+            elif len(kept) == 1:
+                only_child = kept[0]
+                lengths[only_child] = add_lengths(lengths[i], lengths[only_child])
+                collapsed[i] = only_child
+
+        ids = []
+        parents = array('i')
+        new_lengths = array('d')
+        labels = []
+        stack = [(i, -1) for i in reversed(self.roots())]
+        while stack:
+            i, parent = stack.pop()
+            index = len(ids)
+            ids.append(self.ids[i])
+            parents.append(parent)
+            new_lengths.append(lengths[i])
+            labels.append(self.labels[i])
+            stack += [(child, index) for child in reversed(kept_children[i])]
+
+        return CompactTree(ids, parents, new_lengths, labels, self.rooted)
+
+    def count_terminals(self):
+        return sum(1 for i in xrange(len(self)) if self.offsets[i] == self.offsets[i + 1])
+
+    def count_labels(self):
+        return sum(1 for label in self.labels if label)
+
+    def nbytes(self):
+        '''Estimate the memory used by this tree, in bytes.'''
+
+        arrays = (self.parents, self.lengths, self.offsets, self.children, self.ends)
+        size = sum(a.itemsize * len(a) for a in arrays)
+        # pointers to ids and labels, plus the (interned) label strings
+        size += 16 * len(self)
+        size += sum(len(label) + 40 for label in set(self.labels) if label)
+        return size
+
+    def forest_root(self):
+        '''If this is a forest, return a copy joined under a new unlabeled
+        root (as `to_phylo` does); otherwise return the tree itself.'''
+
+        if len(self.roots()) < 2: return self
+        parents = array('i', [-1]) + array('i', [parent + 1 for parent in self.parents])
+        # new Biopython clades have a branch length of 1.0 by default
+        return CompactTree([None] + self.ids, parents, array('d', [1.0]) + self.lengths,
+                           [None] + self.labels, self.rooted)
+
+    def write_newick(self, handle):
+        '''Write the tree to `handle` in Newick format, in chunks, with the
+        same output as Biopython's Newick writer.'''
+
+        tree = self.forest_root()
+        parents, ends, lengths = tree.parents, tree.ends, tree.lengths
+        formatted = {}
+
+        def info(i):
+            label = tree.labels[i] or ''
+            if label in formatted:
+                label = formatted[label]
+            else:
+                match = unquoted_label.match(label)
+                if label and (not match or match.end() < len(label)):
+                    formatted[label] = "'%s'" % label.replace('\\', '\\\\').replace("'", "\\'")
+                else:
+                    formatted[label] = label
+                label = formatted[label]
+            length = lengths[i]
+            return '%s:%1.5f' % (label, length if length == length and length else 0.0)
+
+        # in preorder, a node's first child directly follows it; a node's
+        # closing parenthesis is written after the last node of its subtree
+        pieces = []
+        for i in xrange(len(tree)):
+            parent = parents[i]
+            if parent >= 0 and i != parent + 1: pieces.append(',')
+            if ends[i] > i:
+                pieces.append('(')
+                continue
+
+            pieces.append(info(i))
+            while parent >= 0 and ends[parent] == i:
+                pieces.append(')' + info(parent))
+                parent = parents[parent]
+
+            if len(pieces) >= write_chunk:
+                handle.write(''.join(pieces))
+                pieces = []
+
+        pieces.append(';\n')
+        handle.write(''.join(pieces))
+
+    def write_ascii(self, handle, column_width=80):
+        '''Draw the tree to `handle` as ASCII art, with the same output as
+        Biopython's draw_ascii, one line at a time.'''
+
+        tree = self.forest_root()
+        n = len(tree)
+        parents, offsets, children = tree.parents, tree.offsets, tree.children
+
+        terminals = [i for i in xrange(n) if offsets[i] == offsets[i + 1]]
+        names = []
+        for i in terminals:
+            name = tree.labels[i] or 'Clade'
+            if len(name) > 40: name = name[:37] + '...'
+            names.append(name)
+
+        max_label_width = max(len(name) for name in names)
+        drawing_width = column_width - max_label_width - 1
+        drawing_height = 2 * len(terminals) - 1
+
+        # column positions, from the depth of each node; if there are no 
+        # branch lengths, assume unit branch lengths
+        depths = [0] * n
+        for unit in (False, True):
+            depths[0] = tree.length(0) or 0
+            for i in xrange(1, n):
+                depths[i] = depths[parents[i]] + (1 if unit else (tree.length(i) or 0))
+            if max(depths) != 0: break
+        fudge_margin = int(math.ceil(math.log(len(terminals), 2)))
+        cols_per_branch_unit = (drawing_width - fudge_margin) / float(max(depths))
+        cols = [int(depth * cols_per_branch_unit + 1.0) for depth in depths]
+
+        # row positions: terminals on even rows, internal nodes halfway
+        # between their first and last child
+        rows = [0] * n
+        for row, i in enumerate(terminals):
+            rows[i] = 2 * row
+        for i in xrange(n - 1, -1, -1):
+            if offsets[i] < offsets[i + 1]:
+                rows[i] = (rows[i + 1] + rows[children[offsets[i + 1] - 1]]) // 2
+
+        matrix = [bytearray(' ' * drawing_width) for _ in xrange(drawing_height)]
+        for i in xrange(n):
+            thiscol = cols[i]
+            line = matrix[rows[i]]
+            for col in xrange(cols[parents[i]] + 1 if i else 0, thiscol):
+                line[col] = '_'
+            if offsets[i] < offsets[i + 1]:
+                toprow = rows[i + 1]
+                botrow = rows[children[offsets[i + 1] - 1]]
+                for row in xrange(toprow + 1, botrow + 1):
+                    matrix[row][thiscol] = '|'
+                # short terminal branches need something to stop rstrip()
+                if cols[i + 1] - thiscol < 2:
+                    matrix[toprow][thiscol] = ','
+
+        for row, line in enumerate(matrix):
+            line = str(line).rstrip()
+            # add labels for terminal taxa in the right margin
+            if row % 2 == 0: line += ' ' + names[row // 2]
+            handle.write(line + '\n')
+        handle.write('\n')
+
+    def to_phylo(self):
+        '''Convert to a Biopython tree.'''
+
+        clades = [bp.CDAO.Clade(name=self.labels[i], branch_length=self.length(i))
+                  for i in xrange(len(self))]
+        roots = []
+        for i, parent in enumerate(self.parents):
+            if parent < 0: roots.append(clades[i])
+            else: clades[parent].clades.append(clades[i])
+
+        if len(roots) == 1: root = roots[0]
+        else: root = bp.CDAO.Clade(clades=roots)
+
+        return bp.CDAO.Tree(root=root, rooted=self.rooted)
+
+
+def add_lengths(a, b):
+    '''Sum two branch lengths, either of which may be missing (NaN or None).'''
+
+    if a is None or a != a: return b
+    if b is None or b != b: return a
+    return a + b
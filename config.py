@@ -6,12 +6,13 @@ import tempfile
 
 load_dir = os.path.join(tempfile.gettempdir(), 'treestore')
 base_uri = 'http://www.phylocommons.org/trees/'
+config_dir = os.path.expanduser('~/.treestore')
+db_path = os.path.join(config_dir, 'treestore.db')
 
 def get_treestore_kwargs():
     global load_dir
     global base_uri
     
-    config_dir = os.path.expanduser('~/.treestore')
     if not os.path.exists(config_dir): os.makedirs(config_dir)
     config_file_path = os.path.join(config_dir, 'treestore.config')
     
@@ -21,6 +22,11 @@ def get_treestore_kwargs():
                 ('password', 'dba'),
                 ('load_dir', load_dir),
                 ('base_uri', base_uri),
+                ('store', 'virtuoso'),
+                ('db_path', db_path),
+                ('cache_size', '64'),
+                ('cache_bytes', str(256*1024*1024)),
+                ('pool_size', '8'),
                 ]
     
     config = ConfigParser.SafeConfigParser()
@@ -38,7 +44,23 @@ def get_treestore_kwargs():
     for k, v in config.items('treestore'):
         kwargs[k] = v
     
+    # config files written by older versions may be missing newer options
+    for key, value in defaults:
+        if not key in kwargs: kwargs[key] = value
+    
     if 'load_dir' in kwargs: load_dir = kwargs['load_dir']
     if not os.path.exists(load_dir): os.makedirs(load_dir)
     
     return kwargs
+
+
+def config_defaults(**options):
+    '''Return a dictionary of options, replacing any that are None with
+    their values from the config file. The config file is only read if
+    some options are missing.'''
+    
+    if None in options.values():
+        config = get_treestore_kwargs()
+        for key, value in options.items():
+            if value is None: options[key] = config[key]
+    return options
@@ -0,0 +1,41 @@
+'''Canonical content hashes of trees, used to skip adding trees that are
+already stored. A tree's hash covers its topology, labels and branch
+lengths, but not the order of children, so the same tree written with
+its clades in a different order has the same hash.'''
+
+import hashlib
+from operator import itemgetter
+
+
+def tree_hashes(rows, salt=''):
+    '''Return the hash of each tree in a list of (index, parent, label,
+    length, ...) node rows, where children have higher indexes than their
+    parents (e.g. in preorder), as a list of hex strings in the order of
+    their roots. `salt` is included in every hash, for anything else that
+    affects how a tree is stored.'''
+
+    sha1 = hashlib.sha1
+    digests = {}
+    roots = []
+    # children are hashed before their parents, and each parent's hash
+    # covers its children's hashes in sorted order
+    for row in sorted(rows, key=itemgetter(0), reverse=True):
+        index, parent, label, length = row[:4]
+        if isinstance(label, unicode): label = label.encode('utf-8')
+        children = digests.pop(index, None)
+        node = sha1('%s\0%s\0%s' % (label or '', '' if length is None else repr(float(length)),
+                                    ''.join(sorted(children)) if children else '')).digest()
+        if parent is None:
+            roots.append(node)
+        else:
+            digests.setdefault(parent, []).append(node)
+
+    return [sha1(salt + root).hexdigest() for root in reversed(roots)]
+
+
+def unchanged(hashes, stored):
+    '''Return True if a file's tree hashes are exactly those stored under
+    its URI, so adding it again wouldn't change anything.'''
+
+    return bool(hashes) and set(hashes) == set(stored)
+
@@ -11,9 +11,9 @@ Triple.__str__ = lambda self: '%s %s %s' % (str(self.term1), str(self.relation),
 Triple.__repr__ = Triple.__str__
 Query = collections.namedtuple('Query', 'prefixes clause sortspec')
 
-charString1 = Regex(r'''[^\(\)\=\<\>\"\/\s]*''')
+charString1 = Regex(r'''[^\(\)\=\<\>\"\/\s]+''')
 charString2 = dblQuotedString
-comparitorSymbol = Literal('==') | '>' | '<' | '>=' | '<=' | '<>' | '='
+comparitorSymbol = Literal('==') | '>=' | '<=' | '<>' | '>' | '<' | '='
 identifier = charString1 | charString2
 term = identifier | 'and' | 'or' | 'not' | 'prox' | 'sortby'
 prefix = uri = modifierName = modifierValue = index = searchTerm = term
@@ -21,13 +21,17 @@ term.setParseAction(lambda x: Term(x[0]))
 cqlQuery = Forward()
 modifier = '/' + modifierName + Optional(comparitorSymbol + modifierValue)
 modifierList = OneOrMore(modifier)
-namedComparitor = identifier
+boolean = CaselessKeyword('and') | CaselessKeyword('or') | CaselessKeyword('not') | CaselessKeyword('prox')
+# a boolean after a bare search term isn't a relation
+namedComparitor = ~boolean + identifier
 comparitor = comparitorSymbol | namedComparitor
 relation = comparitor + Optional(modifierList)
 triple = (index + relation + searchTerm)
-triple.setParseAction(lambda x: Triple(*x))
+def make_triple(text, loc, x):
+    if len(x) != 3: raise ParseFatalException(text, loc, 'Relation modifiers are not supported')
+    return Triple(*x)
+triple.setParseAction(make_triple)
 searchClause = (Suppress('(') + cqlQuery + Suppress(')')) | triple | searchTerm
-boolean = Literal('and') | 'or' | 'not' | 'prox'
 booleanGroup = boolean + Optional(modifierList)
 scopedClause = searchClause + ZeroOrMore(booleanGroup + searchClause)
 def combine_search_clauses(*x):
@@ -41,6 +45,8 @@ prefixAssignment.setParseAction(lambda x: (x[0], x[1]))
 prefixAssignments = OneOrMore(prefixAssignment)
 prefixAssignments.setParseAction(lambda x: {key:value for (key, value) in x})
 cqlQuery << (Optional(prefixAssignments, default={}) + scopedClause)
+# a parenthesized query is a single clause
+cqlQuery.setParseAction(lambda x: x[-1])
 singleSpec = index + Optional(modifierList)
 sortSpec = OneOrMore(singleSpec)
 sortedQuery = Forward()
@@ -0,0 +1,255 @@
+'''A server that keeps a treestore open between commands, and the client
+used by the treestore command to run commands on it.
+
+Clients send their arguments and working directory as a line of JSON.
+The server runs the command on its store and sends back its output as
+frames of a one-byte channel, a four-byte length and the data: 'o' for
+stdout and 'e' for stderr, followed by 'x' with the exit status, or 'l' if
+the client should run the command itself.
+
+Only the standard library is imported here, so the client starts quickly.'''
+
+import errno
+import json
+import os
+import signal
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import traceback
+from config import config_dir
+
+
+header = struct.Struct('>cI')
+
+
+class RunLocally(Exception):
+    '''Raised by a server's command handler for commands it can't run,
+    which are sent back to the client.'''
+    pass
+
+
+def socket_path():
+    '''Return the default server socket path.'''
+
+    return os.environ.get('TREESTORE_SOCKET') or os.path.join(config_dir, 'treestore.sock')
+
+
+class ThreadStreams(object):
+    '''A file-like object that writes to the stream set for the current
+    thread, or to a default stream. Installed as sys.stdout and sys.stderr
+    while serving, so each command's output goes to its own client.'''
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def write(self, data):
+        self.stream().write(data)
+
+    def writelines(self, lines):
+        for line in lines: self.write(line)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream(), name)
+
+
+class Channel(object):
+    '''A file-like object that writes frames for one channel to a client.'''
+
+    softspace = 0
+
+    def __init__(self, output, channel):
+        self.output = output
+        self.channel = channel
+
+    def write(self, data):
+        if isinstance(data, unicode): data = data.encode('utf-8')
+        if not data: return
+        self.output.write(header.pack(self.channel, len(data)))
+        self.output.write(data)
+
+    def writelines(self, lines):
+        for line in lines: self.write(line)
+
+    def flush(self):
+        self.output.flush()
+
+    def isatty(self):
+        return False
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    # buffer output, so many small writes don't each need a system call
+    wbufsize = 64 * 1024
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+            cwd = request.get('cwd', '/').encode('utf-8')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+
+        stdout = Channel(self.wfile, 'o')
+        stderr = Channel(self.wfile, 'e')
+        self.server.stdout.local.stream = stdout
+        self.server.stderr.local.stream = stderr
+        try:
+            try:
+                status = self.server.run(argv, cwd)
+            except RunLocally:
+                self.send('l', '')
+                return
+            except SystemExit as e:
+                status = e.code
+            except socket.error:
+                raise
+            except Exception:
+                traceback.print_exc(file=stderr)
+                status = 1
+
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                stderr.write('%s\n' % status)
+                status = 1
+            self.send('x', str(status))
+        except socket.error:
+            # the client went away
+            pass
+        finally:
+            self.server.stdout.local.stream = None
+            self.server.stderr.local.stream = None
+
+    def send(self, channel, data):
+        self.wfile.write(header.pack(channel, len(data)))
+        self.wfile.write(data)
+
+
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, run):
+        SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        self.run = run
+        self.stdout = ThreadStreams(sys.stdout)
+        self.stderr = ThreadStreams(sys.stderr)
+
+
+def serve(run, path=None):
+    '''Listen on a Unix socket and run the commands clients send with
+    `run(argv, cwd)`, which returns an exit status, until interrupted. Each
+    client is handled in its own thread.'''
+
+    path = path or socket_path()
+    if os.path.exists(path):
+        if listening(path):
+            raise Exception('A treestore server is already listening on %s.' % path)
+        os.remove(path)
+    socket_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(socket_dir): os.makedirs(socket_dir)
+
+    # only this user can connect
+    old_umask = os.umask(0177)
+    try:
+        server = CommandServer(path, run)
+    finally:
+        os.umask(old_umask)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+
+    sys.stdout, sys.stderr = server.stdout, server.stderr
+    sys.stderr.write('Serving on %s\n' % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = server.stdout.default, server.stderr.default
+        server.server_close()
+        if os.path.exists(path): os.remove(path)
+
+
+def listening(path):
+    '''Return True if a server is accepting connections on `path`.'''
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def call(argv, path=None, stdout=None, stderr=None):
+    '''Run a command on a server, writing its output to `stdout` and
+    `stderr`. Returns its exit status, or None if no server is listening or
+    the server sent the command back to be run locally.'''
+
+    path = path or socket_path()
+    if not os.path.exists(path): return None
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return None
+
+        sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n')
+        response = sock.makefile('rb', 64 * 1024)
+        outputs = {'o': stdout, 'e': stderr}
+        while True:
+            frame = response.read(header.size)
+            if len(frame) < header.size:
+                stderr.write('The treestore server closed the connection.\n')
+                return 1
+            channel, size = header.unpack(frame)
+            data = response.read(size)
+            if channel == 'x':
+                return int(data)
+            elif channel == 'l':
+                return None
+            outputs[channel].write(data)
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    '''Run a treestore command on the server, if one is listening, and
+    otherwise in this process.'''
+
+    if argv is None: argv = sys.argv[1:]
+
+    try:
+        if not '--local' in argv:
+            status = call(argv)
+            if status is not None:
+                sys.stdout.flush()
+                sys.exit(status)
+
+        import treestore
+        treestore.main(argv)
+    except IOError as e:
+        # stdout was closed, e.g. by `head`
+        if e.errno == errno.EPIPE: sys.exit(1)
+        raise
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+'''In-place edits of stored trees: grafting and pruning clades, relabeling
+taxa and setting branch lengths, without removing and re-adding the tree.
+
+Each edit changes only the nodes it touches, plus the interval index
+entries of the nodes that move, in one transaction. The taxon index and
+any cached copy of the tree are updated from the edit rather than rebuilt,
+and the tree's content hashes are dropped, since it no longer matches the
+file it was added from.'''
+
+import re
+import newick
+from pruner import node_intervals
+from compact import add_lengths
+from templates import QueryTemplate
+from lazy import lazy_import
+
+rdflib = lazy_import('rdflib')
+
+
+class Editable:
+    # number of statements sent in each query when inserting grafted nodes
+    insert_size = 1000
+    # named queries (see templates.py)
+    query_templates = {}
+
+    def graft_trees(self, tree_uri, taxa, tree_file, format='newick'):
+        '''Graft the trees in a file into a stored tree, as the last
+        children of the most recent common ancestor of `taxa`.
+
+        Example:
+        >>> treestore.graft_trees('test', ['Homo sapiens', 'Pan paniscus'], 'hominini.newick')
+        '''
+
+        tree_uri = self.uri_from_id(tree_uri)
+        rows = newick.parse_rows(tree_file, format)
+        if not rows: raise Exception('No trees were found in %s.' % tree_file)
+        node_id, (pre, post, depth) = self.find_edit_node(tree_uri, taxa)
+        old_version, tree = self.edit_start(tree_uri)
+
+        # the new nodes follow the node's descendants in preorder, and
+        # precede the node itself in postorder
+        start = post + depth + 1
+        local_post, local_depth = node_intervals([row[1] for row in rows])
+        intervals = [(start + index, post + local_post[index], depth + 1 + local_depth[index])
+                     for index, parent, label, length, synonyms in rows]
+
+        with self.transaction():
+            self.shift_intervals(tree_uri, 'pre', start, len(rows))
+            self.shift_intervals(tree_uri, 'post', post, len(rows))
+            ids = self.insert_clade(tree_uri, node_id, rows, intervals)
+            version = self.edited(tree_uri, old_version,
+                                  added=[row[2] for row in rows if row[2]])
+
+        if tree is not None:
+            i = tree.index_of(node_id)
+            stop = tree.ends[i] + 1
+            tree = tree.splice(stop, stop, ids,
+                               [i if parent is None else stop + parent
+                                for index, parent, label, length, synonyms in rows],
+                               [row[3] for row in rows], [row[2] for row in rows])
+            self.cache.put(tree_uri, version, tree, tree.nbytes())
+
+
+    def prune_clade(self, tree_uri, taxa):
+        '''Remove the most recent common ancestor of `taxa`, and all of its
+        descendants, from a stored tree. If that leaves its parent with a 
+        single child, the parent is collapsed into it, adding their branch
+        lengths together, unless it's the root.
+
+        Example:
+        >>> treestore.prune_clade('test', ['Homo sapiens', 'Pan paniscus'])
+        '''
+
+        tree_uri = self.uri_from_id(tree_uri)
+        node_id, (pre, post, depth) = self.find_edit_node(tree_uri, taxa)
+        if depth == 0: raise Exception("The root of a tree can't be pruned; remove the tree instead.")
+        parent = self.get_common_ancestor(tree_uri, pre - 1, post + 1)
+        siblings = [child for child in self.get_children(tree_uri, parent) if child != node_id]
+        if depth > 1 and len(siblings) == 1:
+            parent_pre, parent_post, parent_depth = self.get_intervals(tree_uri, [parent])[parent]
+            grandparent = self.get_common_ancestor(tree_uri, parent_pre - 1, parent_post + 1)
+        else:
+            parent = None
+        old_version, tree = self.edit_start(tree_uri)
+
+        end = post + depth
+        size = end - pre + 1
+        with self.transaction():
+            labels = self.delete_clade(tree_uri, node_id, pre, end)
+            self.shift_intervals(tree_uri, 'pre', end + 1, -size)
+            self.shift_intervals(tree_uri, 'post', post + 1, -size)
+            if parent is not None:
+                labels += self.collapse_node(tree_uri, parent, (parent_pre, parent_post - size, parent_depth),
+                                             siblings[0], grandparent)
+            version = self.edited(tree_uri, old_version, removed=labels)
+
+        if tree is not None:
+            i = tree.index_of(node_id)
+            tree = tree.splice(i, tree.ends[i] + 1)
+            if parent is not None: tree = tree.collapse(tree.index_of(parent))
+            self.cache.put(tree_uri, version, tree, tree.nbytes())
+
+
+    def collapse_node(self, tree_uri, node_id, interval, child, parent):
+        '''Remove a node with a single child, in an edit's transaction, 
+        making the child a child of `parent` (the node's parent) with the 
+        sum of their branch lengths. `interval` is the node's interval 
+        index entry. Returns the node's labels.'''
+
+        pre, post, depth = interval
+        lengths = self.get_lengths(tree_uri, [node_id, child])
+        self.move_node(tree_uri, child, parent)
+        labels = self.delete_clade(tree_uri, node_id, pre, pre)
+        length = add_lengths(lengths.get(node_id), lengths.get(child))
+        if length is not None: self.set_length(tree_uri, child, length)
+
+        # the node's descendants move up a level, and the nodes after it
+        # move back one place in preorder and postorder
+        self.shift_depths(tree_uri, pre + 1, post + depth, -1)
+        self.shift_intervals(tree_uri, 'pre', pre + 1, -1)
+        self.shift_intervals(tree_uri, 'post', post + 1, -1)
+        return labels
+
+
+    def relabel_taxa(self, tree_uri, labels):
+        '''Rename taxa in a stored tree, given a dictionary mapping their
+        current labels to new ones.
+
+        Example:
+        >>> treestore.relabel_taxa('test', {'Pan paniscus': 'Pan troglodytes'})
+        '''
+
+        tree_uri = self.uri_from_id(tree_uri)
+        labels = dict(labels)
+        if not labels: return
+
+        nodes = [(node_id, label) for label, node_id, pre, post, depth
+                 in self.query_labels(tree_uri, labels)]
+        missing = set(labels) - set(label for node_id, label in nodes)
+        if missing:
+            raise Exception('Taxa not found in %s: %s' % (tree_uri, ', '.join(sorted(missing))))
+        old_version, tree = self.edit_start(tree_uri)
+
+        with self.transaction():
+            self.set_labels(tree_uri, [(node_id, label, labels[label]) for node_id, label in nodes])
+            version = self.edited(tree_uri, old_version,
+                                  added=labels.values(), removed=labels.keys())
+
+        if tree is not None:
+            tree = tree.changed(labels={tree.index_of(node_id): labels[label]
+                                        for node_id, label in nodes})
+            self.cache.put(tree_uri, version, tree, tree.nbytes())
+
+
+    def set_branch_length(self, tree_uri, taxa, length):
+        '''Set the length of the branch leading to the most recent common
+        ancestor of `taxa` in a stored tree.
+
+        Example:
+        >>> treestore.set_branch_length('test', ['Homo sapiens'], 6.5)
+        '''
+
+        tree_uri = self.uri_from_id(tree_uri)
+        node_id, (pre, post, depth) = self.find_edit_node(tree_uri, taxa)
+        if depth == 0: raise Exception("The root of a tree doesn't have a branch.")
+        length = float(length)
+        old_version, tree = self.edit_start(tree_uri)
+
+        with self.transaction():
+            self.set_length(tree_uri, node_id, length)
+            version = self.edited(tree_uri, old_version)
+
+        if tree is not None:
+            tree = tree.changed(lengths={tree.index_of(node_id): length})
+            self.cache.put(tree_uri, version, tree, tree.nbytes())
+
+
+    def find_edit_node(self, tree_uri, taxa):
+        '''Find the most recent common ancestor of a list of taxa, which
+        must all be in the tree. Returns its node id and its (preorder,
+        postorder, depth) interval index entry.'''
+
+        if isinstance(taxa, basestring): taxa = [taxa]
+        if not taxa: raise Exception('A list of taxa is required.')
+        resolved, unresolved = self.resolve_taxa(tree_uri, list(taxa))
+        if unresolved:
+            raise Exception('Taxa not found in %s: %s' % (tree_uri, ', '.join(sorted(unresolved))))
+
+        matches = dict((node_id, interval) for node_id, label, interval in resolved.itervalues())
+        if not all(matches.values()):
+            raise Exception('%s has no interval index; remove and re-add it to edit it.' % tree_uri)
+        if len(matches) == 1: return matches.items()[0]
+
+        node_id = self.get_common_ancestor(tree_uri, min(pre for pre, post, depth in matches.values()),
+                                           max(post for pre, post, depth in matches.values()))
+        if node_id is None: raise Exception("These taxa aren't all in the same tree.")
+        return node_id, self.get_intervals(tree_uri, [node_id])[node_id]
+
+
+    def edit_start(self, tree_uri):
+        '''Return the current version of a tree about to be edited, and its
+        cached CompactTree, if there is one, to be edited to match.'''
+
+        version = self.get_version(tree_uri)
+        if not self.cache.enabled: return version, None
+        return version, self.cache.peek(tree_uri, version)
+
+
+    def edited(self, tree_uri, old_version, added=(), removed=()):
+        '''Finish an edit, in its transaction: drop the tree's content
+        hashes and give it a new version, updating the taxon index with the
+        labels the edit added and removed. Returns the new version.'''
+
+        removed = set(removed)
+        if removed:
+            # a label removed from some nodes may still be on others
+            removed -= set(row[0] for row in self.query_labels(tree_uri, removed))
+        self.clear_content_hashes(tree_uri)
+        version = self.set_version(tree_uri, (old_version, set(added), removed))
+        self.taxon_index.save()
+        return version
+
+
+    query_templates['shift_intervals'] = '''
+DELETE { GRAPH <%(graph)s> { ?n ts:%(key!)s ?old } }
+INSERT { GRAPH <%(graph)s> { ?n ts:%(key!)s ?new } }
+WHERE {
+    GRAPH <%(graph)s> { ?n ts:%(key!)s ?old }
+    FILTER (?old >= %(start)s)
+    BIND ((?old + %(offset)s) AS ?new)
+}'''
+
+    def shift_intervals(self, tree_uri, key, start, offset):
+        '''Add `offset` to the `key` ('pre' or 'post') interval index entry
+        of every node of a tree where it's at least `start`.'''
+
+        self.run_query('shift_intervals', graph=tree_uri, key=key, start=start, offset=offset)
+
+
+    query_templates['shift_depths'] = '''
+DELETE { GRAPH <%(graph)s> { ?n ts:depth ?old } }
+INSERT { GRAPH <%(graph)s> { ?n ts:depth ?new } }
+WHERE {
+    GRAPH <%(graph)s> { ?n ts:pre ?pre ; ts:depth ?old }
+    FILTER (?pre >= %(pre)s && ?pre <= %(end)s)
+    BIND ((?old + %(offset)s) AS ?new)
+}'''
+
+    def shift_depths(self, tree_uri, pre, end, offset):
+        '''Add `offset` to the depth of the nodes of a tree with preorder
+        index from `pre` to `end`.'''
+
+        self.run_query('shift_depths', graph=tree_uri, pre=pre, end=end, offset=offset)
+
+
+    query_templates['children'] = '''
+SELECT ?n
+WHERE { GRAPH <%(graph)s> { ?n obo:CDAO_0000179 <%(node)s> } }'''
+
+    def get_children(self, tree_uri, node_id):
+        '''Return the ids of the children of a node.'''
+
+        return [row[0] for row in self.run_query('children', graph=tree_uri, node=node_id).fetchall()]
+
+
+    query_templates['lengths'] = '''
+SELECT ?n ?length
+WHERE {
+    GRAPH <%(graph)s> { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] }
+    FILTER (?n IN (iri(%(nodes*)s)))
+}'''
+
+    def get_lengths(self, tree_uri, node_ids):
+        '''Return a dictionary of the branch lengths of the given nodes;
+        nodes without one are missing from it.'''
+
+        return {node_id: float(length) for node_id, length
+                in self.run_query('lengths', graph=tree_uri, nodes=set(node_ids)).fetchall()}
+
+
+    query_templates['move_node'] = '''
+DELETE { GRAPH <%(graph)s> { ?edge obo:CDAO_0000201 ?old . <%(node)s> obo:CDAO_0000179 ?old . ?old obo:CDAO_0000177 ?edge } }
+INSERT { GRAPH <%(graph)s> { ?edge obo:CDAO_0000201 <%(parent)s> . <%(node)s> obo:CDAO_0000179 <%(parent)s> . <%(parent)s> obo:CDAO_0000177 ?edge } }
+WHERE { GRAPH <%(graph)s> { <%(node)s> obo:CDAO_0000143 ?edge ; obo:CDAO_0000179 ?old } }'''
+
+    def move_node(self, tree_uri, node_id, parent):
+        '''Make a node, with its edge, a child of another node.'''
+
+        self.run_query('move_node', graph=tree_uri, node=node_id, parent=parent)
+
+
+    query_templates['last_node'] = '''
+SELECT ?n
+WHERE { GRAPH <%(graph)s> { ?n ts:pre ?pre } }
+ORDER BY DESC(STR(?n))
+LIMIT 1'''
+    # the parent may have been a terminal node
+    query_templates['make_internal'] = '''
+DELETE { GRAPH <%(graph)s> { <%(node)s> a obo:CDAO_0000108 } }
+INSERT { GRAPH <%(graph)s> { <%(node)s> a obo:CDAO_0000026 } }
+WHERE { GRAPH <%(graph)s> { <%(node)s> a obo:CDAO_0000108 } }'''
+    # node names are relative to the graph, as in its CDAO file; each block
+    # of statements is different, so they aren't kept prepared
+    query_templates['insert_statements'] = QueryTemplate('''
+BASE <%(base!)s>
+INSERT INTO GRAPH iri(%(graph)s) {
+%(statements!)s
+}''', prepare=False)
+
+    def insert_clade(self, tree_uri, parent, rows, intervals):
+        '''Add the nodes of parsed trees (see `newick.parse_rows`) to a
+        tree as descendants of `parent`, with the given interval index
+        entries. Returns the new node ids, in the order of the rows.'''
+
+        # new nodes are numbered after the highest numbered node
+        last = re.search(r'(\d+)$', str(self.run_query('last_node', graph=tree_uri).fetchone()[0]))
+        first = int(last.group(1)) + 1 if last else 1
+
+        self.run_query('make_internal', graph=tree_uri, node=parent)
+        parent = rdflib.URIRef(parent).n3()
+        internal = set(row[1] for row in rows)
+        uri = lambda name, index: '<%s%s>' % (name, str(first + index).zfill(8))
+        statements = []
+        for (index, parent_index, label, length, synonyms), (pre, post, depth) in zip(rows, intervals):
+            node = uri('node', index)
+            p = parent if parent_index is None else uri('node', parent_index)
+            edge = uri('edge', index)
+            statements.append('%s a obo:CDAO_0000139 ; obo:CDAO_0000200 <> ; obo:CDAO_0000201 %s ; obo:CDAO_0000209 %s .'
+                              % (edge, p, node))
+            statements.append('%s obo:CDAO_0000143 %s ; obo:CDAO_0000179 %s .' % (node, edge, p))
+            statements.append('%s obo:CDAO_0000177 %s .' % (p, edge))
+            if length is not None:
+                annotation = uri('edge_annotation', index)
+                statements.append('%s a obo:CDAO_0000046 ; obo:CDAO_0000215 %s .'
+                                  % (annotation, newick.decimal(length)))
+                statements.append('%s obo:CDAO_0000193 %s .' % (edge, annotation))
+            if label or synonyms:
+                tu = uri('tu', index)
+                statements.append('%s a obo:CDAO_0000138 .' % tu)
+                if label: statements.append('%s rdfs:label %s .' % (tu, rdflib.Literal(label).n3()))
+                for synonym in synonyms:
+                    statements.append('%s skos:altLabel %s .' % (tu, rdflib.Literal(synonym).n3()))
+                statements.append('%s obo:CDAO_0000187 %s .' % (node, tu))
+            statements.append('%s a %s ; obo:CDAO_0000200 <> ; ts:pre %s ; ts:post %s ; ts:depth %s .'
+                              % (node, 'obo:CDAO_0000026' if index in internal else 'obo:CDAO_0000108',
+                                 pre, post, depth))
+
+        for i in xrange(0, len(statements), self.insert_size):
+            self.run_query('insert_statements', base=tree_uri, graph=tree_uri,
+                           statements='\n'.join(statements[i:i + self.insert_size]))
+
+        return ['%snode%s' % (tree_uri, str(first + row[0]).zfill(8)) for row in rows]
+
+
+    in_clade = '?n ts:pre ?pre . FILTER (?pre >= %(pre)s && ?pre <= %(end)s)'
+    query_templates['clade_labels'] = '''
+SELECT DISTINCT ?label
+WHERE { GRAPH <%(graph)s> { ''' + in_clade + ''' ?n obo:CDAO_0000187 [ rdfs:label ?label ] } }'''
+    # the parent of the clade may become a terminal node
+    query_templates['make_terminal'] = '''
+DELETE { GRAPH <%(graph)s> { ?parent a obo:CDAO_0000026 } }
+INSERT { GRAPH <%(graph)s> { ?parent a obo:CDAO_0000108 } }
+WHERE {
+    GRAPH <%(graph)s> {
+        <%(node)s> obo:CDAO_0000179 ?parent .
+        FILTER NOT EXISTS { ?sibling obo:CDAO_0000179 ?parent . FILTER (?sibling != iri(%(node)s)) }
+    }
+}'''
+    query_templates['delete_clade'] = '''
+DELETE { GRAPH <%(graph)s> { ?s ?p ?o } }
+WHERE {
+    GRAPH <%(graph)s> {
+        ''' + in_clade + '''
+        { ?n ?p ?o . BIND (?n AS ?s) }
+        UNION { ?s ?p ?n . BIND (?n AS ?o) }
+        UNION { ?n obo:CDAO_0000143 ?s . ?s ?p ?o }
+        UNION { ?n obo:CDAO_0000143 ?edge . ?s ?p ?edge . BIND (?edge AS ?o) }
+        UNION { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 ?s ] . ?s ?p ?o }
+        UNION { ?n obo:CDAO_0000187 ?s . ?s ?p ?o }
+    }
+}'''
+    del in_clade
+
+    def delete_clade(self, tree_uri, node_id, pre, end):
+        '''Delete the nodes of a tree with preorder index from `pre` to
+        `end` (the subtree of `node_id`) along with their edges and TUs.
+        Returns the labels of the deleted nodes.'''
+
+        labels = [row[0] for row in self.run_query('clade_labels', graph=tree_uri, 
+                                                   pre=pre, end=end).fetchall()]
+        self.run_query('make_terminal', graph=tree_uri, node=node_id)
+        self.run_query('delete_clade', graph=tree_uri, pre=pre, end=end)
+
+        return labels
+
+
+    query_templates['relabel'] = '''
+DELETE { GRAPH <%(graph)s> { ?tu rdfs:label ?label } }
+INSERT { GRAPH <%(graph)s> { ?tu rdfs:label %(new_label)s } }
+WHERE {
+    GRAPH <%(graph)s> {
+        ?n obo:CDAO_0000187 ?tu .
+        ?tu rdfs:label ?label .
+        FILTER (?n in (iri(%(nodes*)s)) && ?label = %(label)s)
+    }
+}'''
+
+    def set_labels(self, tree_uri, changes):
+        '''Relabel nodes of a tree, given a list of (node id, current label,
+        new label) tuples.'''
+
+        # nodes are matched by id as well as label, so labels can be swapped
+        nodes = {}
+        for node_id, label, new_label in changes:
+            nodes.setdefault((label, new_label), []).append(node_id)
+        for (label, new_label), node_ids in nodes.iteritems():
+            self.run_query('relabel', graph=tree_uri, new_label=new_label, nodes=node_ids,
+                           label=label)
+
+
+    # edges without a length are given a new edge annotation
+    query_templates['set_length'] = '''
+DELETE { GRAPH <%(graph)s> { ?annotation obo:CDAO_0000215 ?length } }
+INSERT { GRAPH <%(graph)s> { ?annotation obo:CDAO_0000215 ?value } }
+WHERE {
+    GRAPH <%(graph)s> { 
+        <%(node)s> obo:CDAO_0000143 [ obo:CDAO_0000193 ?annotation ] . 
+        ?annotation obo:CDAO_0000215 ?length 
+    }
+    BIND (STRDT(%(length)s, <''' + newick.xsd_decimal + '''>) AS ?value)
+}'''
+    query_templates['add_length'] = '''
+INSERT { GRAPH <%(graph)s> { ?edge obo:CDAO_0000193 [ a obo:CDAO_0000046 ; obo:CDAO_0000215 ?value ] } }
+WHERE {
+    GRAPH <%(graph)s> { 
+        <%(node)s> obo:CDAO_0000143 ?edge . 
+        FILTER NOT EXISTS { ?edge obo:CDAO_0000193 [] } 
+    }
+    BIND (STRDT(%(length)s, <''' + newick.xsd_decimal + '''>) AS ?value)
+}'''
+
+    def set_length(self, tree_uri, node_id, length):
+        '''Set the length of the branch leading to a node.'''
+
+        value = newick.decimal_text(length)
+        for name in ('set_length', 'add_length'):
+            self.run_query(name, graph=tree_uri, node=node_id, length=value)
+
+
+    query_templates['clear_content_hashes'] = '''
+DELETE FROM GRAPH iri(%(graph)s) { <%(graph)s> ts:contentHash ?hash }
+WHERE { GRAPH <%(graph)s> { <%(graph)s> ts:contentHash ?hash } }'''
+
+    def clear_content_hashes(self, tree_uri):
+        '''Drop the content hashes recorded for a graph.'''
+
+        self.run_query('clear_content_hashes', graph=tree_uri)
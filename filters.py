@@ -0,0 +1,178 @@
+'''Tree filters written in CQL (see cql.py), compiled into plans that are
+answered from the taxon index rather than by queries over every graph. A
+filter is made of these indexes, combined with and, or, not (meaning "and
+not") and parentheses:
+
+    taxon = "Homo sapiens"      trees containing a taxon; a search term on
+                                its own ("Homo sapiens") means the same
+    tips > 100                  trees with more tips (or =, <>, <, <=, >=)
+    citation = "http://dx.doi.org/10.1000/182"
+                                trees that cite a work
+    tree = "bird*"              trees whose id or URI matches a pattern
+
+`=` and `==` are the same, and `<>` matches the trees that don't. Compiled
+filters are cached by their normalized text.'''
+
+import fnmatch
+import operator
+import re
+import threading
+from lazy import lazy_import
+
+# pyparsing is only imported when a filter is compiled
+cql = lazy_import('cql')
+
+
+comparisons = {
+               '=': operator.eq,
+               '==': operator.eq,
+               '<>': operator.ne,
+               '<': operator.lt,
+               '<=': operator.le,
+               '>': operator.gt,
+               '>=': operator.ge,
+               }
+
+# indexes that are answered from each tree's tip count and citations,
+# rather than from its labels
+info_indexes = ('tips', 'citation')
+
+# spans of a filter between whitespace, keeping quoted strings whole
+spans = re.compile(r'(?:"(?:\\.|[^"\\])*"|[^\s"]|")+')
+
+plan_cache = {}
+plan_cache_size = 256
+plan_cache_lock = threading.Lock()
+
+
+class Filter(object):
+    '''A compiled filter. Its plan is a tree of tuples: ('and' | 'or' |
+    'not', left, right), ('all',) for every tree, or an index and its
+    parameters: ('taxon', label), ('tips', comparison, count),
+    ('citation', uri) or ('tree', pattern).'''
+
+    def __init__(self, text, plan):
+        self.text = text
+        self.plan = plan
+        self.needs_info = uses_info(plan)
+        # (index, generation) -> the trees selected from that version of it
+        self._selected = (None, None)
+
+    def select(self, index, tree_id=None):
+        '''Return the set of numbers of the trees in a TaxonIndex that match
+        the filter. `tree_id` gives the id of a tree URI, for patterns. The
+        result is kept until the index changes.'''
+
+        key = (id(index), index.generation)
+        selected_key, selected = self._selected
+        if selected_key == key: return selected
+
+        selected = evaluate(self.plan, index, tree_id or (lambda uri: uri))
+        self._selected = (key, selected)
+        return selected
+
+    def __repr__(self):
+        return '<Filter %r>' % self.text
+
+
+def compile_filter(text):
+    '''Compile a CQL filter into a Filter, or return the one already
+    compiled from the same normalized text.'''
+
+    text = ' '.join(spans.findall(text))
+    with plan_cache_lock:
+        compiled = plan_cache.get(text)
+    if compiled is not None: return compiled
+
+    try:
+        query = cql.parse(text)
+    except cql.ParseBaseException as e:
+        raise Exception('Invalid filter: %s' % e)
+    if query.prefixes: raise Exception('Prefixes are not supported in filters.')
+    if query.sortspec: raise Exception('Sorting is not supported in filters.')
+    compiled = Filter(text, compile_clause(query.clause))
+
+    with plan_cache_lock:
+        if len(plan_cache) >= plan_cache_size: plan_cache.clear()
+        plan_cache[text] = compiled
+    return compiled
+
+
+def compile_clause(clause):
+    '''Compile a clause parsed by cql.py into a plan.'''
+
+    if isinstance(clause, cql.Term):
+        # a search term without an index is a taxon
+        return ('taxon', unquote(clause.term))
+
+    left, relation, right = clause
+    relation = str(relation).lower()
+    if relation in ('and', 'or', 'not'):
+        return (relation, compile_clause(left), compile_clause(right))
+    if relation == 'prox':
+        raise Exception('prox is not supported in filters.')
+
+    index = unquote(left.term).lower()
+    if index == 'cql.serverchoice': index = 'taxon'
+    value = unquote(right.term)
+
+    if index == 'tips':
+        if not relation in comparisons:
+            raise Exception('Unsupported relation for tips: %s' % relation)
+        try:
+            return ('tips', relation, int(value))
+        except ValueError:
+            raise Exception('The number of tips must be an integer, not %s.' % value)
+
+    if not index in ('taxon', 'citation', 'tree'):
+        raise Exception('Unknown filter index: %s' % index)
+    if relation in ('=', '=='):
+        return (index, value)
+    elif relation == '<>':
+        return ('not', ('all',), (index, value))
+    raise Exception('Unsupported relation for %s: %s' % (index, relation))
+
+
+def unquote(term):
+    '''Return the value of a CQL term, without the quotes of a quoted
+    string; backslashes are kept, except those escaping a quote.'''
+
+    if len(term) > 1 and term.startswith('"') and term.endswith('"'):
+        term = term[1:-1].replace('\\"', '"')
+    return term
+
+
+def uses_info(plan):
+    if plan[0] in ('and', 'or', 'not'):
+        return uses_info(plan[1]) or uses_info(plan[2])
+    return plan[0] in info_indexes
+
+
+def evaluate(plan, index, tree_id):
+    '''Return the set of numbers of the trees in a TaxonIndex matching a
+    plan. Tip counts and citations are read from the index's `info`, which
+    has to be up to date for plans that use them.'''
+
+    kind = plan[0]
+    if kind == 'and':
+        return evaluate(plan[1], index, tree_id) & evaluate(plan[2], index, tree_id)
+    elif kind == 'or':
+        return evaluate(plan[1], index, tree_id) | evaluate(plan[2], index, tree_id)
+    elif kind == 'not':
+        return evaluate(plan[1], index, tree_id) - evaluate(plan[2], index, tree_id)
+    elif kind == 'all':
+        return set(index.uris)
+    elif kind == 'taxon':
+        return set(index.postings.get(plan[1], ()))
+    elif kind == 'tips':
+        compare, count = comparisons[plan[1]], plan[2]
+        return set(number for number, info in index.info.iteritems()
+                   if compare(info['tips'], count))
+    elif kind == 'citation':
+        return set(number for number, info in index.info.iteritems()
+                   if plan[1] in info['citations'])
+    elif kind == 'tree':
+        pattern = plan[1]
+        return set(number for number, uri in index.uris.iteritems()
+                   if fnmatch.fnmatchcase(tree_id(uri), pattern)
+                   or fnmatch.fnmatchcase(uri, pattern))
@@ -0,0 +1,208 @@
+import re
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+
+# query text before the first keyword: the "sparql" marker and PREFIX lines
+query_preamble = re.compile(r'^\s*(sparql\b)?\s*(PREFIX\s+\w*:\s*<[^>]*>\s*)*', re.IGNORECASE)
+
+
+# methods that run queries on behalf of their caller (see templates.py)
+query_helpers = ('execute', 'executemany', 'run', 'run_query', 'run_query_many')
+
+
+def query_kind(query):
+    '''Return the kind of a query: its first keyword (e.g. "select"), or the
+    name of the procedure it calls.'''
+
+    match = re.match(r'[A-Za-z_.]+', query[query_preamble.match(query).end():])
+    return match.group().lower() if match else 'other'
+
+
+class QueryStats:
+    '''Statistics on the queries run by a treestore and the time spent in
+    Python-side phases (reconstructing, pruning and serializing trees).
+    Queries are counted by the operation (treestore method) that ran them
+    and their kind, with their total latency and number of rows fetched;
+    latency includes the time taken to fetch rows. Nothing is recorded
+    unless `enabled` is set.'''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (operation, kind) -> [queries, seconds, rows]
+            self.queries = {}
+            # phase -> [count, seconds]
+            self.phases = {}
+
+    def query_entry(self, operation, kind):
+        '''Return the counters for queries of a kind run by an operation,
+        as a mutable list of [queries, seconds, rows].'''
+
+        key = (operation, kind)
+        with self._lock:
+            entry = self.queries.get(key)
+            if entry is None: entry = self.queries[key] = [0, 0.0, 0]
+        return entry
+
+    @contextmanager
+    def phase(self, name):
+        '''Time a Python-side phase of an operation.'''
+
+        if not self.enabled:
+            yield
+            return
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                entry = self.phases.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def summary(self):
+        '''Return the statistics as a dictionary.'''
+
+        with self._lock:
+            queries = [{'operation': operation, 'kind': kind, 'queries': n,
+                        'time': seconds, 'rows': rows}
+                       for (operation, kind), (n, seconds, rows) in self.queries.iteritems()]
+            phases = [{'phase': name, 'count': n, 'time': seconds}
+                      for name, (n, seconds) in self.phases.iteritems()]
+        queries.sort(key=lambda x: -x['time'])
+        phases.sort(key=lambda x: -x['time'])
+        return {
+                'queries': queries,
+                'phases': phases,
+                'total_queries': sum(x['queries'] for x in queries),
+                'query_time': sum(x['time'] for x in queries),
+                'rows': sum(x['rows'] for x in queries),
+                }
+
+    def report(self, handle=sys.stderr):
+        '''Write a breakdown of the statistics to a file handle.'''
+
+        summary = self.summary()
+        handle.write('%-28s %-14s %8s %10s %10s\n' % ('operation', 'query', 'count', 'time (s)', 'rows'))
+        for x in summary['queries']:
+            handle.write('%-28s %-14s %8s %10.4f %10s\n' % (x['operation'], x['kind'], x['queries'],
+                                                            x['time'], x['rows']))
+        handle.write('%-28s %-14s %8s %10.4f %10s\n' % ('total', '', summary['total_queries'],
+                                                        summary['query_time'], summary['rows']))
+        if summary['phases']:
+            handle.write('\n%-43s %8s %10s\n' % ('phase', 'count', 'time (s)'))
+            for x in summary['phases']:
+                handle.write('%-43s %8s %10.4f\n' % (x['phase'], x['count'], x['time']))
+
+
+class InstrumentedCursor(object):
+    '''Wraps a database cursor, recording each query in a QueryStats.'''
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._entry = None
+
+    def _record(self, method, args, kwargs):
+        if not self._stats.enabled:
+            self._entry = None
+            return method(*args, **kwargs)
+
+        # the operation is the method that called execute, skipping helper
+        # methods that run queries for it
+        frame = sys._getframe(2)
+        while frame.f_back and frame.f_code.co_name in query_helpers:
+            frame = frame.f_back
+        operation = frame.f_code.co_name
+        self._entry = entry = self._stats.query_entry(operation, query_kind(args[0]))
+        start_time = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            entry[0] += 1
+            entry[1] += time.time() - start_time
+
+    def execute(self, *args, **kwargs):
+        self._record(self._cursor.execute, args, kwargs)
+        return self
+
+    def executemany(self, *args, **kwargs):
+        self._record(self._cursor.executemany, args, kwargs)
+        return self
+
+    def _fetch(self, method, *args):
+        entry = self._entry
+        if entry is None: return method(*args)
+        start_time = time.time()
+        rows = method(*args)
+        entry[1] += time.time() - start_time
+        if rows is not None: entry[2] += len(rows) if isinstance(rows, list) else 1
+        return rows
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        if self._entry is None: return iter(self._cursor)
+        return self._iterate(self._entry)
+
+    def _iterate(self, entry):
+        rows = iter(self._cursor)
+        while True:
+            start_time = time.time()
+            try:
+                row = rows.next()
+            except StopIteration:
+                return
+            finally:
+                entry[1] += time.time() - start_time
+            entry[2] += 1
+            yield row
+
+    def next(self):
+        if self._entry is None: return self._cursor.next()
+        row = self.fetchone()
+        if row is None: raise StopIteration()
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection(object):
+    '''Wraps a database connection, so its cursors record their queries.'''
+
+    def __init__(self, connection, stats):
+        self._connection = connection
+        self._stats = stats
+
+    def cursor(self):
+        return InstrumentedCursor(self._connection.cursor(), self._stats)
+
+    def __enter__(self):
+        return self._connection.__enter__()
+
+    def __exit__(self, *args):
+        return self._connection.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        # settings like autocommit belong to the wrapped connection
+        if name.startswith('_'): object.__setattr__(self, name, value)
+        else: setattr(self._connection, name, value)
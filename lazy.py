@@ -0,0 +1,30 @@
+import sys
+
+
+class LazyModule(object):
+    '''Stands in for a module that isn't imported until one of its
+    attributes is used, so heavy dependencies are only loaded by the
+    commands that need them.'''
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            __import__(self._name)
+            module = self.__dict__['_module'] = sys.modules[self._name]
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
+
+
+def lazy_import(name):
+    '''Return a stand-in for the module `name`, imported on first use.'''
+
+    return LazyModule(name)
@@ -0,0 +1,337 @@
+'''Streaming Newick parsing, and conversion of Newick files straight to CDAO
+turtle without building Biopython trees or an RDF graph in memory. Only the
+nodes on the path from the root to the current node are kept while parsing.
+Also parses tree files of any format into rows of nodes (`parse_rows`).'''
+
+import re
+from pruner import ts
+from lazy import lazy_import
+
+bp = lazy_import('Bio.Phylo')
+rdflib = lazy_import('rdflib')
+
+
+# the same tokens as Biopython's Newick parser
+tokenizer = re.compile('|'.join([
+    r"\(",
+    r"\)",
+    r"[^\s\(\)\[\]\'\:\;\,]+",
+    r"\:\ ?[+-]?[0-9]*\.?[0-9]+([eE][+-]?[0-9]+)?",
+    r"\,",
+    r"\[(\\.|[^\]])*\]",
+    r"\'(\\.|[^\'])*\'",
+    r"\;",
+    r"\n",
+    ]))
+
+# characters that end an unquoted label or a branch length
+delimiters = set("()[]':;, \t\r\n")
+
+obo = 'http://purl.obolibrary.org/obo/'
+rdfs = 'http://www.w3.org/2000/01/rdf-schema#'
+skos = 'http://www.w3.org/2004/02/skos/core#'
+xsd_decimal = 'http://www.w3.org/2001/XMLSchema#decimal'
+
+
+class UnenclosedTree(Exception):
+    '''Raised for trees whose top level isn't enclosed in parentheses (e.g.
+    "A,B;"); the root of these trees is only known after its first child
+    has been read, so they can't be streamed.'''
+
+
+def newick_error(message):
+    '''Return Biopython's exception for malformed Newick, which is only
+    imported when there's an error to raise.'''
+
+    from Bio.Phylo.NewickIO import NewickError
+    return NewickError(message)
+
+
+def tokens(handle, chunk_size=65536):
+    '''Iterate over the Newick tokens in a file, reading `chunk_size` bytes
+    at a time. As in Biopython, trailing whitespace (including the newline)
+    is removed from each line.'''
+
+    buffer = ''
+    while True:
+        chunk = handle.readline(chunk_size)
+        eof = not chunk
+        if chunk.endswith('\n'): chunk = chunk.rstrip()
+        buffer += chunk
+
+        pos = 0
+        for match in tokenizer.finditer(buffer):
+            token = match.group()
+            if not eof:
+                # a label or branch length is only complete once it's followed
+                # by a delimiter, which may be in the next chunk; a skipped
+                # quote or bracket may start a quoted label or comment
+                if not token[0] in "(),;'[":
+                    if match.end() == len(buffer) or not buffer[match.end()] in delimiters:
+                        break
+                gap = buffer[pos:match.start()]
+                if "'" in gap or '[' in gap: break
+            pos = match.end()
+            yield token
+
+        buffer = buffer[pos:]
+        if eof: break
+
+
+def parse_confidence(text):
+    try:
+        return int(text) if text.isdigit() else float(text)
+    except ValueError:
+        return None
+
+
+def parse_nodes(handle):
+    '''Parse the trees in a Newick file in one streaming pass. Each node is
+    yielded once all of its descendants have been read (in postorder) as a
+    tuple of (preorder index, parent preorder index, label, branch length,
+    support, postorder index, depth, terminal). The parent index is None for
+    roots, and nodes of all trees in the file are numbered together, as with
+    `node_intervals`.
+
+    Like Biopython, numeric labels of internal nodes are read as support
+    values rather than labels.'''
+
+    # open nodes from the root down, as lists of [preorder index, label,
+    # branch length, has children]
+    stack = []
+    count = 0
+
+    for token in tokens(handle):
+        if token == ';':
+            if not stack: continue
+            if len(stack) > 1:
+                raise newick_error('Number of open/close parentheses do not match.')
+            yield close_node(stack, count)
+            continue
+        elif token == '\n' or token.startswith('['):
+            # comments aren't stored
+            continue
+
+        if not stack:
+            stack.append([count, None, None, False])
+            count += 1
+        node = stack[-1]
+
+        if token == '(':
+            # start a new clade, which is a child of the current clade
+            node[3] = True
+            stack.append([count, None, None, False])
+            count += 1
+        elif token == ',':
+            if len(stack) == 1: raise UnenclosedTree()
+            # start a new clade at the same level as the current clade
+            yield close_node(stack, count)
+            stack.append([count, None, None, False])
+            count += 1
+        elif token == ')':
+            if len(stack) == 1: raise newick_error('Parenthesis mismatch.')
+            yield close_node(stack, count)
+        elif token.startswith("'"):
+            node[1] = token[1:-1]
+        elif token.startswith(':'):
+            node[2] = float(token[1:])
+        else:
+            node[1] = token
+
+    # the last tree is missing a terminal ';' -- that's OK
+    if stack:
+        if len(stack) > 1:
+            raise newick_error('Number of open/close parentheses do not match.')
+        yield close_node(stack, count)
+
+
+def close_node(stack, count):
+    '''Pop the current node off the stack of open nodes, and return its
+    tuple for `parse_nodes`. `count` is the number of nodes opened so far,
+    which includes all of its descendants.'''
+
+    pre, label, length, internal = stack.pop()
+    depth = len(stack)
+    support = None
+    if label and internal:
+        support = parse_confidence(label)
+        if support is not None: label = None
+    return (pre, stack[-1][0] if stack else None, label, length, support,
+            count - 1 - depth, depth, not internal)
+
+
+def literal(text):
+    return '"%s"' % (text.replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def decimal(value):
+    '''Format a number as an xsd:decimal literal (which, unlike an
+    xsd:double, can't use exponent notation).'''
+
+    return '"%s"^^<%s>' % (decimal_text(value), xsd_decimal)
+
+
+def decimal_text(value):
+    '''Format a number as the text of an xsd:decimal literal.'''
+
+    text = repr(float(value))
+    if 'e' in text:
+        text = ('%.30f' % value).rstrip('0')
+        if text.endswith('.'): text += '0'
+    return text
+
+
+def write_cdao(input_file, handle, tree_uri=None, rooted=False, rows=None):
+    '''Convert the trees in a Newick file (an open file handle) to CDAO
+    turtle, along with their interval index, in one streaming pass. Node,
+    edge and TU names are relative to `tree_uri`, as in Biopython's CDAO
+    writer. Labels have underscores replaced with spaces. If `rows` is a
+    list, the row of each node (see `parse_rows`) is added to it.'''
+
+    if tree_uri: handle.write('@base <%s> .\n' % tree_uri)
+    for prefix, uri in (('obo', obo), ('rdfs', rdfs), ('ts', ts)):
+        handle.write('@prefix %s: <%s> .\n' % (prefix, uri))
+
+    tree_type = 'obo:CDAO_0000012' if rooted else 'obo:CDAO_0000088'
+
+    lines = []
+    for pre, parent, label, length, support, post, depth, terminal in parse_nodes(input_file):
+        # nodes, edges and TUs are numbered from 1, in preorder
+        n = str(pre + 1).zfill(8)
+        node = '<node%s>' % n
+
+        if parent is None:
+            lines.append('<> a %s ; obo:CDAO_0000148 %s .' % (tree_type, node))
+        else:
+            p = '<node%s>' % str(parent + 1).zfill(8)
+            edge = '<edge%s>' % n
+            lines.append('%s a obo:CDAO_0000139 ; obo:CDAO_0000200 <> ; obo:CDAO_0000201 %s ; obo:CDAO_0000209 %s .'
+                         % (edge, p, node))
+            lines.append('%s obo:CDAO_0000143 %s ; obo:CDAO_0000179 %s .' % (node, edge, p))
+            lines.append('%s obo:CDAO_0000177 %s .' % (p, edge))
+            if support is not None:
+                lines.append('%s obo:CDAO_0000214 %s .' % (node, decimal(support)))
+            if length is not None:
+                annotation = '<edge_annotation%s>' % n
+                lines.append('%s a obo:CDAO_0000046 ; obo:CDAO_0000215 %s .'
+                             % (annotation, decimal(length)))
+                lines.append('%s obo:CDAO_0000193 %s .' % (edge, annotation))
+
+        if label:
+            tu = '<tu%s>' % n
+            lines.append('%s a obo:CDAO_0000138 ; rdfs:label %s .'
+                         % (tu, literal(label.replace('_', ' '))))
+            lines.append('%s obo:CDAO_0000187 %s .' % (node, tu))
+
+        lines.append('%s a %s ; obo:CDAO_0000200 <> ; ts:pre %s ; ts:post %s ; ts:depth %s .'
+                     % (node, 'obo:CDAO_0000108' if terminal else 'obo:CDAO_0000026',
+                        pre, post, depth))
+
+        if rows is not None:
+            rows.append((pre, parent, label.replace('_', ' ') if label else None, length, ()))
+
+        if len(lines) >= 4096:
+            lines.append('')
+            handle.write('\n'.join(lines))
+            lines = []
+
+    lines.append('')
+    handle.write('\n'.join(lines))
+
+
+def parse_rows(tree_file, format, output_path=None, tree_uri=None, rooted=False,
+               taxonomy=None, rows=None):
+    '''Parse the trees in a file into a list of node rows, as (index, parent
+    index, label, branch length, synonyms) tuples in preorder. `taxonomy` is
+    a TaxonLabeler used to label higher-order taxa. If `rows` is a list,
+    the rows as they were before labelling are added to it. `output_path`
+    and `tree_uri` are unused, but accepted so this can be used as a bulk
+    converter.'''
+
+    if format == 'cdao' and not taxonomy:
+        result = list(cdao_rows(tree_file))
+        if rows is not None: rows += result
+        return result
+
+    if format == 'newick' and not taxonomy:
+        # parse Newick without building Biopython trees, unless the tree's top
+        # level isn't in parentheses
+        try:
+            with open(tree_file) as input_file:
+                result = [(index, parent, label.replace('_', ' ') if label else None, length, ())
+                          for index, parent, label, length, support, post, depth, terminal
+                          in parse_nodes(input_file)]
+            result.sort()
+            if rows is not None: rows += result
+            return result
+        except UnenclosedTree:
+            pass
+
+    trees = list(bp.parse(tree_file, format))
+    result = list(clade_rows([tree.root for tree in trees]))
+    if rows is not None: rows += result
+    if taxonomy:
+        # label higher-order taxa before adding
+        for phylogeny in trees:
+            taxonomy.label_tree(phylogeny)
+        result = list(clade_rows([tree.root for tree in trees]))
+    return result
+
+
+def clade_rows(roots):
+    '''Iterate over the clades of Biopython trees in preorder, yielding
+    (index, parent index, label, branch length, synonyms) for each.'''
+
+    index = 0
+    stack = [(root, None) for root in reversed(roots)]
+    while stack:
+        clade, parent = stack.pop()
+        label = clade.name.replace('_', ' ') if clade.name else None
+        yield index, parent, label, clade.branch_length, ()
+        stack += [(child, index) for child in reversed(clade.clades)]
+        index += 1
+
+
+def cdao_rows(tree_file):
+    '''Iterate over the nodes of the trees in a CDAO file, like
+    `clade_rows`. Unlike Biopython's CDAO parser, this keeps any
+    skos:altLabel synonyms attached to each node's TU.'''
+
+    cdao = rdflib.Namespace(obo)
+    altLabel = rdflib.URIRef(skos + 'altLabel')
+    graph = rdflib.Graph()
+    graph.parse(tree_file, format='turtle')
+
+    node_types = (cdao.CDAO_0000108, cdao.CDAO_0000026)
+    nodes = set(s for t in node_types for s in graph.subjects(rdflib.RDF.type, t))
+    children = {}
+    roots = []
+    for node in sorted(nodes):
+        parent = graph.value(node, cdao.CDAO_0000179)
+        if parent is None: roots.append(node)
+        else: children.setdefault(parent, []).append(node)
+
+    def node_row(node):
+        label, length, synonyms = None, None, []
+        tu = graph.value(node, cdao.CDAO_0000187)
+        if tu is not None:
+            label = graph.value(tu, rdflib.RDFS.label)
+            if label is not None: label = unicode(label)
+            synonyms = [unicode(x) for x in graph.objects(tu, altLabel)]
+        edge = graph.value(node, cdao.CDAO_0000143)
+        if edge is not None:
+            annotation = graph.value(edge, cdao.CDAO_0000193)
+            if annotation is not None:
+                value = graph.value(annotation, cdao.CDAO_0000215)
+                if value is not None: length = float(value)
+        return label, length, synonyms
+
+    index = 0
+    stack = [(root, None) for root in reversed(roots)]
+    while stack:
+        node, parent = stack.pop()
+        label, length, synonyms = node_row(node)
+        yield index, parent, label, length, synonyms
+        stack += [(child, index) for child in reversed(children.get(node, []))]
+        index += 1
@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''A bounded pool of database connections shared between threads. At most
+    `size` connections are open at once; `acquire` blocks until one is free.
+    Idle connections are checked with `check` (a function that raises if a
+    connection is broken) before they're handed out again, and replaced if
+    they fail; connections idle for more than `idle_timeout` seconds are
+    closed.'''
+
+    def __init__(self, connect, size=8, idle_timeout=300, check=None,
+                 check_interval=30):
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check = check
+        self.check_interval = check_interval
+        # idle connections as (connection, time last released), most recently
+        # used last
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+        self.reconnects = self.evictions = 0
+
+    def acquire(self, timeout=None):
+        '''Take a connection from the pool, opening a new one if none are
+        idle and the pool isn't full. Raises PoolTimeout if none is free
+        after `timeout` seconds.'''
+
+        deadline = None if timeout is None else time.time() + timeout
+        connection = last_used = None
+
+        with self._condition:
+            self._evict_idle()
+            while not self._idle and self._open >= self.size:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout('No connection available after %s seconds.' % timeout)
+                self._condition.wait(remaining)
+            if self._idle:
+                connection, last_used = self._idle.pop()
+            else:
+                self._open += 1
+
+        # connect or check outside the lock, so other threads aren't held up
+        try:
+            if connection is not None and self.check and \
+                    time.time() - last_used > self.check_interval:
+                try:
+                    self.check(connection)
+                except Exception:
+                    close_quietly(connection)
+                    connection = None
+                    self.reconnects += 1
+            if connection is None:
+                connection = self.connect()
+        except:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+        return connection
+
+    def release(self, connection, broken=False):
+        '''Return a connection to the pool. Broken connections are closed.'''
+
+        with self._condition:
+            if broken:
+                close_quietly(connection)
+                self._open -= 1
+            else:
+                self._idle.append((connection, time.time()))
+            self._evict_idle()
+            self._condition.notify()
+
+    def _evict_idle(self):
+        # the least recently used connections are at the start of the list
+        now = time.time()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.pop(0)
+            close_quietly(connection)
+            self._open -= 1
+            self.evictions += 1
+
+    def close(self):
+        '''Close all idle connections. Connections in use are still returned
+        to the pool normally.'''
+
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                close_quietly(connection)
+                self._open -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                    'size': self.size,
+                    'open': self._open,
+                    'idle': len(self._idle),
+                    'reconnects': self.reconnects,
+                    'evictions': self.evictions,
+                    }
+
+
+class Lease(object):
+    '''A connection taken from a pool by one thread, along with that thread's
+    cursor. The connection is returned to the pool when the lease is released,
+    or when the thread that holds it exits.'''
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        self.cursor = None
+
+    def release(self, broken=False):
+        if self.connection is None: return
+        connection, self.connection, self.cursor = self.connection, None, None
+        self.pool.release(connection, broken=broken)
+
+    def __del__(self):
+        self.release()
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
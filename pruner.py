@@ -1,229 +1,720 @@
-import Bio.Phylo as bp
 import sys
-import rdflib
+import itertools
+import signal
+from cStringIO import StringIO
+from compact import CompactTree, add_lengths
+from lazy import lazy_import
 
+multiprocessing = lazy_import('multiprocessing')
+
+
+# namespace of the interval index predicates added to each tree node
+ts = 'http://www.phylocommons.org/terms/'
 
 class Prunable:
+    # number of rows fetched at a time when reconstructing trees
+    fetch_size = 1000
+    # named queries (see templates.py)
+    query_templates = {}
+    
     def get_subtree(self, contains=[], contains_ids=[], tree_uri=None,
                     format='newick', prune=True, filter=None, taxonomy=None,
-                    handle=None):
-        # TODO: filter is not being used. Use cql.py to parse the query, then convert the
-        # requirements into SPARQL.
-        
-        filter = self.validate_filter(filter)
+                    handle=None, unresolved=None, resolved=None):
+        '''Serialize the subtree of the best tree (or `tree_uri`) containing
+        a set of taxa. If a list is passed as `unresolved`, the names of taxa 
+        that couldn't be found in the tree are appended to it. `resolved` can
+        be the result of `resolve_taxa` for these taxa in this tree, if it was
+        already looked up.'''
         
         if not contains or contains_ids: raise Exception('A list of taxa or ids is required.')
         if tree_uri:
             tree_uri = self.uri_from_id(tree_uri)
         else:
-            trees = self.list_trees_containing_taxa(contains=contains,
-                                                    show_counts=False,
-                                                    filter=filter)
+            tree_uri = self.best_tree(contains, filter=filter, taxonomy=taxonomy)
+        
+        tree = self.compact_subtree(list(contains), tree_uri, taxonomy=taxonomy,
+                                    prune=prune, unresolved=unresolved, resolved=resolved)
+        
+        return self.serialize_trees(trees=[tree], format=format, handle=handle)
+        
+        
+    def get_subtrees(self, queries, tree_uri=None, prune=True, filter=None, taxonomy=None,
+                     processes=None):
+        '''Find the subtrees for many sets of taxa at once, as Newick. Each
+        query uses the best tree for its taxa (or `tree_uri`), and queries 
+        that use the same tree share one copy of it, fetched once. Taxa are
+        matched, and subtrees are pruned and written, in memory by a pool of
+        `processes` worker processes (default: one per CPU).
         
+        Returns an iterator over a dictionary for each query, in the order
+        they're finished, with the `index` of the query in `queries`, the 
+        `uri` of its tree, the `tree` in Newick, the taxa that were 
+        `unresolved`, and an `error` message if it failed.
+        
+        Example:
+        >>> for result in treestore.get_subtrees([['Homo sapiens', 'Pan paniscus']]):
+        ...     print result['tree']
+        '''
+        
+        filter = self.compile_filter(filter)
+        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
+        synonyms = self.get_synonyms(taxonomy) if taxonomy else None
+        if not tree_uri:
+            # trees are chosen from the taxon index in memory
+            index = self.get_taxon_index(info=filter and filter.needs_info)
+            selected = index.select(filter, self.id_from_uri) if filter else None
+        
+        tasks = []
+        for n, taxa in enumerate(queries):
+            taxa = list(taxa)
             try:
-                tree_uri = trees.next()
-            except StopIteration:
-                raise Exception("An appropriate tree for this query couldn't be found.")
+                if not taxa: raise Exception('A list of taxa is required.')
+                if tree_uri:
+                    uri = tree_uri
+                else:
+                    trees = index.search(taxa, 1, synonyms.expand(taxa) if synonyms else None,
+                                         selected)
+                    if not trees: raise Exception("An appropriate tree for this query couldn't be found.")
+                    uri = trees[0][0]
+            except Exception as e:
+                yield {'index': n, 'uri': None, 'tree': None, 'unresolved': [], 'error': str(e)}
+                continue
+            tasks.append((n, uri, taxa))
         
-        tree = self.subtree(list(contains), tree_uri, 
-                            taxonomy=taxonomy, prune=prune)
+        trees = {}
+        for n, uri, taxa in tasks:
+            if not uri in trees: trees[uri] = self.get_compact_tree(uri)
+        options = {'trees': trees, 'synonyms': synonyms, 'prune': prune, 'labels': {}}
         
-        return self.serialize_trees(trees=[tree], format=format, handle=handle)
+        processes = processes or multiprocessing.cpu_count()
+        if processes == 1 or len(tasks) < 2:
+            for task in tasks: yield batch_query(task, options)
+            return
         
+        # workers are forked with the trees already in memory, so they aren't
+        # sent with each task
+        chunksize = max(1, min(64, len(tasks) // (4 * processes)))
+        pool = multiprocessing.Pool(processes, init_batch_worker, (options,))
+        finished = False
+        try:
+            for result in pool.imap_unordered(run_batch_query, tasks, chunksize):
+                yield result
+            finished = True
+        finally:
+            if finished: pool.close()
+            else: pool.terminate()
+            pool.join()
         
-    def find_mrca(self, taxa, graph, taxonomy=None):
-        assert len(taxa) > 0
         
-        cursor = self.get_cursor()
+    def best_tree(self, contains, filter=None, taxonomy=None):
+        '''Return the URI of the tree that best matches a set of taxa, 
+        counting synonyms from `taxonomy` as matches.'''
+        
+        trees = self.list_trees_containing_taxa(contains=contains,
+                                                show_counts=False,
+                                                taxonomy=taxonomy,
+                                                filter=filter, limit=1)
+        
+        try:
+            return trees.next()
+        except StopIteration:
+            raise Exception("An appropriate tree for this query couldn't be found.")
         
-        mrca = None
         
+    def resolve_taxa(self, graph, taxa, taxonomy=None):
+        '''Find the nodes of a tree matching a list of taxa in one query, 
+        falling back to the genus for unidentified species ("Genus sp.") and 
+        to synonyms from `taxonomy`. Returns a dictionary mapping each 
+        resolved taxon to a tuple of (node id, label in the tree, interval), 
+        and a list of the taxa that couldn't be resolved.'''
+        
+        search = {}
+        for taxon in taxa:
+            words = taxon.split()
+            if words and words[-1] == 'sp.':
+                # when species is unidentified, fall back to searching for the genus
+                search[taxon] = ' '.join(words[:-1])
+            else:
+                search[taxon] = taxon
+        
+        matches = {}
+        for label, node_id, synonym, pre, post, depth in self.query_taxa(
+                graph, sorted(set(search.values())), taxonomy):
+            # prefer exact matches to synonyms
+            if label in matches and (matches[label][1] is None or synonym): continue
+            interval = None if pre is None else (int(pre), int(post), int(depth))
+            matches[label] = (node_id, synonym, interval)
+        
+        resolved = {}
+        unresolved = []
+        for taxon in taxa:
+            if search[taxon] in matches:
+                node_id, synonym, interval = matches[search[taxon]]
+                resolved[taxon] = (node_id, synonym or search[taxon], interval)
+            else:
+                unresolved.append(taxon)
+        
+        return resolved, unresolved
+        
+        
+    def match_taxa(self, taxa, graph, taxonomy=None, unresolved=None, resolved=None):
+        '''Find the nodes of a tree matching a list of taxa. Returns a list of
+        (node id, interval) tuples. Taxa matched to a different name in the 
+        tree (a synonym or genus) are replaced in the list with that name, and
+        taxa that couldn't be found are replaced with None and appended to 
+        `unresolved`, if given. `resolved` can be the result of 
+        `resolve_taxa`, if it was already looked up.'''
+        
+        assert len(taxa) > 0
+        
+        resolved, missing = resolved or self.resolve_taxa(graph, taxa, taxonomy)
+        if not unresolved is None: unresolved += missing
+        
+        matches = []
         for n, taxon in enumerate(taxa[:]):
-            try:
-                result = self.find_name(graph, taxon, taxonomy)
-                if len(result) == 2: node_id, taxon, synonym = result + (None,)
-                else: node_id, taxon, synonym = result
-                ancestors = self.get_ancestors(graph, node_id)
-                if synonym: taxa[n] = synonym
-            except:
+            if taxon in resolved:
+                node_id, label, interval = resolved[taxon]
+                taxa[n] = label
+                matches.append((node_id, interval))
+            else:
                 taxa[n] = None
+        
+        if not matches: raise Exception('None of these taxa are members of this tree.')
+        
+        return matches
+        
+        
+    def find_mrca(self, taxa, graph, taxonomy=None, unresolved=None, resolved=None):
+        '''Find the most recent common ancestor of a list of taxa in a tree.
+        The list is updated as described in `match_taxa`.'''
+        
+        matches = self.match_taxa(taxa, graph, taxonomy, unresolved, resolved)
+        
+        # if the tree has an interval index, the MRCA is the deepest node whose
+        # interval contains the intervals of all matched nodes
+        if all(interval for node_id, interval in matches):
+            pre = min(interval[0] for node_id, interval in matches)
+            post = max(interval[1] for node_id, interval in matches)
+            mrca = self.get_common_ancestor(graph, pre, post)
+            if mrca is None: raise Exception("These taxa aren't all in the same tree.")
+            return mrca
+        
+        # otherwise, intersect the ancestor lists of the matched nodes
+        ancestor_lists = self.get_ancestor_lists(graph, [node_id for node_id, interval in matches])
+        mrca_ancestors = None
+        
+        for node_id, interval in matches:
+            ancestors = ancestor_lists.get(node_id)
+            if not ancestors: continue
+            
+            if mrca_ancestors is None:
+                mrca_ancestors = ancestors
                 continue
-
-            if not mrca:
-                mrca_ancestors = []
-                for (ancestor,) in ancestors:
-                    mrca_ancestors.append(ancestor)
-                if not mrca_ancestors:
-                    taxa[n] = None
-                    continue
-                mrca = mrca_ancestors[0]
-                continue
-                
-            for (ancestor,) in ancestors:
+            
+            for ancestor in ancestors:
                 if ancestor in mrca_ancestors:
-                    mrca = ancestor
                     mrca_ancestors = mrca_ancestors[mrca_ancestors.index(ancestor):]
                     break
         
-        if not mrca: raise Exception('None of these taxa are members of this tree.')
-        return mrca
+        if not mrca_ancestors: raise Exception('None of these taxa are members of this tree.')
+        return mrca_ancestors[0]
+        
+        
+    def subtree(self, taxa, graph, taxonomy=None, prune=False, unresolved=None):
+        '''Get a subtree containing a given set of taxa, as a Biopython tree.'''
+        
+        return self.compact_subtree(taxa, graph, taxonomy=taxonomy, prune=prune,
+                                    unresolved=unresolved).to_phylo()
+        
         
+    def compact_subtree(self, taxa, graph, taxonomy=None, prune=False, unresolved=None,
+                        resolved=None):
+        '''Get a subtree containing a given set of taxa, as a CompactTree.'''
         
-    def subtree(self, taxa, graph, taxonomy=None, prune=False):
-        '''Get a subtree containing a given set of taxa.'''
+        if not taxa: return self.get_compact_tree(graph)
         
-        if taxa:
-            old_taxa = taxa[:]
-            mrca = self.find_mrca(taxa, graph, taxonomy)
+        old_taxa = taxa[:]
+        
+        # if the whole tree is cached, only the taxa need to be looked up; the
+        # MRCA and pruning are done in memory
+        tree = self.cached_tree(graph)
+        if tree is not None:
+            matches = self.match_taxa(taxa, graph, taxonomy, unresolved, resolved)
+            mrca = tree.mrca([tree.index_of(node_id) for node_id, interval in matches])
+            if mrca is None: raise Exception('None of these taxa are members of this tree.')
+            if prune:
+                # only the paths up to the MRCA from nodes labeled with a query
+                # name or a matched name are needed
+                names = set(old_taxa) | set(taxon for taxon in taxa if taxon)
+                labels = tree.labels
+                tree = tree.induced(mrca, [i for i in xrange(mrca, tree.ends[mrca] + 1)
+                                           if labels[i] in names])
+            else:
+                tree = tree.subtree(mrca)
+        else:
+            mrca = self.find_mrca(taxa, graph, taxonomy, unresolved=unresolved,
+                                  resolved=resolved)
+        
+        # these taxa were changed by the MRCA query; they're either None (couldn't
+        # be found) or the name of a synonym
+        replace = {new:old for (new, old) in zip(taxa, old_taxa) 
+                   if new and old != new}
+        
+        if tree is not None:
+            tree.relabel(replace)
+        elif prune:
+            # only the paths from the matched nodes up to the MRCA need to be fetched
+            batches = self.query_induced_nodes(graph, mrca, [taxon for taxon in taxa if taxon])
+            if batches is None: batches = self.query_nodes(graph, mrca)
+            with self.stats.phase('reconstruct'):
+                tree = CompactTree.from_rows(batches, mrca, replace)
+        else:
+            with self.stats.phase('reconstruct'):
+                tree = CompactTree.from_rows(self.query_nodes(graph, mrca), mrca, replace)
+        
+        # synonyms were replaced with query names, so nodes are kept if they're
+        # labeled with a query name
+        if prune:
+            with self.stats.phase('prune'):
+                tree = tree.prune(set(old_taxa))
+        
+        return tree
+    
+    
+    query_templates['subtree_nodes'] = '''
+SELECT DISTINCT ?n ?length ?parent ?label
+WHERE {
+    GRAPH <%(graph)s> {
+        <%(mrca)s> ts:pre ?mrca_pre ; ts:post ?mrca_post ; ts:depth ?mrca_depth .
+        ?n ts:pre ?pre .
+        FILTER (?pre >= ?mrca_pre && ?pre <= ?mrca_post + ?mrca_depth)
+        OPTIONAL { ?n obo:CDAO_0000187 [ rdfs:label ?label ] . }
+        OPTIONAL { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] . }
+        OPTIONAL { ?n obo:CDAO_0000179 ?parent . }
+    }
+}
+ORDER BY ?pre'''
+    # trees added without an interval index need a transitive query
+    query_templates['subtree_nodes_transitive'] = '''
+SELECT DISTINCT ?n ?length ?parent ?label
+WHERE {
+    GRAPH <%(graph)s> {
+        ?n obo:CDAO_0000200 ?tree .
+        ?n a ?type .
+        ?n obo:CDAO_0000179 <%(mrca)s> option(transitive, t_min(0), t_step('step_no') as ?steps) .
+        OPTIONAL { ?n obo:CDAO_0000187 [ rdfs:label ?label ] . }
+        OPTIONAL { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] . }
+        OPTIONAL { ?n obo:CDAO_0000179 ?parent . }
+        FILTER (?type = obo:CDAO_0000108 || ?type = obo:CDAO_0000026)
+    }
+}
+ORDER BY ?steps ?n'''
+    query_templates['tree_nodes'] = '''
+SELECT DISTINCT ?n ?length ?parent ?label
+WHERE {
+    GRAPH <%(graph)s> {
+        ?n obo:CDAO_0000200 ?tree .
+        ?n a ?type .
+        OPTIONAL { ?n obo:CDAO_0000187 [ rdfs:label ?label ] . }
+        OPTIONAL { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] . }
+        OPTIONAL { ?n obo:CDAO_0000179 ?parent . }
+        FILTER (?type = obo:CDAO_0000108 || ?type = obo:CDAO_0000026)
+    }
+}
+ORDER BY ?n'''
+    
+    def query_nodes(self, graph, mrca=None):
+        '''Query for all nodes in a tree, or all descendants of `mrca`. Returns
+        an iterator over batches of (node id, branch length, parent id, label) 
+        rows.'''
+        
+        if mrca:
+            # descendants of the MRCA are a range scan over the interval index
+            cursor = self.run_query('subtree_nodes', graph=graph, mrca=mrca)
+            rows = cursor.fetchmany(self.fetch_size)
+            if rows: return itertools.chain([rows], fetch_batches(cursor, self.fetch_size))
             
-            # these taxa were changed by the MRCA query; they're either None (couldn't
-            # be found) or the name of a synonym
-            replace = {new:old for (new, old) in zip(taxa, old_taxa) 
-                       if new and old != new}
+            cursor = self.run_query('subtree_nodes_transitive', graph=graph, mrca=mrca)
         else:
-            mrca, replace = None, None
-        
-        cursor = self.get_cursor()
-        
-        query = '''sparql
-    PREFIX obo: <http://purl.obolibrary.org/obo/>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-    SELECT DISTINCT ?n ?length ?parent ?label
-    WHERE {
-        GRAPH <''' + graph + '''> {
-            ?n obo:CDAO_0000200 ?tree .
-            ?n a ?type .
-            ''' + ((
-    "?n obo:CDAO_0000179 %s option(transitive, t_min(0), t_step('step_no') as ?steps) ." 
-    % rdflib.URIRef(mrca).n3()
-    ) if mrca else '') + '''
-            OPTIONAL { ?n obo:CDAO_0000187 [ rdfs:label ?label ] . }
-            OPTIONAL { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] . }
-            OPTIONAL { ?n obo:CDAO_0000179 ?parent . }
-            FILTER (?type = obo:CDAO_0000108 || ?type = obo:CDAO_0000026)
-        }
-    }''' +  ('ORDER BY ?steps ?n' if mrca else 'ORDER BY ?n')
-        if self.verbose: print query
-        cursor.execute(query)
-        root = None
-        nodes = {}
-        stmts = cursor
-        
-        for _ in range(2):
-            redo = []
-            for stmt in stmts:
-                node_id, edge_length, parent, label = stmt
-                
-                # replace synonymous names from the phylogeny with names from the query
-                if replace and label in replace: label = replace[label]
-                
-                # create a clade for each node, and store in a dictionary by URI
-                if not node_id in nodes:
-                    clade = bp.CDAO.Clade(name=label, branch_length=float(edge_length) if edge_length else None)
-                    nodes[node_id] = clade
-                
-                # this is the root node if it has no parent or if it's the MRCA
-                if root is None and ((node_id == mrca) if mrca else (parent is None)):
-                    root = nodes[node_id]
-                elif parent and (parent in nodes):
-                    nodes[parent].clades.append(clade)
-                else:
-                    redo.append(stmt)
-                    
-            stmts = redo
+            cursor = self.run_query('tree_nodes', graph=graph)
         
-        tree = bp.CDAO.Tree(root=root, rooted=True)
+        return fetch_batches(cursor, self.fetch_size)
+    
+    
+    query_templates['induced_nodes'] = '''
+SELECT DISTINCT ?n ?length ?parent ?label
+WHERE {
+    GRAPH <%(graph)s> {
+        <%(mrca)s> ts:pre ?mrca_pre ; ts:post ?mrca_post ; ts:depth ?mrca_depth .
+        ?m obo:CDAO_0000187 [ rdfs:label ?m_label ] ; ts:pre ?m_pre ; ts:post ?m_post .
+        FILTER (?m_label in (%(labels*)s) && 
+                ?m_pre >= ?mrca_pre && ?m_pre <= ?mrca_post + ?mrca_depth)
+        ?n ts:pre ?pre ; ts:post ?post .
+        FILTER (?pre >= ?mrca_pre && ?pre <= ?m_pre && ?post >= ?m_post)
+        OPTIONAL { ?n obo:CDAO_0000187 [ rdfs:label ?label ] . }
+        OPTIONAL { ?n obo:CDAO_0000143 [ obo:CDAO_0000193 [ obo:CDAO_0000215 ?length ] ] . }
+        OPTIONAL { ?n obo:CDAO_0000179 ?parent . }
+    }
+}
+ORDER BY ?pre'''
+    
+    def query_induced_nodes(self, graph, mrca, labels):
+        '''Query for the nodes of the subtree under `mrca` labeled with any of 
+        `labels`, along with all of their ancestors up to the MRCA. Returns an
+        iterator over batches of rows like `query_nodes`, or None if the tree
+        has no interval index.'''
         
-        if prune: result = pruned_tree(tree, old_taxa)
-        else: result = tree
+        cursor = self.run_query('induced_nodes', graph=graph, mrca=mrca, labels=labels)
         
-        return result
+        rows = cursor.fetchmany(self.fetch_size)
+        if not rows: return None
+        return itertools.chain([rows], fetch_batches(cursor, self.fetch_size))
+    
     
+    query_templates['ancestors'] = '''
+SELECT ?ancestor
+WHERE {
+    GRAPH <%(graph)s> {
+        <%(node)s> ts:pre ?pre ; ts:post ?post .
+        ?ancestor ts:pre ?ancestor_pre ; ts:post ?ancestor_post .
+        FILTER (?ancestor_pre <= ?pre && ?ancestor_post >= ?post)
+    }
+}
+ORDER BY DESC(?ancestor_pre)'''
+    # trees added without an interval index need a transitive query
+    query_templates['ancestors_transitive'] = '''
+SELECT DISTINCT ?ancestor
+WHERE {
+    GRAPH <%(graph)s> { 
+        <%(node)s> obo:CDAO_0000179 ?ancestor 
+        option(transitive, t_direction 1, t_step('step_no') as ?steps, 
+               t_min 0, t_max 10000)
+    }
+}
+ORDER BY ?steps'''
     
     def get_ancestors(self, graph, node_id):
         '''Query to get all ancestors of a node, starting with the most recent.'''
         
-        cursor = self.get_cursor()
+        results = self.run_query('ancestors', graph=graph, node=node_id).fetchall()
+        if results: return results
         
-        query = '''sparql
-    PREFIX obo: <http://purl.obolibrary.org/obo/>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-    SELECT DISTINCT ?ancestor
-    WHERE {
-        GRAPH %s { 
-            %s obo:CDAO_0000179 ?ancestor 
-            option(transitive, t_direction 1, t_step('step_no') as ?steps, 
-                   t_min 0, t_max 10000)
-        }
+        return self.run_query('ancestors_transitive', graph=graph, node=node_id)
+        
+        
+    query_templates['ancestor_lists'] = '''
+SELECT ?n ?ancestor ?steps
+WHERE {
+    GRAPH <%(graph)s> { 
+        ?n obo:CDAO_0000179 ?ancestor 
+        option(transitive, t_in(?n), t_out(?ancestor), t_direction 1, 
+               t_step('step_no') as ?steps, t_min 0, t_max 10000) .
+        FILTER (?n in (iri(%(nodes*)s)))
     }
-    ORDER BY ?steps
-    ''' % (rdflib.URIRef(graph).n3(), rdflib.URIRef(node_id).n3())
-        if self.verbose: print query
-        cursor.execute(query)
-        results = cursor
+}
+ORDER BY ?n ?steps'''
+    
+    def get_ancestor_lists(self, graph, node_ids):
+        '''Query to get the ancestors of several nodes at once. Returns a 
+        dictionary mapping each node to a list of its ancestors, starting 
+        with the node itself.'''
+        
+        if not node_ids: return {}
+        
+        results = {}
+        for node_id, ancestor, steps in self.run_query('ancestor_lists', graph=graph, 
+                                                       nodes=set(node_ids)):
+            results.setdefault(node_id, []).append(ancestor)
         
         return results
         
         
+    query_templates['intervals'] = '''
+SELECT ?n ?pre ?post ?depth
+WHERE {
+    GRAPH <%(graph)s> {
+        ?n ts:pre ?pre ; ts:post ?post ; ts:depth ?depth .
+        FILTER (?n in (iri(%(nodes*)s)))
+    }
+}'''
+    
+    def get_intervals(self, graph, node_ids):
+        '''Look up the (preorder, postorder, depth) interval index entries for
+        the given nodes. Returns a dictionary; nodes from trees that were added
+        without an interval index are missing from it.'''
+        
+        if not node_ids: return {}
+        
+        return {node_id: (int(pre), int(post), int(depth)) 
+                for node_id, pre, post, depth in self.run_query('intervals', graph=graph,
+                                                                nodes=set(node_ids))}
+        
+        
+    query_templates['common_ancestor'] = '''
+SELECT ?n
+WHERE {
+    GRAPH <%(graph)s> {
+        ?n ts:pre ?pre ; ts:post ?post .
+        FILTER (?pre <= %(pre)s && ?post >= %(post)s)
+    }
+}
+ORDER BY DESC(?pre)
+LIMIT 1'''
+    
+    def get_common_ancestor(self, graph, pre, post):
+        '''Return the deepest node whose interval contains the preorder index 
+        `pre` and postorder index `post`, or None if there isn't one (the 
+        nodes are in different trees of a forest).'''
+        
+        result = self.run_query('common_ancestor', graph=graph, pre=pre, post=post).fetchone()
+        return result[0] if result else None
+        
+        
+    def query_taxa(self, graph, labels, taxonomy=None):
+        '''Query for the nodes of a tree labeled with any of `labels`, or with
+        a synonym of one from `taxonomy`. Returns rows of (label, node id, 
+        synonym, pre, post, depth); the synonym is the node's own label if it 
+        was matched through the taxonomy, and the interval index columns are 
+        None for trees added without one.
+        
+        Synonyms come from the taxonomy's synonym map, so the tree is queried
+        for the labels and all of their synonyms at once, without joining it
+        to the taxonomy graph.'''
+        
+        labels = set(labels)
+        synonyms = self.get_synonyms(taxonomy).expand(labels) if taxonomy else {}
+        
+        # names in the tree that are synonyms of each queried label
+        synonym_of = {}
+        for label, names in synonyms.iteritems():
+            for name in names:
+                synonym_of.setdefault(name, []).append(label)
+        
+        rows = []
+        for name, node_id, pre, post, depth in self.query_labels(graph, labels | set(synonym_of)):
+            if name in labels: 
+                rows.append((name, node_id, None, pre, post, depth))
+            for label in synonym_of.get(name, ()):
+                rows.append((label, node_id, name, pre, post, depth))
+        
+        return rows
+        
+        
+    query_templates['labels'] = '''
+SELECT ?label ?t ?pre ?post ?depth
+WHERE {
+    GRAPH <%(graph)s> { 
+        ?t obo:CDAO_0000187 [ rdfs:label ?label ] 
+        FILTER (?label in (%(labels*)s)) 
+        OPTIONAL { ?t ts:pre ?pre ; ts:post ?post ; ts:depth ?depth }
+    }
+}'''
+    
+    def query_labels(self, graph, labels):
+        '''Query for the nodes of a tree labeled with any of `labels`. Returns
+        rows of (label, node id, pre, post, depth).'''
+        
+        return self.run_query('labels', graph=graph, labels=labels)
+        
+        
+    query_templates['synonym_rows'] = '''
+SELECT ?x ?name ?accepted
+WHERE {
+    GRAPH <%(graph)s> { 
+        { ?x obo:CDAO_0000187 [ rdfs:label ?name ] . BIND (1 AS ?accepted) }
+        UNION
+        { ?x obo:CDAO_0000187 [ skos:altLabel ?name ] . BIND (0 AS ?accepted) }
+    }
+}'''
+    
+    def query_synonym_rows(self, taxonomy):
+        '''Query for the names of every node of a taxonomy graph, as rows of
+        (node id, name, accepted); the accepted name is the rdfs:label, and 
+        other names are skos:altLabels.'''
+        
+        return fetch_rows(self.run_query('synonym_rows', graph=taxonomy), self.fetch_size)
+        
+        
     def find_name(self, graph, taxon, taxonomy=None):
         '''If taxon is the name of a node in this graph, return it; otherwise,
-        return a synonym from `taxonomy` that matches a name in this graph.'''
-        
-        cursor = self.get_cursor()
+        return a synonym from `taxonomy` that matches a name in this graph.
+        Returns a tuple of (node id, name, synonym), where the synonym is the
+        node's label if it was matched through the taxonomy.'''
         
         if taxon.split()[-1] == 'sp.':
             # when species is unidentified, fall back to searching for the genus
             taxon = ' '.join(taxon.split()[:-1])
         
-        query = '''sparql
-    PREFIX obo: <http://purl.obolibrary.org/obo/>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-
-    SELECT ?t ?label ''' + ('?synonym' if taxonomy else '') + '''
-    WHERE { 
-    {
-        GRAPH %s { 
-            ?t obo:CDAO_0000187 [ rdfs:label ?label ] 
-            FILTER (?label = %s) 
-        }
-    }''' % (rdflib.URIRef(graph).n3(), rdflib.Literal(taxon).n3())
-        if taxonomy: query += ''' UNION {
-        GRAPH %s { ?t obo:CDAO_0000187 [ rdfs:label ?synonym ] }
-        GRAPH %s { 
-            ?x obo:CDAO_0000187 [ ?l1 ?synonym ; ?l2 ?label ]
-            FILTER (?label = %s && 
-                    ?l1 in (rdfs:label, skos:altLabel) &&
-                    ?l2 in (rdfs:label, skos:altLabel))
-        }
-    }''' % (rdflib.URIRef(graph).n3(), rdflib.URIRef(taxonomy).n3(), rdflib.Literal(taxon).n3())
-        query += '\n}'
-        if self.verbose: print query
-        cursor.execute(query)
-        results = cursor
-        
-        return results.next()
+        # prefer exact matches to synonyms
+        rows = sorted(self.query_taxa(graph, [taxon], taxonomy), 
+                      key=lambda row: row[2] is not None)
+        if not rows: raise StopIteration()
+        label, node_id, synonym = rows[0][:3]
+        
+        return (node_id, label, synonym)
     
     
     
-def pruned_tree(tree, contains):
-    def prune_clade(tree, clade, root=False):
-        keep_pruning = True
-        while keep_pruning:
-            keep_pruning = False
-            for child in clade.clades:
-                if prune_clade(tree, child):
-                    keep_pruning = True
-                    break
+def fetch_batches(cursor, size):
+    '''Iterate over the remaining rows of a query in batches of `size`.'''
+    
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows: break
+        yield rows
+
+
+def fetch_rows(cursor, size):
+    '''Iterate over the remaining rows of a query, fetching `size` at a time.'''
+    
+    for rows in fetch_batches(cursor, size):
+        for row in rows: yield row
+
+
+def init_batch_worker(options):
+    global batch_options
+    batch_options = options
+    # workers forked by a server shouldn't run its handler when terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def run_batch_query(task):
+    '''Batch query worker: run one task with the worker options.'''
+    
+    return batch_query(task, batch_options)
+
+
+def batch_query(task, options):
+    '''Find the subtree for one (index, tree URI, taxa) task of 
+    `get_subtrees` in a tree from `options`. Errors are reported in the 
+    result rather than raised.'''
+    
+    n, uri, taxa = task
+    result = {'index': n, 'uri': uri, 'tree': None, 'unresolved': [], 'error': None}
+    try:
+        tree = options['trees'][uri]
+        labels = options['labels'].get(uri)
+        if labels is None:
+            labels = options['labels'][uri] = {}
+            for i, label in enumerate(tree.labels):
+                if label is not None: labels.setdefault(label, []).append(i)
         
-        if not root and not (clade.name in contains) and len(clade.clades) <= 1:
-            tree.collapse(clade)
-            return True
-        else:
-            return False
+        tree = match_subtree(tree, labels, taxa, options['synonyms'], options['prune'],
+                             result['unresolved'])
+        s = StringIO()
+        tree.write_newick(s)
+        result['tree'] = s.getvalue()
+    except Exception as e:
+        result['error'] = str(e)
     
-    prune_clade(tree, tree.root, True)
+    return result
+
+
+def match_subtree(tree, labels, taxa, synonyms=None, prune=True, unresolved=None):
+    '''Get the subtree of a CompactTree containing a set of taxa, given a
+    dictionary from each label in the tree to a list of the indices of the
+    nodes with that label; the first is the one matched. Taxa are matched
+    as in `Prunable.resolve_taxa`, to the genus of unidentified species and
+    to synonyms from a SynonymMap, and matched names are replaced with the
+    query names. Taxa that couldn't be found are appended to `unresolved`.'''
+    
+    indices = []
+    replace = {}
+    for taxon in taxa:
+        words = taxon.split()
+        name = ' '.join(words[:-1]) if words and words[-1] == 'sp.' else taxon
+        if not name in labels and synonyms:
+            # prefer exact matches to synonyms
+            name = next((synonym for synonym in sorted(synonyms.synonyms(name)) 
+                         if synonym in labels), name)
+        if name in labels:
+            indices.append(labels[name][0])
+            if name != taxon: replace[name] = taxon
+        elif not unresolved is None:
+            unresolved.append(taxon)
+    
+    if not indices: raise Exception('None of these taxa are members of this tree.')
+    mrca = tree.mrca(indices)
+    if mrca is None: raise Exception("These taxa aren't all in the same tree.")
+    
+    if not prune: return tree.subtree(mrca).relabel(replace)
+    
+    # matched names are replaced with the query names, so nodes are kept if
+    # they're labeled with a query name or a matched name; only the paths
+    # from those nodes up to the MRCA are needed to prune the subtree
+    contains = set(taxa)
+    end = tree.ends[mrca]
+    kept = [i for name in contains | set(replace) for i in labels.get(name, ()) 
+            if mrca <= i <= end]
+    return tree.induced(mrca, kept).relabel(replace).prune(contains)
+
+
+def pruned_tree(tree, contains):
+    '''Prune a Biopython tree to the subtree induced by the clades named in
+    `contains`, in one iterative postorder pass. Unnamed clades left with a 
+    single child are collapsed into it, adding their branch lengths together;
+    the root is always kept.'''
+    
+    contains = set(contains)
+    
+    order = []
+    stack = [tree.root]
+    while stack:
+        clade = stack.pop()
+        order.append(clade)
+        stack += clade.clades
+    
+    for clade in reversed(order):
+        kept = []
+        for child in clade.clades:
+            if child.name in contains or len(child.clades) > 1:
+                kept.append(child)
+            elif len(child.clades) == 1:
+                only_child = child.clades[0]
+                only_child.branch_length = add_lengths(child.branch_length, only_child.branch_length)
+                kept.append(only_child)
+        clade.clades = kept
     
     return tree
+
+
+def node_intervals(parents):
+    '''Compute the interval index of a tree (or forest), given the parent 
+    index of each node in preorder (None for roots). Returns lists of the 
+    postorder index and depth of each node; the descendants of a node are the 
+    nodes with preorder index between its own and its postorder index + depth.'''
+    
+    n = len(parents)
+    depth = [0] * n
+    size = [1] * n
+    
+    for i, parent in enumerate(parents):
+        if parent is not None: depth[i] = depth[parent] + 1
+    for i in xrange(n - 1, -1, -1):
+        parent = parents[i]
+        if parent is not None: size[parent] += size[i]
+    
+    post = [i + size[i] - 1 - depth[i] for i in xrange(n)]
+    
+    return post, depth
+
+
+def write_intervals(trees, handle):
+    '''Write the interval index of trees that were just written to `handle` 
+    by the CDAO writer, as turtle statements about each clade's node URI.'''
+    
+    clades = []
+    parents = []
+    stack = [(tree.root, None) for tree in reversed(trees)]
+    while stack:
+        clade, parent = stack.pop()
+        index = len(clades)
+        clades.append(clade)
+        parents.append(parent)
+        stack += [(child, index) for child in reversed(clade.clades)]
+    
+    post, depth = node_intervals(parents)
+    
+    for i, clade in enumerate(clades):
+        handle.write('<%s> <%spre> %s ; <%spost> %s ; <%sdepth> %s .\n' % 
+                     (clade.uri, ts, i, ts, post[i], ts, depth[i]))
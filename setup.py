@@ -13,7 +13,6 @@ setup(name='treestore',
                 'pypyodbc',
                 'rdflib',
                 'biopython',
-                'phylolabel',
                 ],
       packages=['treestore'],
       package_dir={
@@ -21,7 +20,7 @@ setup(name='treestore',
                 },
       entry_points={
         'console_scripts': [
-            'treestore = treestore.treestore:main',
+            'treestore = treestore.daemon:main',
         ],
       },
       )
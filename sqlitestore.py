@@ -0,0 +1,670 @@
+import os
+import time
+import sqlite3
+from newick import parse_rows
+from treestore import Treestore, new_version
+from contenthash import tree_hashes, unchanged
+from pruner import node_intervals, fetch_batches
+from config import config_defaults, base_uri
+from lazy import lazy_import
+
+rdflib = lazy_import('rdflib')
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS trees (
+    id INTEGER PRIMARY KEY,
+    uri TEXT UNIQUE NOT NULL,
+    rooted INTEGER NOT NULL DEFAULT 0,
+    version TEXT,
+    content_hashes TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    tree INTEGER NOT NULL,
+    parent INTEGER,
+    label TEXT,
+    length REAL,
+    pre INTEGER,
+    post INTEGER,
+    depth INTEGER
+);
+CREATE TABLE IF NOT EXISTS labels (
+    tree INTEGER NOT NULL,
+    node INTEGER NOT NULL,
+    label TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS store (
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    tree INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    predicate TEXT NOT NULL,
+    object TEXT NOT NULL
+);
+'''
+
+indexes = '''
+CREATE INDEX IF NOT EXISTS nodes_tree_label ON nodes (tree, label);
+CREATE INDEX IF NOT EXISTS nodes_label ON nodes (label);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent);
+CREATE INDEX IF NOT EXISTS nodes_tree_pre ON nodes (tree, pre);
+CREATE INDEX IF NOT EXISTS labels_tree_label ON labels (tree, label);
+CREATE INDEX IF NOT EXISTS labels_node ON labels (node);
+CREATE INDEX IF NOT EXISTS annotations_subject ON annotations (subject);
+CREATE INDEX IF NOT EXISTS annotations_tree ON annotations (tree);
+'''
+
+# columns added to the schema since it was first released; databases created
+# by older versions are upgraded when they're opened
+added_columns = [
+                 ('nodes', 'pre', 'INTEGER'),
+                 ('nodes', 'post', 'INTEGER'),
+                 ('nodes', 'depth', 'INTEGER'),
+                 ('trees', 'version', 'TEXT'),
+                 ('trees', 'content_hashes', 'TEXT'),
+                 ]
+
+bibo_cites = 'http://purl.org/ontology/bibo/cites'
+
+
+class SqliteTreestore(Treestore):
+    '''A treestore kept in an embedded SQLite database instead of an RDF
+    store. Trees are stored natively as tables of nodes with parent, label
+    and branch length columns, so no server is needed.'''
+
+    def __init__(self, db_path=None, load_dir=None,
+                 base_uri=base_uri, verbose=False, cache_size=None,
+                 cache_bytes=None, pool_size=None, **kwargs):
+        '''Create a treestore object backed by the SQLite database at
+        `db_path`, which is created if it doesn't exist yet. Options that
+        aren't given are read from the config file. Other keyword arguments
+        (e.g. ODBC settings) are ignored.'''
+
+        self.db_path = config_defaults(db_path=db_path)['db_path']
+        Treestore.__init__(self, load_dir=load_dir, base_uri=base_uri,
+                           verbose=verbose, cache_size=cache_size,
+                           cache_bytes=cache_bytes, pool_size=pool_size)
+
+
+    def store_id(self):
+        return os.path.abspath(self.db_path)
+
+
+    def taxon_index_path(self):
+        return self.db_path + '.taxa'
+
+
+    def new_connection(self):
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        if not os.path.exists(db_dir): os.makedirs(db_dir)
+        # pooled connections are only used by one thread at a time, but not
+        # necessarily the thread that opened them
+        connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        connection.text_factory = str
+        connection.executescript(schema)
+        for table, column, type in added_columns:
+            columns = [x[1] for x in connection.execute('PRAGMA table_info(%s)' % table)]
+            if not column in columns:
+                connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, type))
+        connection.executescript(indexes)
+        return connection
+
+    def execute(self, query, params=(), cursor=None):
+        if cursor is None: cursor = self.get_cursor()
+        if self.verbose: print query, params
+        cursor.execute(query, params)
+        return cursor
+
+    def get_tree_id(self, tree_uri, create=False, rooted=False):
+        cursor = self.execute('SELECT id FROM trees WHERE uri = ?', (tree_uri,))
+        result = cursor.fetchone()
+        if result: return result[0]
+        if not create: return None
+
+        cursor = self.execute('INSERT INTO trees (uri, rooted) VALUES (?, ?)',
+                              (tree_uri, 1 if rooted else 0))
+        return cursor.lastrowid
+
+    def add_trees(self, tree_file, format, tree_uri=None, rooted=False,
+        taxonomy=None, tax_root=None, force=False):
+        '''Parse trees residing in a text file and add their nodes to the
+        database under the given tree URI. Returns False without adding 
+        anything if they're the trees stored under this URI already (unless
+        `force` is True), and True otherwise. Trees stored under the URI 
+        from another file, or another version of this one, are replaced.
+
+        Example:
+        >>> treestore.add_trees('test.newick', 'newick', 'http://www.example.org/test/')
+        '''
+
+        if tree_uri is None: tree_uri = os.path.basename(tree_file)
+        else: tree_uri = self.uri_from_id(tree_uri)
+
+        salt = self.content_salt(rooted, taxonomy, tax_root)
+        stored = self.query_content_hashes(tree_uri).get(tree_uri, set())
+
+        if isinstance(taxonomy, basestring):
+            taxonomy = self.get_taxonomy(taxonomy, tax_root)
+        # hash the trees as they were read, before any taxonomy labels
+        read = None if salt is None else []
+        rows = parse_rows(tree_file, format, taxonomy=taxonomy, rows=read)
+        hashes = None if salt is None else tree_hashes(read, salt)
+        if unchanged(hashes, stored) and not force: return False
+
+        with self.connection:
+            if stored: self.clear_tree(tree_uri)
+            self.insert_rows(tree_uri, rows, rooted)
+            if hashes: self.add_content_hashes(tree_uri, hashes)
+        self.taxon_index.save()
+        return True
+
+
+    bulk_converter = staticmethod(parse_rows)
+
+    def load_files(self, results, rooted=False, loader_threads=1):
+        '''Insert the rows parsed from each file by `add_tree_files`, one
+        transaction per file, so a failure only affects its own file. 
+        `loader_threads` is ignored, since SQLite allows a single writer.'''
+
+        for result in results:
+            start_time = time.time()
+            try:
+                with self.connection:
+                    if result['replace']: self.clear_tree(result['uri'])
+                    self.insert_rows(result['uri'], result['data'], rooted)
+                    if result['hashes']: self.add_content_hashes(result['uri'], result['hashes'])
+            except Exception as e:
+                result['error'] = '%s: %s' % (e.__class__.__name__, e)
+            else:
+                result['load_time'] = time.time() - start_time
+
+
+    def insert_rows(self, tree_uri, rows, rooted=False):
+        '''Insert the nodes of parsed trees (see `parse_rows`) under a tree
+        URI, with their interval index. Should be called in a transaction.'''
+
+        post, depth = node_intervals([parent for index, parent, label, length, synonyms in rows])
+
+        tree_id = self.get_tree_id(tree_uri, create=True, rooted=rooted)
+        # trees added to an existing URI are numbered after the ones 
+        # already there
+        cursor = self.execute('SELECT COALESCE(MAX(pre), -1) + 1 FROM nodes WHERE tree = ?', (tree_id,))
+        pre_offset = cursor.fetchone()[0]
+
+        self.insert_nodes(tree_id, rows, [(pre_offset + index, pre_offset + post[index], depth[index])
+                                          for index, parent, label, length, synonyms in rows])
+        self.set_version(tree_uri)
+
+
+    def insert_nodes(self, tree_id, rows, intervals, parent=None):
+        '''Insert parsed nodes into a tree with the given interval index 
+        entries; roots are made children of `parent`, if given. Returns the
+        id of the first node; the rest are numbered in order from it.'''
+
+        cursor = self.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM nodes')
+        offset = cursor.fetchone()[0]
+
+        nodes = []
+        labels = []
+        for (index, parent_index, label, length, synonyms), (pre, post, depth) in zip(rows, intervals):
+            node_id = offset + index
+            nodes.append((node_id, tree_id,
+                          parent if parent_index is None else offset + parent_index,
+                          label, length, pre, post, depth))
+            if label: labels.append((tree_id, node_id, label))
+            labels += [(tree_id, node_id, synonym) for synonym in synonyms]
+
+        cursor = self.get_cursor()
+        cursor.executemany('INSERT INTO nodes (id, tree, parent, label, length, pre, post, depth) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', nodes)
+        cursor.executemany('INSERT INTO labels (tree, node, label) VALUES (?, ?, ?)', labels)
+        return offset
+
+
+    def transaction(self):
+        return self.connection
+
+
+    def shift_intervals(self, tree_uri, key, start, offset):
+        self.execute('UPDATE nodes SET %s = %s + ? WHERE tree = ? AND %s >= ?' % (key, key, key),
+                     (offset, self.get_tree_id(tree_uri), start))
+
+
+    def shift_depths(self, tree_uri, pre, end, offset):
+        self.execute('UPDATE nodes SET depth = depth + ? WHERE tree = ? AND pre BETWEEN ? AND ?',
+                     (offset, self.get_tree_id(tree_uri), pre, end))
+
+
+    def get_children(self, tree_uri, node_id):
+        return [row[0] for row in self.execute('SELECT id FROM nodes WHERE parent = ?', (node_id,))]
+
+
+    def get_lengths(self, tree_uri, node_ids):
+        node_ids = list(set(node_ids))
+        query = 'SELECT id, length FROM nodes WHERE id IN (%s) AND length IS NOT NULL' % (
+            ', '.join(['?' for node_id in node_ids]))
+        return dict(self.execute(query, node_ids).fetchall())
+
+
+    def move_node(self, tree_uri, node_id, parent):
+        self.execute('UPDATE nodes SET parent = ? WHERE id = ?', (parent, node_id))
+
+
+    def insert_clade(self, tree_uri, parent, rows, intervals):
+        offset = self.insert_nodes(self.get_tree_id(tree_uri), rows, intervals, parent)
+        return [offset + row[0] for row in rows]
+
+
+    def delete_clade(self, tree_uri, node_id, pre, end):
+        tree_id = self.get_tree_id(tree_uri)
+        labels = [row[0] for row in self.execute('''
+SELECT DISTINCT label FROM nodes
+WHERE tree = ? AND pre BETWEEN ? AND ? AND label IS NOT NULL''', (tree_id, pre, end))]
+        self.execute('''
+DELETE FROM labels 
+WHERE node IN (SELECT id FROM nodes WHERE tree = ? AND pre BETWEEN ? AND ?)''', (tree_id, pre, end))
+        self.execute('DELETE FROM nodes WHERE tree = ? AND pre BETWEEN ? AND ?', (tree_id, pre, end))
+        return labels
+
+
+    def set_labels(self, tree_uri, changes):
+        cursor = self.get_cursor()
+        cursor.executemany('UPDATE nodes SET label = ? WHERE id = ?',
+                           [(new_label, node_id) for node_id, label, new_label in changes])
+        cursor.executemany('UPDATE labels SET label = ? WHERE node = ? AND label = ?',
+                           [(new_label, node_id, label) for node_id, label, new_label in changes])
+
+
+    def set_length(self, tree_uri, node_id, length):
+        self.execute('UPDATE nodes SET length = ? WHERE id = ?', (length, node_id))
+
+
+    def clear_content_hashes(self, tree_uri):
+        self.execute('UPDATE trees SET content_hashes = NULL WHERE uri = ?', (tree_uri,))
+
+
+    def clear_tree(self, tree_uri):
+        '''Delete the nodes, labels, annotations and content hashes of a 
+        tree, keeping its row. Should be called in a transaction.'''
+
+        tree_id = self.get_tree_id(tree_uri)
+        for table in ('nodes', 'labels', 'annotations'):
+            self.execute('DELETE FROM %s WHERE tree = ?' % table, (tree_id,))
+        self.clear_content_hashes(tree_uri)
+
+
+    def remove_trees(self, tree_uri):
+        '''Remove trees from treestore.
+
+        Example:
+        >>> treestore.remove_trees('http://www.example.org/test/')
+        '''
+
+        tree_uri = self.uri_from_id(tree_uri)
+
+        with self.connection:
+            tree_id = self.get_tree_id(tree_uri)
+            if tree_id is None: return
+            for table in ('nodes', 'labels', 'annotations'):
+                self.execute('DELETE FROM %s WHERE tree = ?' % table, (tree_id,))
+            self.execute('DELETE FROM trees WHERE id = ?', (tree_id,))
+            self.taxon_index.remove(tree_uri)
+            self.set_store_version()
+
+        self.cache.invalidate(tree_uri)
+        self.taxon_index.save()
+
+
+    def get_version(self, tree_uri):
+        '''Return the version stamp of a tree, which changes whenever the
+        tree is modified.'''
+
+        result = self.execute('SELECT version FROM trees WHERE uri = ?', (tree_uri,)).fetchone()
+        return result[0] if result else None
+
+
+    def set_version(self, tree_uri, changes=None):
+        '''Give a tree a new version stamp, drop any cached copy and reindex
+        its taxa (see `index_taxa`). Returns the new version.'''
+
+        self.cache.invalidate(tree_uri)
+        version = new_version()
+        self.execute('UPDATE trees SET version = ? WHERE uri = ?', (version, tree_uri))
+        self.index_taxa(tree_uri, version, changes)
+        self.set_store_version()
+        return version
+
+
+    def get_store_version(self):
+        result = self.execute('SELECT version FROM store').fetchone()
+        return result[0] if result else None
+
+
+    def set_store_version(self):
+        # if the store is still at the version the taxon index was synced
+        # with, one update replaces it
+        self.taxon_index.load()
+        old_version = self.taxon_index.store_version
+        version = new_version()
+        if old_version is not None and self.execute('UPDATE store SET version = ? WHERE version = ?',
+                                                    (version, old_version)).rowcount:
+            self.taxon_index.stamp(old_version, version)
+        else:
+            self.execute('DELETE FROM store')
+            self.execute('INSERT INTO store (version) VALUES (?)', (version,))
+        return version
+
+
+    def query_tree_versions(self):
+        return dict(self.execute('SELECT uri, version FROM trees').fetchall())
+
+
+    def query_content_hashes(self, tree_uri=None):
+        if tree_uri is None:
+            cursor = self.execute('SELECT uri, content_hashes FROM trees')
+        else:
+            cursor = self.execute('SELECT uri, content_hashes FROM trees WHERE uri = ?', (tree_uri,))
+        return dict((uri, set(hashes.split())) for uri, hashes in cursor.fetchall() if hashes)
+
+
+    def add_content_hashes(self, tree_uri, hashes):
+        '''Record the content hashes of trees added under a URI, stored
+        space-separated. Should be called in a transaction.'''
+
+        self.execute("UPDATE trees SET content_hashes = LTRIM(COALESCE(content_hashes, '') || ' ' || ?) WHERE uri = ?",
+                     (' '.join(sorted(set(hashes))), tree_uri))
+
+
+    def query_tree_labels(self, tree_uri):
+        cursor = self.execute('''
+SELECT DISTINCT label FROM nodes
+WHERE tree = (SELECT id FROM trees WHERE uri = ?) AND label IS NOT NULL''', (tree_uri,))
+        return [result[0] for result in cursor.fetchall()]
+
+
+    def query_tree_info(self, tree_uri=None):
+        tree_filter = 'AND trees.uri = ?' if tree_uri else ''
+        params = (tree_uri,) if tree_uri else ()
+
+        # tips are the nodes that aren't anyone's parent
+        info = {}
+        cursor = self.execute('''
+SELECT trees.uri, COUNT(*)
+FROM trees JOIN nodes ON nodes.tree = trees.id
+WHERE NOT EXISTS (SELECT 1 FROM nodes AS children WHERE children.parent = nodes.id) %s
+GROUP BY trees.id''' % tree_filter, params)
+        for uri, tips in cursor.fetchall():
+            info[uri] = {'tips': tips, 'citations': ()}
+
+        cursor = self.execute('''
+SELECT DISTINCT trees.uri, annotations.object
+FROM trees JOIN annotations ON annotations.tree = trees.id
+WHERE annotations.predicate = ? %s''' % tree_filter, (bibo_cites,) + params)
+        for uri, citation in cursor.fetchall():
+            tree_info = info.setdefault(uri, {'tips': 0, 'citations': ()})
+            tree_info['citations'] += (citation,)
+
+        return info
+
+
+    def iter_names(self, tree_uri=None):
+        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
+
+        # keyset paging: each page starts after the last (label, id) of the
+        # previous one, found by seeking in the label index
+        query = '''
+SELECT nodes.id, nodes.label
+FROM nodes %s
+WHERE nodes.label >= ? AND (nodes.label > ? OR nodes.id > ?)
+ORDER BY nodes.label, nodes.id
+LIMIT %s
+''' % ('JOIN trees ON trees.id = nodes.tree AND trees.uri = ?' if tree_uri else '', 
+       self.names_page_size)
+
+        label, node_id = '', -1
+        while True:
+            params = (label, label, node_id)
+            rows = self.execute(query, (tree_uri,) + params if tree_uri else params).fetchall()
+            for row in rows: yield row
+            if len(rows) < self.names_page_size: break
+            node_id, label = rows[-1]
+
+
+    def count_names(self, tree_uri=None):
+        if tree_uri:
+            cursor = self.execute('''
+SELECT COUNT(nodes.label) 
+FROM nodes JOIN trees ON trees.id = nodes.tree 
+WHERE trees.uri = ?''', (self.uri_from_id(tree_uri),))
+        else:
+            cursor = self.execute('SELECT COUNT(label) FROM nodes')
+        return cursor.fetchone()[0]
+
+
+    def get_tree_info(self, tree_uri=None):
+        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
+
+        query = '''
+SELECT trees.uri, COUNT(nodes.label),
+       (SELECT object FROM annotations
+        WHERE annotations.tree = trees.id AND predicate = ? LIMIT 1)
+FROM trees JOIN nodes ON nodes.tree = trees.id
+%s
+GROUP BY trees.id
+ORDER BY trees.uri
+''' % ('WHERE trees.uri = ?' if tree_uri else '')
+        cursor = self.execute(query, (bibo_cites, tree_uri) if tree_uri else (bibo_cites,))
+
+        return [{k:v for k, v in zip(('tree', 'taxa', 'citation'), result) } for result in cursor]
+
+
+    def get_object_info(self, object):
+        return self.execute('SELECT predicate, object FROM annotations WHERE subject = ?',
+                            (str(object),)).fetchall()
+
+
+    def annotate(self, tree_uri, annotations=None, annotation_file=None, doi=None):
+        '''Annotate tree with annotations from RDF file.'''
+
+        from annotate import doi_lookup
+
+        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
+
+        if annotations:
+            pass
+        elif annotation_file:
+            with open(annotation_file) as input_file:
+                annotations = input_file.read()
+        elif doi:
+            annotations = doi_lookup(doi)
+        else:
+            raise Exception('No annotation source (string, file, or DOI)  was specified.')
+
+        # annotations are written as a pattern on ?tree, as they would be
+        # for a SPARQL insert; bind ?tree and parse them as turtle
+        turtle = '\n'.join(['@prefix %s: <%s> .' % x for x in self.prefixes])
+        turtle += '\n' + annotations.replace('?tree', rdflib.URIRef(tree_uri).n3())
+        graph = rdflib.Graph()
+        graph.parse(data=turtle, format='turtle')
+
+        with self.connection:
+            tree_id = self.get_tree_id(tree_uri)
+            if tree_id is None: raise Exception('Tree %s not found.' % tree_uri)
+            self.get_cursor().executemany(
+                'INSERT INTO annotations (tree, subject, predicate, object) VALUES (?, ?, ?, ?)',
+                [(tree_id, unicode(s), unicode(p), unicode(o)) for s, p, o in graph])
+            self.set_version(tree_uri)
+
+
+    def query_nodes(self, graph, mrca=None):
+        '''Query for all nodes in a tree, or all descendants of `mrca`. Returns
+        an iterator over batches of (node id, branch length, parent id, label)
+        rows.'''
+
+        if mrca:
+            intervals = self.get_intervals(graph, [mrca])
+            if mrca in intervals:
+                # descendants of the MRCA are a range scan over the interval index
+                pre, post, depth = intervals[mrca]
+                query = '''
+SELECT id, length, parent, label FROM nodes
+WHERE tree = (SELECT tree FROM nodes WHERE id = ?) AND pre BETWEEN ? AND ?
+ORDER BY pre
+'''
+                return fetch_batches(self.execute(query, (mrca, pre, post + depth)), self.fetch_size)
+
+            query = '''
+WITH RECURSIVE descendants(id, steps) AS (
+    SELECT ?, 0
+    UNION ALL
+    SELECT nodes.id, descendants.steps + 1
+    FROM nodes JOIN descendants ON nodes.parent = descendants.id
+)
+SELECT nodes.id, nodes.length, nodes.parent, nodes.label
+FROM descendants JOIN nodes ON nodes.id = descendants.id
+ORDER BY descendants.steps, nodes.id
+'''
+            return fetch_batches(self.execute(query, (mrca,)), self.fetch_size)
+
+        query = '''
+SELECT nodes.id, nodes.length, nodes.parent, nodes.label
+FROM nodes JOIN trees ON trees.id = nodes.tree
+WHERE trees.uri = ?
+ORDER BY nodes.id
+'''
+        return fetch_batches(self.execute(query, (graph,)), self.fetch_size)
+
+
+    def query_induced_nodes(self, graph, mrca, labels):
+        '''Query for the nodes of the subtree under `mrca` labeled with any of
+        `labels`, along with all of their ancestors up to the MRCA. Returns an
+        iterator over batches of rows like `query_nodes`, or None if the tree
+        has no interval index.'''
+
+        intervals = self.get_intervals(graph, [mrca])
+        if not mrca in intervals: return None
+        pre, post, depth = intervals[mrca]
+
+        labels = list(labels)
+        query = '''
+WITH RECURSIVE path(id) AS (
+    SELECT id FROM nodes
+    WHERE tree = (SELECT tree FROM nodes WHERE id = ?) AND label IN (%s)
+    AND pre BETWEEN ? AND ?
+    UNION
+    SELECT nodes.parent FROM nodes JOIN path ON nodes.id = path.id
+    WHERE nodes.id != ?
+)
+SELECT nodes.id, nodes.length, nodes.parent, nodes.label
+FROM path JOIN nodes ON nodes.id = path.id
+ORDER BY nodes.pre
+''' % ', '.join(['?' for label in labels])
+
+        return fetch_batches(self.execute(query, [mrca] + labels + [pre, post + depth, mrca]),
+                             self.fetch_size)
+
+
+    def get_ancestors(self, graph, node_id):
+        '''Query to get all ancestors of a node, starting with the most recent.'''
+
+        intervals = self.get_intervals(graph, [node_id])
+        if node_id in intervals:
+            pre, post, depth = intervals[node_id]
+            query = '''
+SELECT id FROM nodes
+WHERE tree = (SELECT tree FROM nodes WHERE id = ?) AND pre <= ? AND post >= ?
+ORDER BY pre DESC
+'''
+            return self.execute(query, (node_id, pre, post))
+
+        # trees added without an interval index need a recursive query
+        query = '''
+WITH RECURSIVE ancestors(id, steps) AS (
+    SELECT ?, 0
+    UNION ALL
+    SELECT nodes.parent, ancestors.steps + 1
+    FROM nodes JOIN ancestors ON nodes.id = ancestors.id
+    WHERE nodes.parent IS NOT NULL
+)
+SELECT id FROM ancestors ORDER BY steps
+'''
+        return self.execute(query, (node_id,))
+
+
+    def get_ancestor_lists(self, graph, node_ids):
+        '''Query to get the ancestors of several nodes at once. Returns a
+        dictionary mapping each node to a list of its ancestors, starting
+        with the node itself.'''
+
+        node_ids = list(set(node_ids))
+        query = '''
+WITH RECURSIVE ancestors(node, id, steps) AS (
+    SELECT id, id, 0 FROM nodes WHERE id IN (%s)
+    UNION ALL
+    SELECT ancestors.node, nodes.parent, ancestors.steps + 1
+    FROM nodes JOIN ancestors ON nodes.id = ancestors.id
+    WHERE nodes.parent IS NOT NULL
+)
+SELECT node, id FROM ancestors ORDER BY node, steps
+''' % ', '.join(['?' for node_id in node_ids])
+
+        results = {}
+        for node_id, ancestor in self.execute(query, node_ids):
+            results.setdefault(node_id, []).append(ancestor)
+
+        return results
+
+
+    def get_intervals(self, graph, node_ids):
+        '''Look up the (preorder, postorder, depth) interval index entries for
+        the given nodes. Returns a dictionary; nodes from trees that were added
+        without an interval index are missing from it.'''
+
+        node_ids = list(set(node_ids))
+        query = '''
+SELECT id, pre, post, depth FROM nodes
+WHERE id IN (%s) AND pre IS NOT NULL
+''' % ', '.join(['?' for node_id in node_ids])
+
+        return {node_id: (pre, post, depth)
+                for node_id, pre, post, depth in self.execute(query, node_ids)}
+
+
+    def get_common_ancestor(self, graph, pre, post):
+        '''Return the deepest node whose interval contains the preorder index
+        `pre` and postorder index `post`, or None if there isn't one.'''
+
+        query = '''
+SELECT id FROM nodes
+WHERE tree = (SELECT id FROM trees WHERE uri = ?) AND pre <= ? AND post >= ?
+ORDER BY pre DESC
+LIMIT 1
+'''
+        result = self.execute(query, (graph, pre, post)).fetchone()
+        return result[0] if result else None
+
+
+    def query_labels(self, graph, labels):
+        '''Query for the nodes of a tree labeled with any of `labels`. Returns
+        rows of (label, node id, pre, post, depth).'''
+
+        labels = list(labels)
+        query = '''
+SELECT label, id, pre, post, depth FROM nodes
+WHERE tree = (SELECT id FROM trees WHERE uri = ?) AND label IN (%s)
+''' % ', '.join(['?' for label in labels])
+
+        return self.execute(query, [graph] + labels)
+
+
+    def query_synonym_rows(self, taxonomy):
+        '''Query for the names of every node of a taxonomy tree, as rows of
+        (node id, name, accepted).'''
+
+        query = '''
+SELECT labels.node, labels.label, labels.label = nodes.label
+FROM labels JOIN nodes ON nodes.id = labels.node
+WHERE labels.tree = (SELECT id FROM trees WHERE uri = ?)
+'''
+        return self.execute(query, (taxonomy,), cursor=self.get_cursor(True))
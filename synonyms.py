@@ -0,0 +1,108 @@
+import cPickle as pickle
+import os
+import tempfile
+from array import array
+
+
+def normalize(name):
+    '''Normalize a taxon name for synonym lookup: underscores are treated
+    as spaces, runs of whitespace are collapsed, and case is ignored.'''
+
+    return ' '.join(name.replace('_', ' ').split()).lower()
+
+
+class SynonymMap:
+    '''The synonyms of a taxonomy graph, compiled into a map from each
+    normalized name to the taxa that have it as a label or synonym. Each
+    taxon is stored once, as its taxonomy node id, accepted name and all of
+    its names. Maps are tagged with the version of the taxonomy they were
+    built from.'''
+
+    format_version = 1
+
+    def __init__(self, version=None):
+        self.version = version
+        # normalized name -> array of taxon numbers
+        self.names = {}
+        # taxon number -> (node id, accepted name, tuple of all names)
+        self.taxa = []
+
+    @classmethod
+    def from_rows(cls, rows, version=None):
+        '''Build a map from (node id, name, accepted) rows, where `accepted`
+        is true for a node's accepted name (its rdfs:label) and false for
+        its other names.'''
+
+        names = {}
+        accepted = {}
+        for node_id, name, is_accepted in rows:
+            if not name: continue
+            node_names = names.setdefault(node_id, [])
+            if not name in node_names: node_names.append(name)
+            if is_accepted: accepted[node_id] = name
+
+        synonyms = cls(version)
+        for node_id in sorted(names):
+            number = len(synonyms.taxa)
+            synonyms.taxa.append((node_id, accepted.get(node_id), tuple(names[node_id])))
+            for name in set(normalize(name) for name in names[node_id]):
+                synonyms.names.setdefault(name, array('i')).append(number)
+        return synonyms
+
+    def lookup(self, name):
+        '''Return a list of (node id, accepted name, names) for the taxa
+        that have `name` as a label or synonym.'''
+
+        return [self.taxa[number] for number in self.names.get(normalize(name), ())]
+
+    def synonyms(self, name):
+        '''Return the set of names of all taxa sharing a name with `name`,
+        not including `name` itself.'''
+
+        result = set()
+        for node_id, accepted, names in self.lookup(name):
+            result.update(names)
+        result.discard(name)
+        return result
+
+    def expand(self, names):
+        '''Return a dictionary mapping each of `names` to its synonyms.'''
+
+        return {name: self.synonyms(name) for name in names}
+
+    def __len__(self):
+        return len(self.taxa)
+
+    @classmethod
+    def load(cls, path, version=None):
+        '''Load a saved map, or return None if there isn't one for this
+        version of the taxonomy (or it can't be read).'''
+
+        if not os.path.exists(path): return None
+        try:
+            with open(path, 'rb') as map_file:
+                data = pickle.load(map_file)
+        except Exception:
+            return None
+        if data.get('format_version') != cls.format_version: return None
+        if data['version'] != version: return None
+
+        synonyms = cls(version)
+        synonyms.names = data['names']
+        synonyms.taxa = data['taxa']
+        return synonyms
+
+    def save(self, path):
+        '''Save the map to `path`, replacing any older map atomically.'''
+
+        map_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(map_dir): os.makedirs(map_dir)
+        fd, temp_path = tempfile.mkstemp(dir=map_dir)
+        with os.fdopen(fd, 'wb') as map_file:
+            pickle.dump({
+                         'format_version': self.format_version,
+                         'version': self.version,
+                         'names': self.names,
+                         'taxa': self.taxa,
+                         }, map_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
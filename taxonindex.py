@@ -0,0 +1,272 @@
+import cPickle as pickle
+import heapq
+import os
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+
+
+class TaxonIndex:
+    '''An inverted index from taxon labels to the trees that contain them,
+    used to rank trees by how many of a set of taxa they contain without
+    querying every graph. Each tree is given a number when it's indexed, and
+    each label maps to a sorted array of the numbers of trees containing it.
+
+    Trees are indexed along with their version stamp, so `sync` only needs
+    to reindex trees whose version has changed. The store's version stamp at
+    the last sync is kept in `store_version`, so a store that hasn't changed
+    since needn't be synced at all. The index is saved to `path` and 
+    reloaded lazily, so it persists across restarts.
+
+    Each tree's number of tips and citations, used by filters, are kept in
+    `info`; they're dropped when the tree changes, and fetched again by
+    `sync_info` when they're next needed.'''
+
+    format_version = 3
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._loaded = False
+        # incremented whenever the index changes
+        self.generation = 0
+        self._clear()
+
+    def _clear(self):
+        # tree URI -> (tree number, version stamp)
+        self.trees = {}
+        # tree number -> URI
+        self.uris = {}
+        # tree number -> tuple of labels, to remove a tree's postings
+        self.tree_labels = {}
+        # label -> sorted array of tree numbers
+        self.postings = {}
+        # tree number -> {'tips': number of tips, 'citations': tuple of URIs}
+        self.info = {}
+        self.next_number = 0
+        # version stamp of the store the index was last synced with
+        self.store_version = None
+        self.dirty = False
+        self.generation += 1
+
+    def load(self):
+        '''Load the saved index, if there is one and it hasn't been loaded.
+        An unreadable index file is ignored; the index is rebuilt by `sync`.'''
+
+        with self._lock:
+            if self._loaded: return
+            self._loaded = True
+            if not self.path or not os.path.exists(self.path): return
+            try:
+                with open(self.path, 'rb') as index_file:
+                    data = pickle.load(index_file)
+                if data.get('format_version') != self.format_version: return
+                self.trees = data['trees']
+                self.tree_labels = data['tree_labels']
+                self.postings = data['postings']
+                self.info = data['info']
+                self.next_number = data['next_number']
+                self.store_version = data['store_version']
+                self.uris = {number: uri for uri, (number, _) in self.trees.iteritems()}
+                self.generation += 1
+            except Exception:
+                self._clear()
+
+    def save(self):
+        '''Write the index to its file if it has changed, replacing the old
+        file atomically.'''
+
+        with self._lock:
+            if not self.path or not self.dirty: return
+            index_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(index_dir): os.makedirs(index_dir)
+            fd, temp_path = tempfile.mkstemp(dir=index_dir)
+            with os.fdopen(fd, 'wb') as index_file:
+                pickle.dump({
+                             'format_version': self.format_version,
+                             'trees': self.trees,
+                             'tree_labels': self.tree_labels,
+                             'postings': self.postings,
+                             'info': self.info,
+                             'next_number': self.next_number,
+                             'store_version': self.store_version,
+                             }, index_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.path)
+            self.dirty = False
+
+    def add(self, uri, version, labels):
+        '''Index (or reindex) a tree with a set of labels.'''
+
+        with self._lock:
+            self.load()
+            self.remove(uri)
+
+            # new trees are numbered after all existing ones, so appending
+            # keeps the posting arrays sorted
+            number = self.next_number
+            self.next_number += 1
+            labels = tuple(set(labels))
+            for label in labels:
+                self.postings.setdefault(label, array('i')).append(number)
+
+            self.trees[uri] = (number, version)
+            self.uris[number] = uri
+            self.tree_labels[number] = labels
+            self.dirty = True
+            self.generation += 1
+
+    def remove(self, uri):
+        '''Remove a tree from the index.'''
+
+        with self._lock:
+            self.load()
+            if not uri in self.trees: return
+
+            number, _ = self.trees.pop(uri)
+            del self.uris[number]
+            self.info.pop(number, None)
+            for label in self.tree_labels.pop(number):
+                trees = self.postings[label]
+                del trees[bisect_left(trees, number)]
+                if not trees: del self.postings[label]
+            self.dirty = True
+            self.generation += 1
+
+    def update(self, uri, old_version, version, added=(), removed=()):
+        '''Update the labels of a tree indexed at `old_version` in place,
+        after an edit that added and removed some labels, and mark it as
+        indexed at `version`. Returns False, leaving the index unchanged, if
+        the tree isn't indexed at `old_version`.'''
+
+        with self._lock:
+            self.load()
+            if self.trees.get(uri, (None, None))[1] != old_version: return False
+
+            number, _ = self.trees[uri]
+            labels = set(self.tree_labels[number])
+            for label in set(added) - labels:
+                trees = self.postings.setdefault(label, array('i'))
+                trees.insert(bisect_left(trees, number), number)
+            for label in set(removed) & labels:
+                trees = self.postings[label]
+                del trees[bisect_left(trees, number)]
+                if not trees: del self.postings[label]
+
+            self.tree_labels[number] = tuple((labels | set(added)) - set(removed))
+            self.trees[uri] = (number, version)
+            self.info.pop(number, None)
+            self.dirty = True
+            self.generation += 1
+            return True
+
+    def sync(self, versions, get_labels, store_version=None):
+        '''Bring the index up to date with a store, given a dictionary of
+        the current version stamp of each tree. Trees that are new or have
+        changed are reindexed with labels from `get_labels(uri)`. The index
+        is marked as synced with the store at `store_version`.'''
+
+        with self._lock:
+            self.load()
+            for uri in [uri for uri in self.trees if not uri in versions]:
+                self.remove(uri)
+            for uri, version in versions.iteritems():
+                if not uri in self.trees or self.trees[uri][1] != version:
+                    self.add(uri, version, get_labels(uri))
+            if self.store_version != store_version:
+                self.store_version = store_version
+                self.dirty = True
+            self.save()
+
+    def synced(self, store_version):
+        '''Return whether the index was last synced with the store at
+        `store_version`.'''
+
+        with self._lock:
+            self.load()
+            return store_version is not None and self.store_version == store_version
+
+    def stamp(self, old_store_version, store_version):
+        '''Mark the index as synced with the store at `store_version`, after
+        a change that's been applied to the index too, if it was synced with
+        the store at `old_store_version` before the change.'''
+
+        with self._lock:
+            self.load()
+            if not self.synced(old_store_version): return
+            self.store_version = store_version
+            self.dirty = True
+
+    def sync_info(self, get_info):
+        '''Fetch the info of the trees that don't have it, with 
+        `get_info(uri)` for a few trees or `get_info()` for all of them, 
+        which return dictionaries of {tree URI: info}.'''
+
+        with self._lock:
+            self.load()
+            missing = [uri for uri, (number, _) in self.trees.iteritems()
+                       if not number in self.info]
+            if not missing: return
+
+            if len(missing) * 10 < len(self.trees):
+                info = {}
+                for uri in missing: info.update(get_info(uri))
+            else:
+                info = get_info()
+            for uri in missing:
+                self.info[self.trees[uri][0]] = info.get(uri) or {'tips': 0, 'citations': ()}
+            self.dirty = True
+            self.generation += 1
+            self.save()
+
+    def select(self, filter, tree_id=None):
+        '''Return the set of numbers of the trees matching a compiled
+        filter (see filters.py).'''
+
+        with self._lock:
+            self.load()
+            return filter.select(self, tree_id)
+
+    def search(self, contains=(), limit=None, synonyms=None, trees=None):
+        '''Return a list of (tree URI, number of matched taxa) for the trees
+        containing any of the taxa in `contains` (or all trees, if it's
+        empty), best matches first. Only the top `limit` trees are returned,
+        if given. A taxon also matches trees containing any of its names in
+        the `synonyms` dictionary. If `trees` is given, only trees whose 
+        numbers are in it are returned.'''
+
+        with self._lock:
+            self.load()
+            if contains:
+                counts = {}
+                for label in set(contains):
+                    names = synonyms.get(label) if synonyms else None
+                    if names:
+                        # count each tree once, however many names it matches
+                        matches = set(self.postings.get(label, ()))
+                        for name in names: matches.update(self.postings.get(name, ()))
+                    else:
+                        matches = self.postings.get(label, ())
+                    for number in matches:
+                        counts[number] = counts.get(number, 0) + 1
+                if not trees is None:
+                    counts = {number: count for number, count in counts.iteritems() 
+                              if number in trees}
+            else:
+                counts = dict.fromkeys(self.uris if trees is None else trees, 0)
+            results = [(self.uris[number], count) for number, count in counts.iteritems()]
+
+        # as in the store's queries, taxonomies are listed after trees with
+        # as many matches
+        key = lambda (uri, count): (-count, '_taxonomy' in uri, uri)
+        if limit: return heapq.nsmallest(limit, results, key=key)
+        return sorted(results, key=key)
+
+    def stats(self):
+        with self._lock:
+            self.load()
+            return {
+                    'trees': len(self.trees),
+                    'labels': len(self.postings),
+                    'postings': sum(len(trees) for trees in self.postings.itervalues()),
+                    }
@@ -0,0 +1,102 @@
+class Taxonomy:
+    '''A taxonomy graph reconstructed once for labeling trees with
+    higher-order taxa, tagged with the version of the graph it was built
+    from. Holds a lookup table from each label to its node, and the
+    TaxonLabelers of the subsets (clades named by `tax_root`) that trees
+    have been labeled against so far.'''
+
+    def __init__(self, tree, version=None):
+        '''Create a taxonomy from a CompactTree.'''
+
+        self.tree = tree
+        self.version = version
+
+        # label -> index of the node with that label closest to the root, so
+        # a homonym deeper in the taxonomy is never chosen as a subset root
+        depths = [0] * len(tree)
+        self.nodes = {}
+        for i, label in enumerate(tree.labels):
+            parent = tree.parents[i]
+            if parent >= 0: depths[i] = depths[parent] + 1
+            if label is None: continue
+            if not label in self.nodes or depths[i] < depths[self.nodes[label]]:
+                self.nodes[label] = i
+
+        self._subsets = {}
+
+    def subset(self, tax_root=None):
+        '''Return a TaxonLabeler for the clade named `tax_root` (or the
+        whole taxonomy, if it's None or isn't found). Each subset is only
+        built once.'''
+
+        if not tax_root in self._subsets:
+            if tax_root in self.nodes:
+                tree = self.tree.subtree(self.nodes[tax_root])
+            else:
+                tree = self.tree
+            self._subsets[tax_root] = TaxonLabeler(tree)
+        return self._subsets[tax_root]
+
+
+class TaxonLabeler:
+    '''Lookup tables for labeling trees with the higher-order taxa of a
+    taxonomy: the innermost taxon containing each tip label, and the parent,
+    depth and name of each taxon. They're built once per taxonomy subset and
+    reused for every tree labeled, and can be pickled to send to bulk
+    conversion workers.'''
+
+    def __init__(self, tree):
+        '''Create a labeler from a CompactTree of a taxonomy.'''
+
+        # taxon -> label, enclosing taxon (-1 if none) and depth, where
+        # taxa are the labeled internal nodes of the taxonomy
+        self.names = {}
+        self.parents = {}
+        self.depths = {}
+        # tip label -> innermost taxon containing it
+        self.tips = {}
+
+        # nodes are in preorder, so each node's parent has been seen already
+        enclosing = [-1] * len(tree)
+        for i, label in enumerate(tree.labels):
+            parent = tree.parents[i]
+            taxon = enclosing[parent] if parent >= 0 else -1
+            if tree.offsets[i] == tree.offsets[i + 1]:
+                if label is not None and not label in self.tips:
+                    self.tips[label] = taxon
+                continue
+            if label is not None:
+                self.names[i] = label
+                self.parents[i] = taxon
+                self.depths[i] = self.depths[taxon] + 1 if taxon >= 0 else 0
+                taxon = i
+            enclosing[i] = taxon
+
+    def label_tree(self, phylogeny):
+        '''Label the unlabeled internal nodes of a Biopython tree with the
+        taxa whose tips in the tree are exactly the tips below them, so a
+        tip the taxonomy doesn't include keeps the nodes above it unlabeled.
+        A node matching nested taxa gets the innermost one.'''
+
+        # set of tip labels below each clade -> the lowest clade with them
+        clades = {}
+        below = {}
+        members = {}
+        for clade in phylogeny.find_clades(order='postorder'):
+            if clade.is_terminal():
+                label = clade.name.replace('_', ' ') if clade.name else None
+                below[clade] = frozenset([label]) if label else frozenset()
+                # tips outside the taxonomy are in no taxon
+                taxon = self.tips.get(label, -1)
+                while taxon >= 0:
+                    members.setdefault(taxon, set()).add(label)
+                    taxon = self.parents[taxon]
+            else:
+                below[clade] = frozenset().union(*[below[child] for child in clade.clades])
+                if below[clade] and not below[clade] in clades:
+                    clades[below[clade]] = clade
+
+        for taxon in sorted(members, key=lambda taxon: -self.depths[taxon]):
+            clade = clades.get(frozenset(members[taxon]))
+            if clade is None or clade.name: continue
+            clade.name = self.names[taxon]
@@ -0,0 +1,264 @@
+'''Named query templates, prepared once on each connection and run with
+bound parameters, so the store doesn't parse and compile new query text on
+every call. Parameters are written in a template's text as:
+
+    <%(node)s>        an IRI in a triple pattern or GRAPH clause
+    iri(%(node)s)     an IRI in an expression or an update's target graph
+    %(label)s         a literal
+    %(labels*)s       a list of literals (or iri(%(nodes*)s) of IRIs), e.g.
+                      for IN; lists are padded to a power of two by repeating
+                      their last value, so only a few queries are prepared
+    %(key!)s          text pasted into the query, for the parts that can't be
+                      parameters: a predicate's name, LIMIT, or a block of data
+
+A query is prepared for each distinct length of a template's lists and
+pasted text. Templates of SQL statements use ? for parameters; SPARQL
+templates are sent with only the PREFIX lines they use, or all of them if
+they paste text.'''
+
+import inspect
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+
+parameter = re.compile(r'<%\((\w+)\)s>|(iri\()?%\((\w+)([*!]?)\)s(?(2)\))')
+prefix_name = re.compile(r'\b([A-Za-z][\w-]*):\w')
+
+
+class QueryTemplate(object):
+    '''The text of a template, split into literal text and parameters.
+    `sql` templates are SQL statements rather than SPARQL queries. Templates
+    that aren't to be kept prepared (e.g. ones pasting large blocks of data)
+    have `prepare` set to False.'''
+
+    def __init__(self, text, sql=False, prepare=True):
+        self.text = text
+        self.sql = sql
+        self.prepare = prepare
+        # literal text, and (name, form, kind) tuples for parameters, where
+        # form is 'pattern', 'iri' or 'value' and kind is '', '*' or '!'
+        self.parts = []
+        position = 0
+        for match in parameter.finditer(text):
+            self.parts.append(text[position:match.start()])
+            if match.group(1):
+                self.parts.append((match.group(1), 'pattern', ''))
+            else:
+                self.parts.append((match.group(3), 'iri' if match.group(2) else 'value',
+                                   match.group(4)))
+            position = match.end()
+        self.parts.append(text[position:])
+        self.pastes = any(part[2] == '!' for part in self.parts if isinstance(part, tuple))
+        if sql and any(part[1] != 'value' for part in self.parts if isinstance(part, tuple)):
+            raise ValueError('SQL templates can only have literal parameters.')
+
+    def bind(self, params):
+        '''Return the shape of a query made from this template with a
+        dictionary of parameters (the lengths of its lists and the text it
+        pastes) and the list of values to bind.'''
+
+        shape = []
+        values = []
+        for part in self.parts:
+            if isinstance(part, basestring): continue
+            name, form, kind = part
+            value = params[name]
+            if kind == '!':
+                shape.append(value)
+            elif kind == '*':
+                value = list(value)
+                size = padded_size(len(value)) if value else 0
+                shape.append(size)
+                values.extend(value)
+                values.extend(value[-1:] * (size - len(value)))
+            else:
+                values.append(value)
+        return tuple(shape), values
+
+    def render(self, shape, header=''):
+        '''Return the text of the query of a shape returned by `bind`.'''
+
+        marker = '?' if self.sql else '??'
+        markers = {'pattern': '`iri(%s)`' % marker, 'iri': 'iri(%s)' % marker, 'value': marker}
+        shape = iter(shape)
+        text = [header]
+        for part in self.parts:
+            if isinstance(part, basestring):
+                text.append(part)
+                continue
+            name, form, kind = part
+            if kind == '!':
+                text.append('%s' % shape.next())
+            elif kind == '*':
+                text.append(', '.join([markers[form]] * shape.next()))
+            else:
+                text.append(markers[form])
+        return ''.join(text)
+
+
+def padded_size(n):
+    size = 1
+    while size < n: size *= 2
+    return size
+
+
+def collect_templates(cls):
+    '''Return the templates in the `query_templates` dictionaries of a class
+    and its bases, which are text or QueryTemplates; those of subclasses
+    replace those of their bases.'''
+
+    templates = {}
+    for base in reversed(inspect.getmro(cls)):
+        for name, template in vars(base).get('query_templates', {}).iteritems():
+            if isinstance(template, basestring): template = QueryTemplate(template)
+            templates[name] = template
+    return templates
+
+
+class TemplateRegistry(object):
+    '''The query templates of a store, with the queries prepared from them
+    on each connection and statistics on each template's executions.
+
+    Each query gets its own cursor on each connection it's run on, which
+    keeps it prepared; executing the same text again with new parameters
+    reuses the prepared statement. Up to `prepared_size` queries are kept
+    prepared per connection, closing the least recently used. Queries run
+    on a cursor of their own aren't read lazily by anything else, but the
+    results of one are replaced when it's run again, and lost if it's
+    closed, so results handed to callers should be fetched first.'''
+
+    prepared_size = 200
+
+    def __init__(self, templates, prefixes=()):
+        self.templates = templates
+        self.prefixes = list(prefixes)
+        self._lock = threading.Lock()
+        # (template name, shape) -> text of the query
+        self._queries = {}
+        # connection -> OrderedDict of {query text: cursor}
+        self._prepared = weakref.WeakKeyDictionary()
+        # template name -> [executions, prepares, seconds]
+        self._stats = {}
+
+    def __contains__(self, name):
+        return name in self.templates
+
+    def header(self, template):
+        '''Return the text sent before a SPARQL template's own: the "sparql"
+        marker and the PREFIX lines it needs.'''
+
+        if template.sql: return ''
+        if template.pastes:
+            prefixes = self.prefixes
+        else:
+            used = set(prefix_name.findall(''.join(part for part in template.parts
+                                                    if isinstance(part, basestring))))
+            prefixes = [prefix for prefix in self.prefixes if prefix[0] in used]
+        return 'sparql\n' + ''.join(['PREFIX %s: <%s>\n' % prefix for prefix in prefixes])
+
+    def query(self, name, params=None):
+        '''Return the text of a template's query for a dictionary of
+        parameters, and the values to bind to it.'''
+
+        template = self.templates[name]
+        shape, values = template.bind(params or {})
+        if not template.prepare: return template.render(shape, self.header(template)), values
+        key = (name, shape)
+        text = self._queries.get(key)
+        if text is None:
+            text = template.render(shape, self.header(template))
+            with self._lock:
+                if len(self._queries) >= 4096: self._queries.clear()
+                self._queries[key] = text
+        return text, values
+
+    def cursor(self, connection, name, text):
+        '''Return the cursor a query is kept prepared on for a connection.
+        Returns None for templates that aren't kept prepared.'''
+
+        if not self.templates[name].prepare: return None
+        with self._lock:
+            prepared = self._prepared.get(connection)
+            if prepared is None: prepared = self._prepared[connection] = OrderedDict()
+            cursor = prepared.pop(text, None)
+            if cursor is None:
+                cursor = connection.cursor()
+                self.entry(name)[1] += 1
+                if len(prepared) >= self.prepared_size:
+                    close_quietly(prepared.popitem(last=False)[1])
+            prepared[text] = cursor
+        return cursor
+
+    def execute(self, connection, name, params=None, cursor=None):
+        '''Run a template with a dictionary of parameters on a connection,
+        and return the cursor with its results. Templates that aren't kept
+        prepared are run on `cursor`, or a new cursor.'''
+
+        text, values = self.query(name, params)
+        return self.run(connection, name, text, cursor, 'execute', values)
+
+    def executemany(self, connection, name, rows, cursor=None):
+        '''Run a template once for each of a list of dictionaries of
+        parameters, which have to give queries of the same shape.'''
+
+        if not rows: return None
+        text, values = self.query(name, rows[0])
+        template = self.templates[name]
+        values = [values] + [template.bind(params)[1] for params in rows[1:]]
+        return self.run(connection, name, text, cursor, 'executemany', values)
+
+    def run(self, connection, name, text, cursor, method, values):
+        prepared = self.cursor(connection, name, text)
+        if prepared is None: prepared = cursor or connection.cursor()
+        entry = self.entry(name)
+        start_time = time.time()
+        try:
+            getattr(prepared, method)(text, values)
+        finally:
+            entry[0] += 1 if method == 'execute' else len(values)
+            entry[2] += time.time() - start_time
+        return prepared
+
+    def entry(self, name):
+        entry = self._stats.get(name)
+        if entry is None: entry = self._stats.setdefault(name, [0, 0, 0.0])
+        return entry
+
+    def summary(self, since=None):
+        '''Return a list of the number of executions, number of queries
+        prepared and total execution time of each template that's been run,
+        slowest first; `since` is an earlier summary to subtract.'''
+
+        before = dict((x['template'], x) for x in since or ())
+        summary = []
+        with self._lock:
+            for name, (executions, prepares, seconds) in self._stats.iteritems():
+                old = before.get(name, {'executions': 0, 'prepares': 0, 'time': 0.0})
+                if executions == old['executions']: continue
+                summary.append({'template': name,
+                                'executions': executions - old['executions'],
+                                'prepares': prepares - old['prepares'],
+                                'time': seconds - old['time']})
+        summary.sort(key=lambda x: -x['time'])
+        return summary
+
+    def report(self, handle=sys.stderr, since=None):
+        '''Write the statistics of each template to a file handle.'''
+
+        summary = self.summary(since)
+        if not summary: return
+        handle.write('\n%-32s %10s %9s %10s\n' % ('template', 'executions', 'prepared', 'time (s)'))
+        for x in summary:
+            handle.write('%-32s %10s %9s %10.4f\n' % (x['template'], x['executions'],
+                                                      x['prepares'], x['time']))
+
+
+def close_quietly(cursor):
+    try:
+        cursor.close()
+    except Exception:
+        pass
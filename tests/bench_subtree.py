@@ -0,0 +1,40 @@
+'''Benchmark tree reconstruction (Prunable.subtree) across the tests/bird*.new
+series, using an embedded SQLite treestore in a temporary directory.
+
+Time per node should stay roughly constant as the trees get bigger.'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from sqlitestore import SqliteTreestore
+
+sizes = [10, 50, 100, 200, 500, 1000, 2000, 5000]
+repeats = 5
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+tmp_dir = tempfile.mkdtemp()
+t = SqliteTreestore(db_path=os.path.join(tmp_dir, 'bench.db'), load_dir=tmp_dir)
+
+print 'size\tnodes\tsubtree (s)\tper node (us)'
+try:
+    for n in sizes:
+        s = str(n).zfill(4)
+        t.add_trees(os.path.join(tests_dir, 'bird%s.new' % s), 'newick', 'test%s' % s)
+        graph = t.uri_from_id('test%s' % s)
+
+        best = None
+        for _ in range(repeats):
+            start_time = time.time()
+            tree = t.subtree(None, graph)
+            elapsed = time.time() - start_time
+            if best is None or elapsed < best: best = elapsed
+
+        nodes = len(list(tree.find_clades()))
+        print '%s\t%s\t%.4f\t\t%.2f' % (n, nodes, best, best / nodes * 1e6)
+        sys.stdout.flush()
+finally:
+    t.close()
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,277 @@
+'''Benchmark treestore operations across the tests/bird*.new series and the
+large trees in trees/, using an embedded SQLite treestore in a temporary
+directory (or a live store, with --store).
+
+For each tree and operation, the best wall time of several runs, the number
+of store round trips (queries executed) and the peak memory use are written
+to a JSON file. If a baseline from an earlier run is given, results are
+compared with it and the exit status is 1 if any operation got slower by
+more than the tolerance, or needs more round trips.
+
+Startup is measured too: the time to import treestore and to run
+`treestore --version` in a new process. The exit status is 1 if either
+takes longer than the startup budget, or if importing treestore loads a
+heavy dependency or touches the config directory.
+
+Usage:
+    python tests/benchmark.py [--quick] [-o benchmarks.json] [-b baseline.json]
+
+Trees and caches are dropped before each run, so times include rebuilding
+trees from the store.'''
+
+import os
+import sys
+import json
+import time
+import glob
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+from cStringIO import StringIO
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+package_dir = os.path.join(tests_dir, '..')
+trees_dir = os.path.join(tests_dir, '..', 'trees')
+sizes = [10, 50, 100, 200, 500, 1000, 2000, 5000]
+quick_sizes = [10, 100, 1000]
+# modules that should only be imported by the commands that use them
+heavy_modules = ['Bio', 'rdflib', 'pypyodbc', 'sqlite3', 'multiprocessing']
+
+
+def reset_peak_memory():
+    '''Reset the peak resident set size, if the OS allows it (Linux 4.0+).
+    Otherwise peaks are for the whole process so far.'''
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_memory():
+    '''Return the peak resident set size in kB.'''
+
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'): return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, kB elsewhere
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def datasets(quick=False):
+    '''Return a list of (name, tree file) pairs to benchmark.'''
+
+    result = [('bird%s' % str(n).zfill(4), os.path.join(tests_dir, 'bird%s.new' % str(n).zfill(4)))
+              for n in (quick_sizes if quick else sizes)]
+    if not quick:
+        result += [(os.path.splitext(os.path.basename(path))[0], path)
+                   for path in sorted(glob.glob(os.path.join(trees_dir, '*.new')))]
+    return result
+
+
+def operations(t, uri, taxa):
+    '''Return a list of (name, function) for the operations to benchmark on
+    an added tree; `taxa` is a sample of its names.'''
+
+    contains = set(taxa)
+    batch = [taxa[i:i + 5] for i in range(len(taxa))]
+    return [
+            ('get', lambda: t.serialize_trees(uri, 'newick')),
+            ('query', lambda: t.get_subtree(contains=taxa, tree_uri=uri)),
+            ('query_complete', lambda: t.get_subtree(contains=taxa, tree_uri=uri, prune=False)),
+            ('query_best_tree', lambda: t.get_subtree(contains=taxa)),
+            ('query_batch', lambda: list(t.get_subtrees(batch, processes=1))),
+            ('ls', lambda: list(t.list_trees())),
+            ('ls_contains', lambda: list(t.list_trees_containing_taxa(contains=contains, show_counts=True))),
+            ('ls_taxonomy', lambda: list(t.list_trees_containing_taxa(contains=contains, show_counts=True,
+                                                                      taxonomy=uri))),
+            ('ls_filter', lambda: list(t.list_trees_containing_taxa(contains=contains, show_counts=True,
+                                                                    filter='tips > 5 and tree = bench*'))),
+            ('names', lambda: t.get_names(uri, format='list')),
+            ('names_json', lambda: t.get_names(uri, format='json', handle=StringIO())),
+            ('count', lambda: t.count_names(uri)),
+            ('prune', lambda: t.get_compact_tree(uri).prune(contains)),
+            # edits last, since they change the tree
+            ('edit_relabel', lambda: t.relabel_taxa(uri, {taxa[0]: taxa[0]})),
+            ('edit_length', lambda: t.set_branch_length(uri, taxa[:1], 1.0)),
+            ]
+
+
+def measure(t, fn, repeats):
+    '''Run `fn` `repeats` times with empty caches, and return the best wall
+    time, the round trips of one run and the peak memory in kB.'''
+
+    best = None
+    for _ in range(repeats):
+        t.cache.invalidate()
+        t.synonym_maps.clear()
+        reset_peak_memory()
+        t.stats.reset()
+        start_time = time.time()
+        fn()
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best: best = elapsed
+    return best, t.stats.summary()['total_queries'], peak_memory()
+
+
+def run(t, names, repeats=3, sample=0.05, seed=1):
+    results = []
+    print '%-28s %-16s %10s %8s %10s' % ('tree', 'operation', 'time (s)', 'queries', 'peak (kB)')
+
+    def record(name, size, operation, (elapsed, round_trips, peak)):
+        results.append({'tree': name, 'size': size, 'operation': operation,
+                        'time': elapsed, 'round_trips': round_trips, 'peak_kb': peak})
+        print '%-28s %-16s %10.4f %8s %10s' % (name, operation, elapsed, round_trips, peak)
+        sys.stdout.flush()
+
+    for name, path in names:
+        uri = t.uri_from_id('bench_%s' % name)
+        t.remove_trees(uri)
+        stats = measure(t, lambda: t.add_trees(path, 'newick', uri), 1)
+        size = t.get_compact_tree(uri).count_terminals()
+        record(name, size, 'add', stats)
+        record(name, size, 'add_unchanged', measure(t, lambda: t.add_trees(path, 'newick', uri), 1))
+
+        all_taxa = sorted(t.get_names(uri, format='list'))
+        rng = random.Random(seed)
+        taxa = rng.sample(all_taxa, min(len(all_taxa), max(3, min(200, int(len(all_taxa) * sample)))))
+
+        for operation, fn in operations(t, uri, taxa):
+            record(name, size, operation, measure(t, fn, repeats))
+
+    return results
+
+
+def startup(repeats=5):
+    '''Measure the best time to import treestore and to run `treestore
+    --version` in new processes, with an empty home directory. Returns the
+    results and a list of startup problems: heavy modules or config files
+    loaded by the import.'''
+
+    home = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['HOME'] = home
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + filter(None, [env.get('PYTHONPATH')]))
+    commands = [
+                ('import', [sys.executable, '-c', 'import treestore']),
+                ('version', [sys.executable, os.path.join(package_dir, 'treestore.py'), '--version']),
+                ]
+
+    results = []
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for operation, command in commands:
+                best = None
+                for _ in range(repeats):
+                    start_time = time.time()
+                    subprocess.check_call(command, env=env, stdout=devnull, stderr=devnull)
+                    elapsed = time.time() - start_time
+                    if best is None or elapsed < best: best = elapsed
+                results.append({'tree': 'startup', 'size': 0, 'operation': operation,
+                                'time': best, 'round_trips': 0, 'peak_kb': None})
+
+        loaded = subprocess.check_output([sys.executable, '-c', 
+            'import sys, treestore; print " ".join(m for m in %r if m in sys.modules)' % heavy_modules], 
+            env=env).split()
+        problems = ['importing treestore loads %s' % module for module in loaded]
+        if os.listdir(home):
+            problems.append('importing treestore creates %s' % ', '.join(os.listdir(home)))
+    finally:
+        shutil.rmtree(home)
+
+    return results, problems
+
+
+def compare(results, baseline, tolerance=0.25, min_delta=0.005):
+    '''Compare results with a baseline; return a list of regressions.'''
+
+    old = {(r['tree'], r['operation']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = old.get((r['tree'], r['operation']))
+        if b is None: continue
+        if (r['time'] > b['time'] * (1 + tolerance) and r['time'] - b['time'] > min_delta):
+            regressions.append('%s %s: %.4fs (baseline %.4fs)' % (r['tree'], r['operation'],
+                                                                  r['time'], b['time']))
+        if r['round_trips'] > b['round_trips']:
+            regressions.append('%s %s: %s queries (baseline %s)' % (r['tree'], r['operation'],
+                                                                    r['round_trips'], b['round_trips']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark treestore operations.')
+    parser.add_argument('-o', '--output', help='JSON file to write results to (default=tests/benchmarks.json)',
+                        default=os.path.join(tests_dir, 'benchmarks.json'))
+    parser.add_argument('-b', '--baseline', help='JSON results to compare with', default=None)
+    parser.add_argument('--tolerance', help='allowed slowdown relative to the baseline (default=0.25)',
+                        type=float, default=0.25)
+    parser.add_argument('--quick', help='only benchmark a few small trees', action='store_true')
+    parser.add_argument('--repeats', help='runs of each operation (default=3)', type=int, default=3)
+    parser.add_argument('--tree', help='only benchmark trees with this name (can be repeated)',
+                        action='append', default=None)
+    parser.add_argument('-s', '--store', help='storage engine (default=a temporary SQLite store)',
+                        default=None)
+    parser.add_argument('--startup-budget', help='maximum startup time in seconds (default=0.25)',
+                        type=float, default=0.25)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    if args.store:
+        from treestore import get_store
+        t = get_store(args.store)()
+    else:
+        from sqlitestore import SqliteTreestore
+        t = SqliteTreestore(db_path=os.path.join(tmp_dir, 'bench.db'), load_dir=tmp_dir)
+    t.stats.enabled = True
+
+    names = datasets(args.quick)
+    if args.tree: names = [(name, path) for name, path in names if name in args.tree]
+
+    results, regressions = startup()
+    for result in results:
+        print '%-28s %-16s %10.4f' % (result['tree'], result['operation'], result['time'])
+        if result['time'] > args.startup_budget:
+            regressions.append('%s takes %.4fs (budget %.4fs)' % (result['operation'], result['time'],
+                                                                 args.startup_budget))
+
+    try:
+        results += run(t, names, repeats=args.repeats)
+    finally:
+        if args.store:
+            for name, path in names: t.remove_trees('bench_%s' % name)
+        t.close()
+        shutil.rmtree(tmp_dir)
+
+    output = {
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'store': args.store or 'sqlite',
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'repeats': args.repeats,
+              'results': results,
+              }
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=1, sort_keys=True)
+    print 'Results written to %s' % args.output
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions += compare(results, json.load(baseline_file), args.tolerance)
+    if regressions:
+        print '\n%s regressions:' % len(regressions)
+        for regression in regressions: print '  %s' % regression
+        sys.exit(1)
+    if args.baseline: print 'No regressions compared with %s' % args.baseline
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''Measure the per-call latency of treestore commands run in their own
+process (--local) and through a `treestore serve` server, using an SQLite
+store and config in a temporary home directory.
+
+Usage:
+    python tests/server_latency.py [--calls 20] [--tree tests/bird0500.new]'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+daemon_path = os.path.join(tests_dir, '..', 'daemon.py')
+
+
+def run(env, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, daemon_path] + list(args), env=env, stdout=devnull)
+
+
+def latency(env, calls, *args):
+    '''Return the median wall time of a command, in seconds.'''
+
+    times = []
+    for _ in range(calls):
+        start_time = time.time()
+        run(env, *args)
+        times.append(time.time() - start_time)
+    return sorted(times)[len(times) / 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare local and server command latency.')
+    parser.add_argument('--calls', help='calls of each command (default=20)', type=int, default=20)
+    parser.add_argument('--tree', help='tree file to query (default=tests/bird0500.new)',
+                        default=os.path.join(tests_dir, 'bird0500.new'))
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp()
+    config_dir = os.path.join(home, '.treestore')
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, 'treestore.config'), 'w') as config_file:
+        config_file.write('[treestore]\nstore = sqlite\ndb_path = %s\nload_dir = %s\n' % (
+                          os.path.join(home, 'treestore.db'), os.path.join(home, 'load')))
+    env = dict(os.environ)
+    env['HOME'] = home
+    env['TREESTORE_SOCKET'] = os.path.join(home, 'treestore.sock')
+
+    server = None
+    try:
+        run(env, '--local', 'add', args.tree, 'bench')
+        names = subprocess.check_output([sys.executable, daemon_path, '--local', 'names', 'bench'],
+                                        env=env).strip().split(',')
+        commands = [
+                    ('ls', ['ls', '-l']),
+                    ('names', ['names', 'bench']),
+                    ('count', ['count', 'bench']),
+                    ('get', ['get', 'bench']),
+                    ('query', ['query', ','.join(names[::10]), 'bench']),
+                    ('query_best_tree', ['query', ','.join(names[::10])]),
+                    ]
+
+        local = [(name, latency(env, args.calls, '--local', *command)) for name, command in commands]
+
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen([sys.executable, daemon_path, 'serve'], env=env, stderr=devnull)
+        while not os.path.exists(env['TREESTORE_SOCKET']): time.sleep(0.05)
+        served = [(name, latency(env, args.calls, *command)) for name, command in commands]
+
+        print '%-16s %10s %10s %8s' % ('command', 'local (s)', 'server (s)', 'speedup')
+        for (name, local_time), (_, served_time) in zip(local, served):
+            print '%-16s %10.4f %10.4f %7.1fx' % (name, local_time, served_time, local_time / served_time)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,20 @@
 from pylab import *
-import cPickle as pkl
+import json
+import sys
 
-data = pkl.load(open('benchmarks.pkl'))
+# plot the results written by benchmark.py
+data = json.load(open(sys.argv[1] if len(sys.argv) > 1 else 'benchmarks.json'))
 
-for key in data:
+series = {}
+for result in data['results']:
+    # startup times don't depend on tree size
+    if result['tree'] == 'startup': continue
+    series.setdefault(result['operation'], []).append((result['size'], result['time']))
+
+for key in sorted(series):
     xs = []
     ys = []
-    for x, y in sorted(data[key].items()):
+    for x, y in sorted(series[key]):
         xs.append(x)
         ys.append(y)
     plot(xs, ys, label=key)
@@ -16,4 +24,4 @@ yscale('log')
 xlabel('tree size (terminal nodes)')
 ylabel('time (seconds)')
 legend()
-show()
\ No newline at end of file
+show()
@@ -1,29 +1,141 @@
 #!/usr/bin/env python
-import Bio.Phylo as bp
+from lazy import lazy_import
 import os
 import re
 import sha
 import shutil
 import sys
-import pypyodbc as pyodbc
-from pruner import Prunable
+import glob
+import threading
+from contextlib import contextmanager
+from pruner import Prunable, write_intervals
+from cache import TreeCache
+from taxonindex import TaxonIndex
+from synonyms import SynonymMap
+from taxonomy import Taxonomy
+from instrument import QueryStats, InstrumentedConnection
+from templates import QueryTemplate, TemplateRegistry, collect_templates
+import daemon
+from pool import ConnectionPool, Lease
+from compact import CompactTree
+from contenthash import tree_hashes, unchanged
+from filters import Filter, compile_filter
+import newick
 from annotate import Annotatable
-from config import get_treestore_kwargs, base_uri, load_dir
+from edit import Editable
+from config import get_treestore_kwargs, config_defaults, base_uri, config_dir
 import tempfile
-import phylolabel
 import time
 from cStringIO import StringIO
 import posixpath
+import json
 from getpass import getpass
-import rdflib
+
+bp = lazy_import('Bio.Phylo')
+pyodbc = lazy_import('pypyodbc')
+multiprocessing = lazy_import('multiprocessing')
 
 
 __version__ = '0.1.2'
 
+# graph holding the version stamp of the whole store
+store_graph = 'http://www.phylocommons.org/terms/store'
+
+
+
+def write_cdao(tree_file, format, output_path, tree_uri=None, rooted=False,
+               taxonomy=None, rows=None):
+    '''Convert the trees in a file to CDAO, written to `output_path` along
+    with their interval index. `taxonomy` is a TaxonLabeler (see 
+    `Treestore.get_taxonomy`) used to label higher-order taxa. If `rows` is a list, the rows of the trees read (see
+    `newick.parse_rows`), before labelling, are added to it.'''
+    
+    if format == 'cdao' and not taxonomy:
+        # if it's already in CDAO format, just copy it
+        if not os.path.abspath(tree_file) == os.path.abspath(output_path):
+            shutil.copy(tree_file, output_path)
+        if rows is not None: rows += newick.cdao_rows(tree_file)
+        return
+    
+    if format == 'newick' and not taxonomy:
+        # stream Newick straight to CDAO, unless the tree's top level isn't in
+        # parentheses
+        try:
+            with open(tree_file) as input_file, open(output_path, 'w') as output_file:
+                newick.write_cdao(input_file, output_file, tree_uri=tree_uri, rooted=rooted,
+                                  rows=rows)
+            return
+        except newick.UnenclosedTree:
+            if rows is not None: del rows[:]
+    
+    trees = list(bp.parse(tree_file, format))
+    if rows is not None: rows += newick.clade_rows([tree.root for tree in trees])
+    if taxonomy:
+        # label higher-order taxa before adding
+        for phylogeny in trees:
+            taxonomy.label_tree(phylogeny)
+    with open(output_path, 'w') as output_file:
+        if taxonomy:
+            bp.write(trees, output_file, 'cdao')
+        else:
+            bp.write(trees, output_file, 'cdao', tree_uri=tree_uri, rooted=rooted)
+        write_intervals(trees, output_file)
+
+
+# options shared by all bulk conversion workers; set by init_worker
+worker_options = {}
+
+def init_worker(options):
+    worker_options.clear()
+    worker_options.update(options)
 
-kwargs = get_treestore_kwargs()
 
-class Treestore(Prunable, Annotatable):
+def convert_file(task):
+    '''Bulk conversion worker: convert one (tree file, tree URI, output path,
+    stored content hashes) task with the `convert` function from the worker
+    options. If the worker options include a content hash `salt`, the trees
+    the converter read are hashed, and the file is skipped if they're the 
+    ones stored already, unless `force` is set. Returns a dictionary 
+    describing the result; errors are reported rather than raised.'''
+    
+    tree_file, tree_uri, output_path, stored = task
+    options = dict(worker_options)
+    convert = options.pop('convert')
+    salt = options.pop('salt')
+    force = options.pop('force')
+    
+    # trees stored from an earlier version of the file are replaced
+    result = {'file': tree_file, 'uri': tree_uri, 'path': output_path, 
+              'data': None, 'error': None, 'hashes': None, 'skipped': False,
+              'replace': bool(stored)}
+    start_time = time.time()
+    try:
+        rows = None if salt is None else []
+        result['data'] = convert(tree_file, output_path=output_path, 
+                                 tree_uri=tree_uri, rows=rows, **options)
+        if salt is not None:
+            hashes = result['hashes'] = tree_hashes(rows, salt)
+            if not force and unchanged(hashes, stored):
+                result['skipped'] = True
+                result['data'] = None
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['convert_time'] = time.time() - start_time
+    
+    return result
+
+
+def expand_files(patterns):
+    '''Expand a list of file names and glob patterns. Patterns that don't 
+    match anything are kept as they are, so they're reported as missing.'''
+    
+    files = []
+    for pattern in patterns:
+        files += sorted(glob.glob(pattern)) or [pattern]
+    return files
+
+
+class Treestore(Prunable, Annotatable, Editable):
     prefixes = [
                 ('rdf', 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'), 
                 ('rdfs', 'http://www.w3.org/2000/01/rdf-schema#'), 
@@ -34,22 +146,41 @@ class Treestore(Prunable, Annotatable):
                 ('foaf', 'http://xmlns.com/foaf/0.1/'), 
                 ('prism', 'http://prismstandard.org/namespaces/basic/2.0/'), 
                 ('obo', 'http://purl.obolibrary.org/obo/'), 
-                ('doi', 'http://dx.doi.org/')
+                ('doi', 'http://dx.doi.org/'),
+                ('ts', 'http://www.phylocommons.org/terms/'),
                 ]
+    # named queries, run with `run_query` (see templates.py)
+    query_templates = {}
 
-    def __init__(self, dsn=kwargs['dsn'], user=kwargs['user'], password=kwargs['password'], 
-                 load_dir=load_dir, base_uri=base_uri, verbose=False):
+    def __init__(self, dsn=None, user=None, password=None, 
+                 load_dir=None, base_uri=base_uri, verbose=False, 
+                 cache_size=None, cache_bytes=None, pool_size=None, **kwargs):
         '''Create a treestore object from an ODBC connection with given DSN,
-        username and password.'''
+        username and password. Each thread using the treestore gets its own
+        connection, from a pool of up to `pool_size` connections. Up to 
+        `cache_size` reconstructed trees, with an estimated total size of 
+        `cache_bytes`, are kept in memory. Options that aren't given are 
+        read from the config file. Other keyword arguments (settings for 
+        other storage engines) are ignored.'''
 
-        self.dsn = dsn
-        self.user = user
-        self.password = password
-        self.load_dir = load_dir
+        options = config_defaults(dsn=dsn, user=user, password=password, load_dir=load_dir,
+                                  cache_size=cache_size, cache_bytes=cache_bytes, 
+                                  pool_size=pool_size)
+        self.dsn = options['dsn']
+        self.user = options['user']
+        self.password = options['password']
+        self.load_dir = options['load_dir']
         self.base_uri = base_uri
         self.verbose = verbose
-        self._connection = None
-        self._cursor = None
+        self.cache = TreeCache(int(options['cache_size']), int(options['cache_bytes']))
+        self.stats = QueryStats()
+        self.templates = TemplateRegistry(collect_templates(self.__class__), self.prefixes)
+        self.pool = ConnectionPool(self.open_connection, int(options['pool_size']),
+                                   check=self.check_connection)
+        self._local = threading.local()
+        self.taxon_index = TaxonIndex(self.taxon_index_path())
+        self.synonym_maps = {}
+        self.taxonomies = {}
 
     @classmethod
     def uri_from_id(self, x, base_uri=base_uri):
@@ -62,27 +193,72 @@ class Treestore(Prunable, Annotatable):
         if x.startswith(base_uri): x = x[len(base_uri):].rstrip('/')
         return x
     
-    def validate_filter(self, x):
-        if not x: return x
+    def compile_filter(self, x):
+        '''Return the compiled Filter for a CQL filter, or None if there 
+        isn't one. Compiled filters are passed through.'''
         
-        for banned_word in 'delete', 'insert':
-            if banned_word in x.lower():
-                raise Exception("Can't use the word %s in a filter." % banned_word)
+        if not x or isinstance(x, Filter): return x or None
+        return compile_filter(x)
+    
+    
+    def store_id(self):
+        '''Return a string identifying the underlying store, used to name
+        files cached for it.'''
         
-        return x
+        return '%s %s' % (self.dsn, self.base_uri)
     
+    def cache_path(self, name, *keys):
+        '''Return the path of a file cached for this store in ~/.treestore,
+        under a name made from `keys`.'''
+        
+        hash = sha.sha()
+        hash.update(' '.join((self.store_id(),) + keys))
+        return os.path.join(config_dir, '%s-%s' % (name, hash.hexdigest()[:16]))
+    
+    def taxon_index_path(self):
+        '''Return the path of the file the taxon index is saved in.'''
+        
+        return self.cache_path('taxa') + '.index'
+    
+    def new_connection(self):
+        return pyodbc.connect('DSN=%s;UID=%s;PWD=%s' % 
+                              (self.dsn, self.user, self.password),
+                              autocommit=True)
+    
+    def open_connection(self):
+        '''Open a new connection whose queries are recorded in `stats`.'''
+        
+        return InstrumentedConnection(self.new_connection(), self.stats)
+    
+    def check_connection(self, connection):
+        '''Raise an exception if a pooled connection no longer works.'''
+        
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+        cursor.close()
     
     def get_connection(self):
-        if not self._connection: 
-            self._connection =pyodbc.connect('DSN=%s;UID=%s;PWD=%s' % 
-                                             (self.dsn, self.user, self.password),
-                                             autocommit=True)
-        return self._connection
+        '''Return this thread's connection, taking one from the pool the 
+        first time it's needed. It's returned to the pool by 
+        `release_connection`, or when the thread exits.'''
+        
+        lease = getattr(self._local, 'lease', None)
+        if lease is None or lease.connection is None:
+            lease = self._local.lease = Lease(self.pool, self.pool.acquire())
+        return lease.connection
+    
+    def release_connection(self, broken=False):
+        '''Return this thread's connection to the pool, e.g. at the end of a
+        request. If `broken` is True, the connection is closed instead.'''
+        
+        lease = getattr(self._local, 'lease', None)
+        if lease: lease.release(broken=broken)
+        self._local.lease = None
     
     def close(self):
-        if self._connection:
-            self._connection.close()
-            self._connection = None
+        self.release_connection()
+        self.pool.close()
     
     def __enter__(self):
         return self
@@ -91,17 +267,60 @@ class Treestore(Prunable, Annotatable):
         self.close()
     
     connection = property(get_connection)
+    
+    @contextmanager
+    def transaction(self):
+        '''Run the queries made in a with block as one transaction, which 
+        is rolled back if the block raises an exception.'''
+        
+        connection = self.connection
+        connection.autocommit = False
+        try:
+            yield
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            connection.autocommit = True
 
     def get_cursor(self, need_new=False):
+        '''Return this thread's cursor, or a new cursor if `need_new` is True.
+        Results that are read lazily (e.g. by a generator) need their own
+        cursor, since the shared one is reused by the next query.'''
+        
         connection = self.connection
         if need_new: return connection.cursor()
-        if not self._cursor: self._cursor = connection.cursor()
-        return self._cursor
+        lease = self._local.lease
+        if not lease.cursor: lease.cursor = connection.cursor()
+        return lease.cursor
+
+    def run_query(self, name, **params):
+        '''Run a query template on this thread's connection, with its 
+        parameters as keyword arguments, and return a cursor with the 
+        results. Each query is prepared once per connection, and then only
+        run with new parameters.'''
+        
+        if self.verbose: print '%s\n%s' % self.templates.query(name, params)
+        return self.templates.execute(self.connection, name, params, self.get_cursor())
+
+    def run_query_many(self, name, rows):
+        '''Run a query template once for each dictionary of parameters in
+        `rows`.'''
+        
+        if not rows: return None
+        if self.verbose: print '%s\n%s' % self.templates.query(name, rows[0])
+        return self.templates.executemany(self.connection, name, rows, self.get_cursor())
 
     def add_trees(self, tree_file, format, tree_uri=None, rooted=False, 
-        taxonomy=None, tax_root=None):
+        taxonomy=None, tax_root=None, force=False):
         '''Convert trees residing in a text file into RDF, and add them to the
-        underlying RDF store with a context node for retrieval.
+        underlying RDF store with a context node for retrieval. 
+        
+        If the trees in the file are the ones already stored under this URI
+        (by content hash), nothing is added and False is returned, unless 
+        `force` is True; otherwise returns True. Trees stored under the URI
+        from another file, or another version of this one, are replaced.
         
         Example:
         >>> treestore.add_trees('test.newick', 'newick', 'http://www.example.org/test/')
@@ -109,51 +328,404 @@ class Treestore(Prunable, Annotatable):
         
         if tree_uri is None: tree_uri = os.path.basename(tree_file)
         else: tree_uri = self.uri_from_id(tree_uri)
+        
+        salt = self.content_salt(rooted, taxonomy, tax_root)
+        stored = self.query_content_hashes(tree_uri).get(tree_uri, set())
 
         hash = sha.sha()
         hash.update(str(time.time()))
         tempfile_name = '%s.cdao' % hash.hexdigest()
 
-        if taxonomy:
-            # label higher-order taxa before adding
-            phylogeny = bp.read(tree_file, format)
-            if isinstance(taxonomy, basestring):
-                taxonomy = self.get_trees(self.uri_from_id(taxonomy))[0]
-            phylolabel.label_tree(phylogeny, taxonomy, tax_root=tax_root)
-            with open(os.path.join(self.load_dir, tempfile_name), 'w') as output_file:
-                bp._io.write([phylogeny], output_file, 'cdao')
-            
+        if isinstance(taxonomy, basestring):
+            taxonomy = self.get_taxonomy(taxonomy, tax_root)
+        # convert to CDAO, adding the interval index, and hash the trees read
+        rows = None if salt is None else []
+        write_cdao(tree_file, format, os.path.join(self.load_dir, tempfile_name),
+                   tree_uri=tree_uri, rooted=rooted, taxonomy=taxonomy, rows=rows)
+        hashes = None if salt is None else tree_hashes(rows, salt)
+        if unchanged(hashes, stored) and not force:
+            os.remove(os.path.join(self.load_dir, tempfile_name))
+            return False
+        
+        # replace the trees and hashes stored from the old file, then run 
+        # the bulk loader to load the CDAO tree into Virtuoso
+        if stored: self.run_query('clear_graph', graph=tree_uri)
+        self.run_query('ld_dir', dir=os.path.abspath(self.load_dir), file=tempfile_name,
+                       graph=tree_uri)
+        self.run_query('rdf_loader_run')
+        
+        # the next treestore add may not work if you don't explicitly delete 
+        # the bulk load list from the Virtuoso db after it's done
+        self.run_query('clear_load_list')
+        
+        os.remove(os.path.join(self.load_dir, tempfile_name))
+        
+        self.set_version(tree_uri)
+        if hashes: self.add_content_hashes(tree_uri, hashes)
+        self.taxon_index.save()
+        return True
+        
+        
+    query_templates['ld_dir'] = QueryTemplate("ld_dir (%(dir)s, %(file)s, %(graph)s)", sql=True)
+    query_templates['rdf_loader_run'] = QueryTemplate('rdf_loader_run()', sql=True)
+    query_templates['load_errors'] = QueryTemplate(
+        'SELECT ll_file, ll_error FROM DB.DBA.load_list WHERE ll_error IS NOT NULL', sql=True)
+    query_templates['clear_load_list'] = QueryTemplate('DELETE FROM DB.DBA.load_list', sql=True)
+    
+    def content_salt(self, rooted=False, taxonomy=None, tax_root=None):
+        '''Return a string describing what, besides the trees in a file,
+        affects what's stored when it's added, to include in content 
+        hashes. Returns None if that can't be known, because the taxonomy 
+        isn't a graph in the store.'''
+        
+        if taxonomy is None: return 'rooted=%s' % bool(rooted)
+        if not isinstance(taxonomy, basestring): return None
+        taxonomy = self.uri_from_id(taxonomy)
+        return 'rooted=%s taxonomy=%s version=%s tax_root=%s' % (
+            bool(rooted), taxonomy, self.get_version(taxonomy), tax_root)
+    
+    
+    query_templates['all_content_hashes'] = '''
+SELECT ?graph ?hash
+WHERE {
+    GRAPH ?graph { ?graph ts:contentHash ?hash }
+}'''
+    query_templates['content_hashes'] = '''
+SELECT ?graph ?hash
+WHERE {
+    GRAPH ?graph { ?graph ts:contentHash ?hash }
+    FILTER (?graph = iri(%(graph)s))
+}'''
+    
+    def query_content_hashes(self, tree_uri=None):
+        '''Return a dictionary of the set of content hashes of the trees
+        added to each graph (or just `tree_uri`).'''
+        
+        if tree_uri is None: cursor = self.run_query('all_content_hashes')
+        else: cursor = self.run_query('content_hashes', graph=tree_uri)
+        
+        hashes = {}
+        for graph, hash in cursor.fetchall():
+            hashes.setdefault(str(graph), set()).add(str(hash))
+        return hashes
+        
+        
+    query_templates['add_content_hash'] = '''
+INSERT INTO GRAPH iri(%(graph)s) { <%(graph)s> ts:contentHash %(hash)s }'''
+    
+    def add_content_hashes(self, tree_uri, hashes):
+        '''Record the content hashes of trees added to a graph.'''
+        
+        self.run_query_many('add_content_hash', [{'graph': tree_uri, 'hash': hash} 
+                                                 for hash in set(hashes)])
+        
+        
+    # function run by bulk conversion workers, called with the arguments of
+    # write_cdao; its return value is passed on to load_files
+    bulk_converter = staticmethod(write_cdao)
+    
+    def add_tree_files(self, files, format='newick', rooted=False, taxonomy=None,
+                       tax_root=None, processes=None, loader_threads=1, force=False):
+        '''Add many tree files at once, each under a URI made from its file 
+        name. `files` can include glob patterns. Files are converted in 
+        parallel by a pool of `processes` worker processes (default: one per
+        CPU), then loaded together in one bulk loader run, using 
+        `loader_threads` concurrent loaders. Files whose trees are the ones
+        stored under their URI already are skipped, unless `force` is True;
+        trees stored under the URI from an earlier version are replaced.
+        
+        Returns a list of dictionaries, one per file, with the `file`, `uri`,
+        `convert_time` and `load_time` (in seconds), whether it was 
+        `skipped`, and an `error` message if the file couldn't be added.
+        
+        Example:
+        >>> treestore.add_tree_files(['trees/*.new'], 'newick', processes=4)
+        '''
+        
+        salt = self.content_salt(rooted, taxonomy, tax_root)
+        stored = self.query_content_hashes()
+        
+        if isinstance(taxonomy, basestring):
+            # workers get a copy of just the part of the taxonomy they need
+            taxonomy = self.get_taxonomy(taxonomy, tax_root)
+        
+        tasks = []
+        for tree_file in expand_files(files):
+            tree_uri = self.uri_from_id(os.path.basename(tree_file))
+            tasks.append((tree_file, tree_uri, 
+                          os.path.join(self.load_dir, '%s.cdao' % new_version()),
+                          frozenset(stored.get(tree_uri, ()))))
+        options = {'convert': self.bulk_converter, 'format': format, 'rooted': rooted,
+                   'taxonomy': taxonomy, 'salt': salt, 'force': force}
+        
+        if processes == 1:
+            init_worker(options)
+            results = map(convert_file, tasks)
         else:
-            if format == 'cdao':
-                # if it's already in CDAO format, just copy it
-                f1, f2 = tree_file, os.path.join(self.load_dir, tempfile_name)
-                if not os.path.abspath(f1) == os.path.abspath(f2):
-                    shutil.copy(f1, f2)
+            pool = multiprocessing.Pool(processes, init_worker, (options,))
+            try:
+                results = pool.map(convert_file, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        
+        for result in results: result['load_time'] = None
+        self.load_files([result for result in results 
+                         if not (result['error'] or result['skipped'])],
+                        rooted=rooted, loader_threads=loader_threads)
+        self.taxon_index.save()
+        for result in results:
+            # remove output left behind by failed conversions
+            if os.path.exists(result['path']): os.remove(result['path'])
+            del result['data'], result['path'], result['hashes'], result['replace']
+        
+        return results
+        
+        
+    def load_files(self, results, rooted=False, loader_threads=1):
+        '''Load files converted by `add_tree_files` with the Virtuoso bulk 
+        loader. All files are registered before a single loader run, so each
+        file's `load_time` is the time taken by the whole run.'''
+        
+        if not results: return
+        
+        self.run_query_many('clear_graph', [{'graph': result['uri']} for result in results
+                                            if result['replace']])
+        self.run_query_many('ld_dir', [{'dir': os.path.abspath(self.load_dir), 
+                                        'file': os.path.basename(result['path']),
+                                        'graph': result['uri']} for result in results])
+        
+        # extra loaders run on their own connections, alongside this one
+        start_time = time.time()
+        loaders = [threading.Thread(target=self.run_loader) 
+                   for _ in range(loader_threads - 1)]
+        for loader in loaders: loader.start()
+        self.run_loader(self.connection)
+        for loader in loaders: loader.join()
+        load_time = time.time() - start_time
+        
+        errors = {os.path.basename(ll_file): ll_error 
+                  for ll_file, ll_error in self.run_query('load_errors').fetchall()}
+        self.run_query('clear_load_list')
+        
+        for result in results:
+            os.remove(result['path'])
+            error = errors.get(os.path.basename(result['path']))
+            if error:
+                result['error'] = error
             else:
-                # otherwise, convert to CDAO
-                bp.convert(tree_file, format, os.path.join(self.load_dir, tempfile_name), 'cdao', 
-                           tree_uri=tree_uri, rooted=rooted)
+                result['load_time'] = load_time
+                self.set_version(result['uri'])
+                if result['hashes']: self.add_content_hashes(result['uri'], result['hashes'])
         
-        # run the bulk loader to load the CDAO tree into Virtuoso
-        cursor = self.get_cursor()
         
-        update_stmt = 'sparql load <file://%s> into %s' % (
-            os.path.abspath(os.path.join(self.load_dir, tempfile_name)), rdflib.URIRef(tree_uri).n3())
+    def run_loader(self, connection=None):
+        '''Run the Virtuoso bulk loader on the files in the load list. Without
+        a connection, a new one is opened for it.'''
         
-        load_stmt = "ld_dir ('%s', '%s', '%s')" % (
-            os.path.abspath(self.load_dir), tempfile_name, tree_uri)
-        print load_stmt
-        cursor.execute(load_stmt)
+        if self.verbose: print 'rdf_loader_run()'
+        if connection:
+            self.templates.execute(connection, 'rdf_loader_run')
+            return
         
-        update_stmt = "rdf_loader_run()"
-        print update_stmt
-        cursor.execute(update_stmt)
+        connection = self.open_connection()
+        try:
+            self.templates.execute(connection, 'rdf_loader_run')
+        finally:
+            connection.close()
         
-        # the next treestore add may not work if you don't explicitly delete 
-        # the bulk load list from the Virtuoso db after it's done
-        cursor.execute('DELETE FROM DB.DBA.load_list')
         
-        os.remove(os.path.join(self.load_dir, tempfile_name))
+    query_templates['version'] = '''
+SELECT ?version
+WHERE {
+    GRAPH <%(graph)s> { <%(graph)s> ts:version ?version }
+}'''
+    
+    def get_version(self, tree_uri):
+        '''Return the version stamp of a graph, which changes whenever the 
+        graph is modified through the treestore.'''
+        
+        result = self.run_query('version', graph=tree_uri).fetchone()
+        return str(result[0]) if result else None
+    
+    
+    query_templates['delete_version'] = '''
+DELETE FROM GRAPH iri(%(graph)s) { <%(graph)s> ts:version ?version }
+WHERE { GRAPH <%(graph)s> { <%(graph)s> ts:version ?version } }'''
+    query_templates['insert_version'] = '''
+INSERT INTO GRAPH iri(%(graph)s) { <%(graph)s> ts:version %(version)s }'''
+    
+    def set_version(self, tree_uri, changes=None):
+        '''Give a graph a new version stamp, drop any cached copy and 
+        reindex its taxa (see `index_taxa`). Returns the new version.'''
+        
+        self.cache.invalidate(tree_uri)
+        
+        version = new_version()
+        self.run_query('delete_version', graph=tree_uri)
+        self.run_query('insert_version', graph=tree_uri, version=version)
+        
+        self.index_taxa(tree_uri, version, changes)
+        self.set_store_version()
+        return version
+        
+        
+    def get_store_version(self):
+        '''Return the version stamp of the whole store, which changes 
+        whenever a tree is added, modified or removed through the 
+        treestore, or None if the store hasn't been stamped yet.'''
+        
+        return self.get_version(store_graph)
+    
+    def set_store_version(self):
+        '''Give the store a new version stamp, after a change that the taxon
+        index has been updated for. Returns the new version.'''
+        
+        old_version = self.get_store_version()
+        version = new_version()
+        self.run_query('delete_version', graph=store_graph)
+        self.run_query('insert_version', graph=store_graph, version=version)
+        
+        self.taxon_index.stamp(old_version, version)
+        return version
+        
+        
+    def index_taxa(self, tree_uri, version, changes=None):
+        '''Reindex the taxa of a tree at a new version. After an edit, 
+        `changes` can be a tuple of (previous version, added labels, removed
+        labels), to update the index without querying all of its labels.'''
+        
+        if changes and self.taxon_index.update(tree_uri, changes[0], version, *changes[1:]):
+            return
+        self.taxon_index.add(tree_uri, version, self.query_tree_labels(tree_uri))
+        
+        
+    query_templates['tree_versions'] = '''
+SELECT DISTINCT ?graph ?version
+WHERE {
+    GRAPH ?graph {
+        ?tree obo:CDAO_0000148 [] .
+        OPTIONAL { ?graph ts:version ?version }
+    }
+}'''
+    
+    def query_tree_versions(self):
+        '''Return a dictionary of the version stamp of every tree.'''
+        
+        return {str(graph): str(version) if version else None
+                for graph, version in self.run_query('tree_versions').fetchall()}
+        
+        
+    query_templates['tree_labels'] = '''
+SELECT DISTINCT ?label
+WHERE {
+    GRAPH <%(graph)s> { ?x rdfs:label ?label }
+}'''
+    
+    def query_tree_labels(self, tree_uri):
+        '''Return the distinct labels in a tree.'''
+        
+        return [result[0] for result in self.run_query('tree_labels', graph=tree_uri).fetchall()]
+        
+        
+    query_templates['all_tree_tips'] = '''
+SELECT ?graph (COUNT(DISTINCT ?tip) AS ?tips)
+WHERE {
+    GRAPH ?graph { ?tip a obo:CDAO_0000108 }
+}
+GROUP BY ?graph'''
+    query_templates['tree_tips'] = '''
+SELECT ?graph (COUNT(DISTINCT ?tip) AS ?tips)
+WHERE {
+    GRAPH ?graph { ?tip a obo:CDAO_0000108 }
+    FILTER (?graph = iri(%(graph)s))
+}
+GROUP BY ?graph'''
+    query_templates['all_tree_citations'] = '''
+SELECT DISTINCT ?graph ?citation
+WHERE {
+    GRAPH ?graph { ?tree obo:CDAO_0000148 [] ; bibo:cites ?citation }
+}'''
+    query_templates['tree_citations'] = '''
+SELECT DISTINCT ?graph ?citation
+WHERE {
+    GRAPH ?graph { ?tree obo:CDAO_0000148 [] ; bibo:cites ?citation }
+    FILTER (?graph = iri(%(graph)s))
+}'''
+    
+    def query_tree_info(self, tree_uri=None):
+        '''Return the number of tips and the citations of a tree (or all 
+        trees), as a dictionary of {tree URI: {'tips': number of tips, 
+        'citations': tuple of URIs}}.'''
+        
+        if tree_uri is None: tips, citations, params = 'all_tree_tips', 'all_tree_citations', {}
+        else: tips, citations, params = 'tree_tips', 'tree_citations', {'graph': tree_uri}
+        info = {}
+        
+        for uri, count in self.run_query(tips, **params).fetchall():
+            info[str(uri)] = {'tips': int(count), 'citations': ()}
+        
+        for uri, citation in self.run_query(citations, **params).fetchall():
+            tree_info = info.setdefault(str(uri), {'tips': 0, 'citations': ()})
+            tree_info['citations'] += (str(citation),)
+        
+        return info
+        
+        
+    def get_taxonomy(self, taxonomy, tax_root=None):
+        '''Return a TaxonLabeler for labeling trees with a taxonomy graph,
+        subset to the clade named `tax_root` if given. The taxonomy is only
+        reconstructed once for each version of the graph, and each subset's
+        lookup tables are only built once, so many trees can be labeled 
+        against them.'''
+        
+        taxonomy = self.uri_from_id(taxonomy)
+        version = self.get_version(taxonomy)
+        
+        cached = self.taxonomies.get(taxonomy)
+        if cached is None or cached.version != version:
+            cached = Taxonomy(self.get_compact_tree(taxonomy), version)
+            self.taxonomies[taxonomy] = cached
+        
+        return cached.subset(tax_root)
+        
+        
+    def get_synonyms(self, taxonomy):
+        '''Return the SynonymMap of a taxonomy graph. Maps are compiled the 
+        first time they're needed for each version of the taxonomy, and kept
+        in memory and on disk.'''
+        
+        taxonomy = self.uri_from_id(taxonomy)
+        version = self.get_version(taxonomy)
+        
+        synonyms = self.synonym_maps.get(taxonomy)
+        if synonyms is not None and synonyms.version == version: return synonyms
+        
+        path = self.cache_path('synonyms', taxonomy)
+        synonyms = SynonymMap.load(path, version)
+        if synonyms is None:
+            synonyms = SynonymMap.from_rows(self.query_synonym_rows(taxonomy), version)
+            synonyms.save(path)
+        
+        self.synonym_maps[taxonomy] = synonyms
+        return synonyms
+        
+        
+    def get_taxon_index(self, info=False):
+        '''Return the taxon index, after reindexing any trees that were 
+        added, changed or removed since it was last updated. Only the
+        store's version stamp is queried if nothing has changed since. If
+        `info` is True, the tip counts and citations of trees are brought 
+        up to date too.'''
+        
+        store_version = self.get_store_version()
+        if store_version is None:
+            with self.transaction(): store_version = self.set_store_version()
+        if not self.taxon_index.synced(store_version):
+            self.taxon_index.sync(self.query_tree_versions(), self.query_tree_labels, 
+                                  store_version)
+        if info: self.taxon_index.sync_info(self.query_tree_info)
+        return self.taxon_index
         
         
     def get_trees(self, tree_uri):
@@ -168,7 +740,39 @@ class Treestore(Prunable, Annotatable):
         
         tree_uri = self.uri_from_id(tree_uri)
         
-        return [self.subtree(None, tree_uri)]
+        return [self.get_compact_tree(tree_uri).to_phylo()]
+        
+        
+    def get_compact_tree(self, tree_uri, version=None):
+        '''Retrieve a tree as a CompactTree, from the cache if its current
+        version (or `version`, if it's been looked up) is there. Cached 
+        trees are shared, so they shouldn't be modified.'''
+        
+        if not self.cache.enabled:
+            with self.stats.phase('reconstruct'):
+                return CompactTree.from_rows(self.query_nodes(tree_uri))
+        
+        if version is None: version = self.get_version(tree_uri)
+        tree = self.cache.get(tree_uri, version)
+        if tree is None:
+            with self.stats.phase('reconstruct'):
+                tree = CompactTree.from_rows(self.query_nodes(tree_uri))
+            self.cache.put(tree_uri, version, tree, tree.nbytes())
+        
+        return tree
+        
+        
+    def cached_tree(self, tree_uri):
+        '''Return the CompactTree of the current version of a tree for a
+        query of part of it, if it's cached, or None if the query should
+        fetch just the nodes it needs. Trees that keep being queried are
+        reconstructed whole and cached (see `TreeCache.note_miss`).'''
+        
+        if not self.cache.enabled: return None
+        version = self.get_version(tree_uri)
+        if self.cache.peek(tree_uri, version) is None and not self.cache.note_miss(tree_uri):
+            return None
+        return self.get_compact_tree(tree_uri, version)
 
     def serialize_trees(self, tree_uri='', format='newick', trees=None, handle=None):
         '''Retrieve trees serialized to any format supported by Biopython.
@@ -185,21 +789,37 @@ class Treestore(Prunable, Annotatable):
         if tree_uri: tree_uri = self.uri_from_id(tree_uri)
         
         if trees is None: 
-            trees = [(x for x in self.get_trees(tree_uri)).next()]
+            trees = [self.get_compact_tree(tree_uri)]
         if not trees:
             raise Exception('Tree to be serialized not found.')
-
-        if format == 'cdao':
-            bp.write(trees, s, format, tree_uri=tree_uri)
-        elif format == 'ascii':
-            bp._utils.draw_ascii((i for i in trees).next(), file=s)
-        else:
-            bp.write(trees, s, format)
+        
+        with self.stats.phase('serialize'):
+            if format in ('newick', 'ascii') and all(isinstance(tree, CompactTree) for tree in trees):
+                # write directly from the node arrays, without building clades
+                if format == 'newick':
+                    for tree in trees: tree.write_newick(s)
+                else:
+                    trees[0].write_ascii(s)
+                
+                if handle: return
+                return s.getvalue()
+            
+            trees = [tree.to_phylo() if isinstance(tree, CompactTree) else tree
+                     for tree in trees]
+            
+            if format == 'cdao':
+                bp.write(trees, s, format, tree_uri=tree_uri)
+            elif format == 'ascii':
+                bp._utils.draw_ascii((i for i in trees).next(), file=s)
+            else:
+                bp.write(trees, s, format)
 
         if handle: return
         return s.getvalue()
 
 
+    query_templates['clear_graph'] = 'CLEAR GRAPH iri(%(graph)s)'
+    
     def remove_trees(self, tree_uri):
         '''Remove trees from treestore. Be careful with this; it really just
         removes a named graph, so if Virtuoso contains named graphs other than
@@ -211,8 +831,12 @@ class Treestore(Prunable, Annotatable):
         
         tree_uri = self.uri_from_id(tree_uri)
         
-        cursor = self.get_cursor()
-        cursor.execute('sparql clear graph %s' % rdflib.URIRef(tree_uri).n3())
+        self.run_query('clear_graph', graph=tree_uri)
+        
+        self.cache.invalidate(tree_uri)
+        self.taxon_index.remove(tree_uri)
+        self.set_store_version()
+        self.taxon_index.save()
 
 
     def list_trees(self, **kwargs):
@@ -221,70 +845,37 @@ class Treestore(Prunable, Annotatable):
         return self.list_trees_containing_taxa(**kwargs)
 
 
-    def list_trees_containing_taxa(self, contains=[], show_counts=False, taxonomy=None, filter=None):
-        '''List all trees that contain the specified taxa.'''
+    def list_trees_containing_taxa(self, contains=[], show_counts=False, taxonomy=None, filter=None,
+                                   limit=None):
+        '''List all trees that contain the specified taxa, with the most 
+        matches first. Only the top `limit` trees are listed, if given.
+        Trees are ranked by the taxon index instead of a query across all 
+        graphs. Synonyms of each taxon from `taxonomy` also count as matches.
+        Only trees matching `filter`, a CQL filter (see filters.py), are 
+        listed.'''
 
-        filter = self.validate_filter(filter)
+        filter = self.compile_filter(filter)
+        synonyms = self.get_synonyms(taxonomy).expand(contains) if taxonomy and contains else {}
         
-        taxa_list = ', '.join([rdflib.Literal(contain).n3() for contain in contains])
-        # TODO: if filter: sanitize filter
-        
-        query = '''
-SELECT DISTINCT ?graph (count(DISTINCT ?label) as ?matches)
-WHERE {
-{
-    GRAPH ?graph {
-        ?tree obo:CDAO_0000148 [] .
-        '''
-        if contains:
-            query += '{ ?match rdfs:label ?label . FILTER (?label in (%s)) }' % taxa_list
-        if filter:
-            query += filter
-        query += '''
-    }
-}
-'''
+        index = self.get_taxon_index(info=filter and filter.needs_info)
+        trees = index.select(filter, self.id_from_uri) if filter else None
+        for tree_uri, matches in index.search(contains, limit, synonyms, trees):
+            if show_counts: yield (tree_uri, matches)
+            else: yield tree_uri
 
-        # optional synonym matching
-        if taxonomy and contains:
-            taxonomy = self.uri_from_id(taxonomy)
-            query += '''
-UNION {
-    GRAPH ?graph { 
-        ?tree obo:CDAO_0000148 [] .
-        ?t obo:CDAO_0000187 [ rdfs:label ?synonym ] . %s 
-    }
-    GRAPH %s {
-        ?x obo:CDAO_0000187 [ ?l1 ?synonym ; ?l2 ?label ]
-        FILTER (?label in (%s) &&
-                ?l1 in (rdfs:label, skos:altLabel) &&
-                ?l2 in (rdfs:label, skos:altLabel))
-    }
-}''' % (filter if filter else '', rdflib.URIRef(taxonomy).n3(), taxa_list)
 
-        # end of query
-        query += '''
-}
-GROUP BY ?graph
-ORDER BY DESC(?matches) CONTAINS(STR(?graph), "_taxonomy") ?graph
-'''
-        query = self.build_query(query)
-        cursor = self.get_cursor()
-        if self.verbose: print query
-        cursor.execute(query)
+    def get_names(self, tree_uri=None, format=None, handle=None):
+        '''Return the names in a tree (or all trees) as a list, or as a JSON
+        or CSV string. JSON and CSV are written to `handle` instead, if 
+        given, as names are fetched.'''
         
-        for result in cursor:
-            if show_counts: yield (result[0], result[1])
-            else: yield (result[0])
-
-
-    def get_names(self, tree_uri=None, format=None):
-        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
-
-        query = '''sparql
-PREFIX obo: <http://purl.obolibrary.org/obo/>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
+        return self.format_names(self.iter_names(tree_uri), format, handle)
+    
+    # number of names fetched by each query in `iter_names`
+    names_page_size = 10000
+    
+    # pages are read with a new offset each time, so aren't kept prepared
+    names_page = '''
 SELECT DISTINCT ?uri, ?label
 WHERE {
     GRAPH %s {
@@ -292,50 +883,83 @@ WHERE {
         ?uri rdfs:label ?label .
     }
 }
-ORDER BY ?label
-''' % ((rdflib.URIRef(tree_uri).n3()) if tree_uri else '?graph')
+ORDER BY ?label ?uri
+LIMIT %%(limit!)s
+OFFSET %%(offset!)s
+'''
+    query_templates['all_names_page'] = QueryTemplate(names_page % '?graph', prepare=False)
+    query_templates['names_page'] = QueryTemplate(names_page % '<%(graph)s>', prepare=False)
+    del names_page
+    
+    def iter_names(self, tree_uri=None):
+        '''Iterate over (node id, name) rows for the labeled nodes in a tree
+        (or all trees), ordered by name. Names are fetched a page at a 
+        time, so the whole list is never held in memory.'''
         
-        cursor = self.get_cursor()
-        if self.verbose: print query
-        cursor.execute(query)
-
-        results = cursor
+        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
         
-        if format == 'json':
-            metadata = {
-                "version":"",
-                "treestoreMetadata":{
-                    "treestoreShortName":"rdf_treestore",
-                    "treestoreLongName":"Phylotastic RDF Treestore",
-                    "domain":"",
-                    "urlPrefix":"",
-                }
+        offset = 0
+        while True:
+            if tree_uri: 
+                cursor = self.run_query('names_page', graph=tree_uri, 
+                                        limit=self.names_page_size, offset=offset)
+            else:
+                cursor = self.run_query('all_names_page', limit=self.names_page_size, 
+                                        offset=offset)
+            rows = cursor.fetchall()
+            for row in rows: yield row
+            if len(rows) < self.names_page_size: break
+            offset += len(rows)
+    
+    count_names_query = '''
+SELECT (COUNT(*) AS ?count)
+WHERE {
+    {
+        SELECT DISTINCT ?uri, ?label
+        WHERE {
+            GRAPH %s {
+                [] obo:CDAO_0000148 [] .
+                ?uri rdfs:label ?label .
             }
-
-            json_dict = {'metadata': {}, 'externalSources': {},
-                         'names': [{
-                                    'name': str(result[1]),
-                                    'treestoreId': str(result[0]),
-                                    'sourceIds': {},
-                                    }
-                                   for result in results
-                                   ]
-                        }
-            return repr(json_dict)
-        elif format == 'csv':
-            return ','.join(sorted(list(set([str(result[1]) for result in results]))))
-        else: 
-            return [str(result[1]) for result in results]
+        }
+    }
+}
+'''
+    query_templates['count_all_names'] = count_names_query % '?graph'
+    query_templates['count_names'] = count_names_query % '<%(graph)s>'
+    del count_names_query
+    
+    def count_names(self, tree_uri=None):
+        '''Return the number of labeled nodes in a tree (or all trees).'''
         
+        if tree_uri: 
+            cursor = self.run_query('count_names', graph=self.uri_from_id(tree_uri))
+        else:
+            cursor = self.run_query('count_all_names')
+        return int(cursor.fetchone()[0])
         
-    def build_query(self, query):
-        return 'sparql\n' + '\n'.join(['PREFIX %s: <%s>' % x for x in self.prefixes]) + query
         
+    def format_names(self, results, format=None, handle=None):
+        '''Format (id, name) result rows from a name query as a JSON string, 
+        a CSV string or a list of names. JSON and CSV are written to 
+        `handle` instead, if given.'''
         
-    def get_tree_info(self, tree_uri=None):
-        if tree_uri: tree_uri = self.uri_from_id(tree_uri)
+        if not format in ('json', 'csv'):
+            return [text(result[1]) for result in results]
         
-        query = self.build_query('''
+        if handle: s = handle
+        else: s = StringIO()
+        
+        if format == 'json':
+            write_json_names(results, s)
+        else:
+            write_csv_names(results, s)
+        
+        if handle: return
+        return s.getvalue()
+        
+        
+    tree_info_query = '''
 SELECT ?graph (count(?otu) as ?taxa) ?citation
 WHERE {
     GRAPH ?graph {
@@ -346,43 +970,107 @@ WHERE {
     %s
 } 
 ORDER BY ?graph
-''' % ('' if tree_uri is None else ('FILTER(?graph = %s)' % rdflib.URIRef(tree_uri).n3())))
-        cursor = self.get_cursor()
-        if self.verbose: print query
-        cursor.execute(query)
+'''
+    query_templates['all_tree_info'] = tree_info_query % ''
+    query_templates['tree_info'] = tree_info_query % 'FILTER (?graph = iri(%(graph)s))'
+    del tree_info_query
+        
+    def get_tree_info(self, tree_uri=None):
+        if tree_uri: cursor = self.run_query('tree_info', graph=self.uri_from_id(tree_uri))
+        else: cursor = self.run_query('all_tree_info')
         
         return [{k:v for k, v in zip(('tree', 'taxa', 'citation'), result) } for result in cursor]
     
-    def get_object_info(self, object):
-        query = '''sparql
+    query_templates['object_info'] = '''
 SELECT ?v ?o
 WHERE
 {
-    ?s ?v ?o .
-    FILTER (?s = %s)
-}''' % rdflib.URIRef(object).n3()
+    <%(object)s> ?v ?o .
+}'''
+    
+    def get_object_info(self, object):
+        '''Return the (predicate, object) rows of an object's triples.'''
+        
+        # fetched, since the prepared cursor is reused by the next call
+        return self.run_query('object_info', object=object).fetchall()
 
-        cursor = self.get_cursor(True)
-        if self.verbose: print query
-        cursor.execute(query)
 
-        return cursor
+def text(value):
+    '''Return a name as a (UTF-8 encoded) string.'''
+    
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
 
+def write_json_names(results, handle):
+    '''Write (id, name) rows to a file handle as a JSON name list, one name
+    per line.'''
+    
+    handle.write('{"metadata": {}, "externalSources": {}, "names": [')
+    separator = '\n'
+    for result in results:
+        handle.write(separator)
+        handle.write('{"name": %s, "sourceIds": {}, "treestoreId": %s}' % (
+                     json.dumps(text(result[1])), json.dumps(text(result[0]))))
+        separator = ',\n'
+    handle.write('\n]}')
+
+
+def write_csv_names(results, handle):
+    '''Write the distinct names in (id, name) rows, which must be sorted by
+    name, to a file handle as a single comma-separated row.'''
+    
+    last = None
+    for result in results:
+        name = text(result[1])
+        if name == last: continue
+        if last is not None: handle.write(',')
+        if any(c in name for c in ',"\r\n'): 
+            handle.write('"%s"' % name.replace('"', '""'))
+        else:
+            handle.write(name)
+        last = name
+
+
+def new_version():
+    '''Generate a unique version stamp for a graph.'''
+    
+    return os.urandom(16).encode('hex')
+
+
+def get_store(store='virtuoso'):
+    '''Return the Treestore class implementing the named storage engine.'''
+    
+    if store == 'virtuoso':
+        return Treestore
+    elif store == 'sqlite':
+        from sqlitestore import SqliteTreestore
+        return SqliteTreestore
+    
+    raise Exception('Unknown store: %s' % store)
+
+
+def make_parser():
+    '''Return the argument parser for the treestore command.'''
 
-def main():
     import argparse
 
-    bp_formats = ' | '.join(bp._io.supported_formats)
+    # Biopython's formats are listed here rather than looked up, so that
+    # building the parser doesn't import it
+    bp_formats = 'newick | nexus | nexml | phyloxml | cdao'
     input_formats = bp_formats
     output_formats = '%s | ascii' % bp_formats
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('-v', '--verbose', action='store_true', help='write out SPARQL queries before executing')
-    parser.add_argument('-s', '--store', help='name of Redland store (default=virtuoso)')
+    parser.add_argument('--profile', action='store_true', 
+                        help='write a breakdown of the time spent in queries and in each phase of the command to stderr')
+    parser.add_argument('-s', '--store', help='storage engine (virtuoso | sqlite) (default=virtuoso)')
     parser.add_argument('-d', '--dsn', help='ODBC DSN (default=Virtuoso)')
     parser.add_argument('-u', '--user', help='ODBC user (default=dba)')
     parser.add_argument('-p', '--password', help='ODBC password (default=dba)')
+    parser.add_argument('--local', action='store_true',
+                        help='run the command in this process, even if a treestore server is running')
 
     subparsers = parser.add_subparsers(help='sub-command help', dest='command')
     
@@ -397,6 +1085,26 @@ def main():
                             nargs='?', default=None)
     add_parser.add_argument('--tax-root', help="the name of the top-most taxonomic group in the tree, used to subset the taxonomy and avoid homonymy issues",
                             nargs='?', default=None)
+    add_parser.add_argument('--force', help="add the trees even if they're already stored under this uri",
+                            action='store_true')
+    
+    # treestore load: add many tree files at once
+    load_parser = subparsers.add_parser('load', help='add many tree files to treestore in parallel')
+    load_parser.add_argument('files', help='tree files or glob patterns; each tree uri is the file name', 
+                             nargs='+')
+    load_parser.add_argument('-f', '--format', help='file format (%s)' % input_formats,
+                             nargs='?', default='newick')
+    load_parser.add_argument('--rooted', help='these are rooted trees', action='store_true')
+    load_parser.add_argument('--taxonomy', help="the URI of a taxonomy graph to label higher-order taxa",
+                             nargs='?', default=None)
+    load_parser.add_argument('--tax-root', help="the name of the top-most taxonomic group in the trees",
+                             nargs='?', default=None)
+    load_parser.add_argument('-j', '--processes', help='number of conversion processes (default=number of CPUs)',
+                             type=int, default=None)
+    load_parser.add_argument('--loader-threads', help='number of concurrent bulk loaders (default=1)',
+                             type=int, default=1)
+    load_parser.add_argument('--force', help="add files even if their trees are already stored",
+                             action='store_true')
     
     # treestore get: download an entire tree
     get_parser = subparsers.add_parser('get', help='retrieve trees from treestore')
@@ -420,7 +1128,7 @@ def main():
                            action='store_true')
     ls_parser.add_argument('--taxonomy', help="the URI of a taxonomy graph to enable synonymy lookup",
                            nargs='?', default=None)
-    ls_parser.add_argument('--filter', help="SPARQL graph pattern that returned trees must match",
+    ls_parser.add_argument('--filter', help="CQL filter that listed trees must match, e.g. 'tips > 100 and citation = URI'",
                            nargs='?', default=None)
     
     # treestore names: get list of taxa contained in a tree
@@ -428,7 +1136,7 @@ def main():
                                          help='return a comma-separated list of all taxa names')
     names_parser.add_argument('uri', help='tree uri (default=all trees)', 
                               nargs='?', default=None)
-    names_parser.add_argument('-f', '--format', help='file format (json, csv, xml) (default=csv)', 
+    names_parser.add_argument('-f', '--format', help='file format (json, csv, or list for one name per line) (default=csv)', 
                               default='csv')
     
     # treestore count: count the number of labeled nodes
@@ -440,7 +1148,7 @@ def main():
     # treestore query: create a subtree from a list of taxa
     query_parser = subparsers.add_parser('query', 
                                          help='retrieve the best subtree containing a given set of taxa')
-    query_parser.add_argument('contains', help='comma-delimited list of desired taxa',
+    query_parser.add_argument('contains', help='comma-delimited list of desired taxa (omitted with --batch)',
                               nargs='?')
     query_parser.add_argument('uri', help='tree uri (default=select automatically)', 
                               nargs='?', default=None)
@@ -450,8 +1158,12 @@ def main():
                               action='store_true')
     query_parser.add_argument('--taxonomy', help="the URI of a taxonomy graph to enable synonymy lookup",
                               nargs='?', default=None)
-    query_parser.add_argument('--filter', help="SPARQL graph pattern that returned trees must match",
+    query_parser.add_argument('--filter', help="CQL filter that the selected tree must match, e.g. 'tips > 100 and citation = URI'",
                               nargs='?', default=None)
+    query_parser.add_argument('--batch', help="file with one comma-delimited list of taxa per line; each subtree is written as the line number and Newick tree, in the order they're finished",
+                              default=None)
+    query_parser.add_argument('-j', '--processes', help='number of processes for --batch (default=number of CPUs)',
+                              type=int, default=None)
     
     # treestore annotate: add metadata annotations to tree
     ann_parser = subparsers.add_parser('annotate', help='annotate tree with triples from RDF file')
@@ -459,20 +1171,108 @@ def main():
     ann_parser.add_argument('--file', help='annotation file')
     ann_parser.add_argument('--text', help='annotation, in turtle format', default=None)
     ann_parser.add_argument('--doi', help='tree source DOI', default=None)
+    
+    # treestore edit: change a stored tree in place
+    edit_parser = subparsers.add_parser('edit', help='edit a stored tree in place')
+    edit_subparsers = edit_parser.add_subparsers(help='edit help', dest='edit')
+    graft_parser = edit_subparsers.add_parser('graft', 
+                                              help='graft the trees in a file under the MRCA of a set of taxa')
+    graft_parser.add_argument('uri', help='tree uri')
+    graft_parser.add_argument('taxa', help='comma-delimited list of taxa')
+    graft_parser.add_argument('file', help='tree file')
+    graft_parser.add_argument('-f', '--format', help='file format (%s)' % input_formats,
+                              nargs='?', default='newick')
+    prune_parser = edit_subparsers.add_parser('prune', 
+                                              help='remove the clade descended from the MRCA of a set of taxa')
+    prune_parser.add_argument('uri', help='tree uri')
+    prune_parser.add_argument('taxa', help='comma-delimited list of taxa')
+    relabel_parser = edit_subparsers.add_parser('relabel', help='rename a taxon')
+    relabel_parser.add_argument('uri', help='tree uri')
+    relabel_parser.add_argument('old', help='current name')
+    relabel_parser.add_argument('new', help='new name')
+    length_parser = edit_subparsers.add_parser('length', 
+                                               help='set the length of the branch leading to the MRCA of a set of taxa')
+    length_parser.add_argument('uri', help='tree uri')
+    length_parser.add_argument('taxa', help='comma-delimited list of taxa')
+    length_parser.add_argument('length', help='branch length', type=float)
+    
+    # treestore serve: keep a store open and run commands sent by clients
+    serve_parser = subparsers.add_parser('serve', 
+                                         help='run a server that keeps connections and caches warm; other treestore commands are sent to it while it runs')
+    serve_parser.add_argument('--socket', help='Unix socket to listen on (default=$TREESTORE_SOCKET or ~/.treestore/treestore.sock)',
+                              default=None)
 
-    args = parser.parse_args()
+    return parser
 
-    if args.dsn: kwargs['dsn'] = args.dsn
-    if args.user: kwargs['user'] = args.user
-    if args.password: kwargs['password'] = args.password
-    elif not 'password' in kwargs: password = getpass()
-    kwargs['verbose'] = args.verbose
-    treestore = Treestore(**kwargs)
 
+def store_kwargs(args):
+    '''Return the options used to open a store for parsed command-line
+    arguments, with defaults from the config file.'''
+    
+    options = get_treestore_kwargs()
+    if args.dsn: options['dsn'] = args.dsn
+    if args.user: options['user'] = args.user
+    if args.password: options['password'] = args.password
+    elif not 'password' in options: password = getpass()
+    options['verbose'] = args.verbose
+    if args.store: options['store'] = args.store
+    return options
+
+
+# profiled commands run one at a time on a server, since they share the
+# store's statistics
+profile_lock = threading.Lock()
+
+def run_command(treestore, args):
+    '''Run a parsed command against a store, writing its output to
+    sys.stdout, and return its exit status.'''
+    
+    if not args.profile: return dispatch_command(treestore, args)
+    
+    with profile_lock:
+        treestore.stats.reset()
+        treestore.stats.enabled = True
+        templates = treestore.templates.summary()
+        try:
+            return dispatch_command(treestore, args)
+        finally:
+            treestore.stats.enabled = False
+            treestore.stats.report(sys.stderr)
+            treestore.templates.report(sys.stderr, since=templates)
+
+
+def dispatch_command(treestore, args):
     if args.command == 'add':
         # parse a tree and add it to the treestore
-        treestore.add_trees(args.file, args.format, args.uri, rooted=args.rooted,
-                            taxonomy=args.taxonomy, tax_root=args.tax_root)
+        if not treestore.add_trees(args.file, args.format, args.uri, rooted=args.rooted,
+                                   taxonomy=args.taxonomy, tax_root=args.tax_root,
+                                   force=args.force):
+            print '%s\tunchanged, skipped' % args.file
+        
+    elif args.command == 'load':
+        # add many trees, reporting the time taken by (or failure of) each file
+        start_time = time.time()
+        results = treestore.add_tree_files(args.files, args.format, rooted=args.rooted,
+                                           taxonomy=args.taxonomy, tax_root=args.tax_root,
+                                           processes=args.processes, 
+                                           loader_threads=args.loader_threads,
+                                           force=args.force)
+        failed = [result for result in results if result['error']]
+        skipped = [result for result in results if result['skipped']]
+        for result in results:
+            if result['error']:
+                sys.stderr.write('%s\tfailed: %s\n' % (result['file'], result['error']))
+            elif result['skipped']:
+                print '%s\t%s\tunchanged, skipped' % (
+                    result['file'], treestore.id_from_uri(result['uri']))
+            else:
+                print '%s\t%s\tconvert %.2fs\tload %.2fs' % (
+                    result['file'], treestore.id_from_uri(result['uri']), 
+                    result['convert_time'], result['load_time'])
+        print 'Added %s of %s files (%s unchanged) in %.2fs' % (
+            len(results) - len(failed) - len(skipped), len(results), len(skipped),
+            time.time() - start_time)
+        if failed: return 1
         
     elif args.command == 'get':
         # get a tree, serialize in specified format, and output to stdout
@@ -495,7 +1295,7 @@ def main():
         else:
             trees = list(treestore.list_trees(filter=args.filter))
         
-        if not trees: exit()
+        if not trees: return 0
 
         if not args.f:
             trees = [treestore.id_from_uri(x) for x in trees]
@@ -508,23 +1308,127 @@ def main():
 
 
     elif args.command == 'names':
-        print treestore.get_names(tree_uri=args.uri, format=args.format)
+        if args.format in ('json', 'csv'):
+            treestore.get_names(tree_uri=args.uri, format=args.format, handle=sys.stdout)
+            sys.stdout.write('\n')
+        else:
+            for name in treestore.get_names(tree_uri=args.uri, format=args.format): print name
 
     elif args.command == 'count':
-        print len([r for r in treestore.get_names(tree_uri=args.uri, format=None)])
+        print treestore.count_names(tree_uri=args.uri)
 
+    elif args.command == 'query' and args.batch:
+        # with --batch, the only positional argument is the tree uri
+        return run_batch(treestore, args.batch, tree_uri=args.uri or args.contains,
+                         format=args.format, prune=not args.complete,
+                         taxonomy=treestore.uri_from_id(args.taxonomy) if args.taxonomy else None,
+                         filter=args.filter, processes=args.processes)
+        
     elif args.command == 'query':
-        contains = set([s.strip() for s in args.contains.split(',')])
+        contains = set([s.strip() for s in (args.contains or '').split(',') if s.strip()])
+        unresolved = []
         treestore.get_subtree(contains=contains, tree_uri=args.uri,
                               format=args.format, 
                               prune=not args.complete,
                               taxonomy=treestore.uri_from_id(args.taxonomy) if args.taxonomy else None,
                               filter=args.filter,
                               handle=sys.stdout,
+                              unresolved=unresolved,
                               )
+        if unresolved:
+            sys.stderr.write('Taxa not found in tree: %s\n' % ', '.join(sorted(unresolved)))
 
     elif args.command == 'annotate':
         treestore.annotate(args.uri, annotations=args.text, annotation_file=args.file, doi=args.doi)
+    
+    elif args.command == 'edit':
+        taxa = [s.strip() for s in getattr(args, 'taxa', '').split(',') if s.strip()]
+        if args.edit == 'graft':
+            treestore.graft_trees(args.uri, taxa, args.file, args.format)
+        elif args.edit == 'prune':
+            treestore.prune_clade(args.uri, taxa)
+        elif args.edit == 'relabel':
+            treestore.relabel_taxa(args.uri, {args.old: args.new})
+        elif args.edit == 'length':
+            treestore.set_branch_length(args.uri, taxa, args.length)
+    
+    return 0
+
+
+def run_batch(treestore, batch_file, tree_uri=None, format='newick', prune=True,
+              taxonomy=None, filter=None, processes=None):
+    '''Run a batch of queries from a file with one comma-delimited list of
+    taxa per line, writing each subtree to stdout as its line number and 
+    tree, as it's finished. Problems with a query are written to stderr 
+    along with its line number. Returns the exit status.'''
+    
+    if format != 'newick': raise Exception('Batch queries can only be written as newick.')
+    
+    lines = []
+    queries = []
+    with open(batch_file) as input_file:
+        for n, line in enumerate(input_file, 1):
+            taxa = set([s.strip() for s in line.split(',') if s.strip()])
+            if not taxa: continue
+            lines.append(n)
+            queries.append(sorted(taxa))
+    
+    failed = 0
+    for result in treestore.get_subtrees(queries, tree_uri=tree_uri, prune=prune, 
+                                         filter=filter, taxonomy=taxonomy, 
+                                         processes=processes):
+        n = lines[result['index']]
+        if result['error']:
+            failed += 1
+            sys.stderr.write('%s\t%s\n' % (n, result['error']))
+            continue
+        if result['unresolved']:
+            sys.stderr.write('%s\tTaxa not found in tree: %s\n' % (
+                n, ', '.join(sorted(result['unresolved']))))
+        sys.stdout.write('%s\t%s' % (n, result['tree']))
+    
+    return 1 if failed else 0
+
+
+def run_request(treestore, options, parser, argv, cwd):
+    '''Run a command sent to a server by a client in the directory `cwd`.
+    Commands for a different store than the server's are sent back to be
+    run by the client.'''
+    
+    args = parser.parse_args(argv)
+    if args.command == 'serve' or store_kwargs(args) != options:
+        raise daemon.RunLocally()
+    
+    # file names are relative to the client's working directory
+    if args.command == 'add':
+        args.file = os.path.join(cwd, args.file)
+    elif args.command == 'load':
+        args.files = [os.path.join(cwd, pattern) for pattern in args.files]
+    elif args.command == 'annotate' and args.file:
+        args.file = os.path.join(cwd, args.file)
+    elif args.command == 'edit' and args.edit == 'graft':
+        args.file = os.path.join(cwd, args.file)
+    elif args.command == 'query' and args.batch:
+        args.batch = os.path.join(cwd, args.batch)
+    
+    return run_command(treestore, args)
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    
+    options = store_kwargs(args)
+    store_options = dict(options)
+    treestore = get_store(store_options.pop('store', 'virtuoso'))(**store_options)
+    
+    if args.command == 'serve':
+        daemon.serve(lambda argv, cwd: run_request(treestore, options, parser, argv, cwd),
+                     args.socket)
+        treestore.close()
+        return
+    
+    sys.exit(run_command(treestore, args))
 
 
 if __name__ == '__main__':